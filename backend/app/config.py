@@ -1,10 +1,41 @@
 from pydantic_settings import BaseSettings
+from typing import Dict
 
 class Settings(BaseSettings):
     # Moodle
     moodle_url: str
-    moodle_token: str
-    moodle_user_id: int
+    # Single-account credentials, registered as the default sync user on startup.
+    # Further users (a whole cohort) are added through /api/users/.
+    moodle_token: str = ""
+    moodle_user_id: int = 0
+
+    # Moodle HTTP connection pool
+    moodle_http2: bool = True
+    moodle_max_connections: int = 20
+    moodle_max_keepalive_connections: int = 10
+    moodle_keepalive_expiry: float = 30.0
+    moodle_timeout: float = 30.0
+    moodle_connect_timeout: float = 10.0
+
+    # Moodle request scheduling (adaptive concurrency, retries, circuit breaker)
+    moodle_concurrency_initial: int = 5
+    moodle_concurrency_min: int = 1
+    moodle_concurrency_max: int = 16
+    moodle_latency_target: float = 3.0  # seconds; slower responses shrink the limit
+    moodle_max_retries: int = 3
+    moodle_retry_backoff_base: float = 0.5
+    moodle_retry_backoff_max: float = 15.0
+    moodle_breaker_failure_threshold: int = 5
+    moodle_breaker_reset_timeout: float = 60.0
+    # Max concurrent calls per wsfunction, e.g. MOODLE_FUNCTION_BUDGETS='{"core_course_get_contents": 4}'
+    moodle_function_budgets: Dict[str, int] = {
+        "mod_assign_get_submission_status": 8,
+        "core_course_get_contents": 4,
+    }
+    # Submission-status lookups packed into each tool_mobile_call_external_functions request
+    moodle_batch_size: int = 25
+    # Max concurrent calls per user token, so one user's sync cannot starve the others
+    moodle_user_concurrency: int = 4
 
     # Database
     database_url: str
@@ -12,6 +43,89 @@ class Settings(BaseSettings):
     # Scheduler
     sync_schedule_cron: str = "0 4 * * *"
 
+    # Multi-user syncs: the scheduled run spreads users (least recently synced first)
+    # over this window instead of starting every user at the cron time
+    sync_window_minutes: int = 120
+    sync_user_concurrency: int = 4  # Users synced at once by an in-process cohort run
+    # Course contents another user refreshed this recently are reused, not refetched
+    sync_shared_course_ttl_minutes: int = 180
+
+    # Durable job queue: when enabled the API only enqueues and `python -m app.worker` runs jobs
+    job_queue_enabled: bool = False
+    worker_concurrency: int = 2
+    worker_poll_interval: float = 5.0  # Fallback poll when no NOTIFY arrives
+    job_max_attempts: int = 3
+    job_retry_backoff_seconds: int = 30
+    job_visibility_timeout_seconds: int = 300  # Running jobs without a heartbeat this long are reclaimed
+
+    # Cross-process sync lease; renewed every ttl/3 while a sync runs
+    sync_lock_ttl_seconds: int = 60
+
+    # Sync pipeline: chunks of streamed course contents waiting for the DB writer.
+    # Peak memory is roughly queue size x chunk size resource rows.
+    sync_pipeline_queue_size: int = 4
+    sync_stream_chunk_size: int = 500
+
+    # Incremental sync: unchanged courses are skipped, but every course is fully
+    # refreshed at least this often
+    sync_incremental: bool = True
+    sync_full_resync_hours: int = 24 * 7
+    # A sync retried within this window resumes from the failed run's checkpoint
+    sync_resume_window_hours: int = 6
+
+    # Submission-status tiers: graded/long-closed assignments are refreshed rarely,
+    # unsubmitted ones due soon are polled by their own scheduler job
+    status_closed_after_days: int = 7
+    status_closed_refresh_hours: int = 24 * 7
+    status_urgent_window_days: int = 3
+    status_urgent_interval_minutes: int = 30
+
+    # Take grades from one gradebook call per course instead of submission statuses
+    sync_grades_from_gradebook: bool = True
+
+    # File downloads (ZIP builds): process-wide cap per host, so concurrent ZIPs
+    # cannot trip Moodle's throttling or run out of file descriptors
+    download_host_concurrency: int = 4
+    download_max_retries: int = 2
+    download_timeout: float = 60.0
+    download_chunk_size: int = 64 * 1024
+    # Files a ZIP build downloads ahead of the one being written; each is spooled
+    # in memory up to download_spool_memory_bytes, then to a temp file
+    download_zip_window: int = 4
+    download_spool_memory_bytes: int = 1024 * 1024
+
+    # Signed single-file download links; without a secret one is derived from DATABASE_URL
+    download_url_secret: str = ""
+    download_url_ttl: int = 6 * 3600  # Seconds; links stay valid for one to two of these
+
+    # Local mirror of Moodle files (content-addressed, LRU-evicted past the budget)
+    mirror_enabled: bool = True
+    mirror_dir: str = "/var/lib/moodle-mirror"
+    mirror_max_bytes: int = 20 * 1024 ** 3
+
+    # In-memory cache of listing responses, invalidated when a sync commits
+    response_cache_enabled: bool = True
+    response_cache_backend: str = "memory"
+    response_cache_max_entries: int = 1000
+    response_cache_ttl: int = 600  # Seconds; safety net for a missed invalidation
+
+    # Prebuilt per-course ZIPs, reused until the course's resource set changes
+    zip_cache_enabled: bool = True
+    zip_cache_dir: str = "/var/lib/moodle-zips"
+    zip_cache_max_bytes: int = 10 * 1024 ** 3
+    zip_prebuild_enabled: bool = False  # Build each synced user's course archives right after the sync
+
+    # Post-sync prefetch of new/changed files into the mirror, off-peak only
+    prefetch_enabled: bool = False
+    prefetch_window_start_hour: int = 0  # Local time, [start, end); start > end wraps midnight
+    prefetch_window_end_hour: int = 8
+    prefetch_concurrency: int = 2
+    prefetch_bandwidth_bytes_per_sec: int = 4 * 1024 * 1024  # Shared by all prefetch downloads, 0 = unlimited
+    prefetch_max_age_days: int = 14  # Only files added/modified this recently
+    prefetch_max_file_bytes: int = 200 * 1024 * 1024  # Leave large recordings to on-demand downloads
+    prefetch_max_files: int = 300  # Per run
+    prefetch_retry_hours: int = 24  # Failed files are retried after this long
+
     class Config:
         env_file = ".env"
 
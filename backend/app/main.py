@@ -1,22 +1,34 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from app.database import engine, Base
-from app.routers import courses, assignments, resources, schedule, sync, exams
+from app.routers import courses, assignments, resources, schedule, sync, exams, grades, jobs, users
 from app.scheduler import start_scheduler, stop_scheduler
+from app.services.http_client import open_http_client, close_http_client
+from app.services.course_zips import stop_zip_prebuilds
+from app.services.prefetch import stop_prefetch
+from app.services.response_cache import ResponseCacheMiddleware, start_invalidation_listener, stop_invalidation_listener
+from app.services.users import ensure_default_user
 from contextlib import asynccontextmanager
 # Import models to ensure they're registered with Base
-from app.models import course, assignment, resource
+from app.models import course, assignment, resource, sync_state, grade, sync_run, sync_lock, job, user, mirror
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+    await ensure_default_user()
+    await open_http_client()
+    await start_invalidation_listener()
     start_scheduler()
     print("[FastAPI] Application started successfully")
     yield
     # Shutdown
     stop_scheduler()
+    await stop_prefetch()
+    await stop_zip_prebuilds()
+    await stop_invalidation_listener()
+    await close_http_client()
     print("[FastAPI] Application shutdown complete")
 
 app = FastAPI(
@@ -25,6 +37,9 @@ app = FastAPI(
     lifespan=lifespan
 )
 
+# Cached listings; added before CORS so hits and 304s still get CORS headers
+app.add_middleware(ResponseCacheMiddleware)
+
 # CORS
 app.add_middleware(
     CORSMiddleware,
@@ -41,6 +56,9 @@ app.include_router(resources.router)
 app.include_router(schedule.router)
 app.include_router(sync.router)
 app.include_router(exams.router)
+app.include_router(grades.router)
+app.include_router(jobs.router)
+app.include_router(users.router)
 
 @app.get("/")
 async def root():
@@ -54,11 +72,20 @@ async def health():
 async def scheduler_status():
     """Get scheduler status and next run time"""
     from app.scheduler import scheduler
+    from app.services.sync_lock import held_locks, PROCESS_ID, SYNC_LOCK
+    lock = {"process": PROCESS_ID, "held": await held_locks(SYNC_LOCK)}
     if scheduler.running:
         job = scheduler.get_job('sync_moodle')
         return {
             "status": "running",
             "next_run": str(job.next_run_time) if job else None,
-            "schedule": "Daily at 04:00 AM"
+            "schedule": "Daily at 04:00 AM",
+            "sync_lock": lock
         }
-    return {"status": "stopped"}
+    return {"status": "stopped", "sync_lock": lock}
+
+@app.get("/moodle/status")
+async def moodle_status():
+    """Get Moodle request scheduler state (concurrency limit, circuit breaker)"""
+    from app.services.rate_limiter import get_request_scheduler
+    return get_request_scheduler().status()
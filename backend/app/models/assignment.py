@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, BigInteger, String, DateTime, Boolean, ForeignKey
+from sqlalchemy import Column, Integer, BigInteger, String, DateTime, Boolean, ForeignKey, UniqueConstraint
 from sqlalchemy.orm import relationship
 from app.database import Base
 from datetime import datetime
@@ -14,7 +14,20 @@ class Assignment(Base):
     due_date = Column(DateTime, nullable=True)
     description = Column(String, nullable=True)
     is_new = Column(Boolean, default=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class UserAssignment(Base):
+    """A user's submission status and grade for an assignment"""
+    __tablename__ = "user_assignments"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("moodle_users.id"), nullable=False, index=True)
+    assignment_id = Column(BigInteger, ForeignKey("assignments.moodle_id"), nullable=False, index=True)
     submitted = Column(Boolean, default=False)  # Submission status
     grade = Column(String, nullable=True)  # Grade for display
+    status_checked_at = Column(DateTime, nullable=True)  # Last time submission status was fetched
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (UniqueConstraint("user_id", "assignment_id", name="uq_user_assignments_user_assignment"),)
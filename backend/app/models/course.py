@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, BigInteger, String, Boolean, DateTime
+from sqlalchemy import Column, Integer, BigInteger, String, Boolean, DateTime, ForeignKey, UniqueConstraint
 from app.database import Base
 from datetime import datetime
 
@@ -10,8 +10,21 @@ class Course(Base):
     fullname = Column(String, nullable=False)
     shortname = Column(String, nullable=False)
     category_id = Column(Integer)
-    progress = Column(Integer, default=0)
     visible = Column(Boolean, default=True)
     notebook_url = Column(String, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class UserCourse(Base):
+    """A user's enrollment in a course, with their own progress and sync watermark"""
+    __tablename__ = "user_courses"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("moodle_users.id"), nullable=False, index=True)
+    course_id = Column(BigInteger, ForeignKey("courses.moodle_id"), nullable=False, index=True)
+    progress = Column(Integer, default=0)
+    last_synced_at = Column(DateTime, nullable=True)  # Start of the user's last sync that refreshed this course
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (UniqueConstraint("user_id", "course_id", name="uq_user_courses_user_course"),)
@@ -0,0 +1,23 @@
+from sqlalchemy import Column, Integer, BigInteger, String, Float, DateTime, ForeignKey, UniqueConstraint
+from app.database import Base
+from datetime import datetime
+
+class GradeItem(Base):
+    """A user's gradebook item - assignments, quizzes, course totals, etc."""
+    __tablename__ = "grade_items"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("moodle_users.id"), nullable=False, index=True)
+    moodle_id = Column(BigInteger, nullable=False, index=True)  # Gradebook item ID, shared by all users
+    course_id = Column(BigInteger, ForeignKey("courses.moodle_id"), index=True)
+    cmid = Column(BigInteger, nullable=True)  # Course module ID (null for course/category totals)
+    item_type = Column(String, nullable=True)  # mod, course, category, manual
+    item_module = Column(String, nullable=True)  # assign, quiz, ...
+    name = Column(String, nullable=True)
+    grade = Column(String, nullable=True)  # Grade for display
+    grade_raw = Column(Float, nullable=True)
+    grade_max = Column(Float, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (UniqueConstraint("user_id", "moodle_id", name="uq_grade_items_user_item"),)
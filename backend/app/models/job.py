@@ -0,0 +1,35 @@
+from sqlalchemy import Column, Integer, String, DateTime, JSON, Index, text
+from app.database import Base
+from datetime import datetime
+
+# Predicate of the partial unique index on dedupe_key. Kept as literal SQL: ON
+# CONFLICT can only infer a partial index from constants, not bound parameters
+ACTIVE_DEDUPE_PREDICATE = "status IN ('queued', 'running')"
+
+class Job(Base):
+    """Durable background job (sync, status refresh, ...) claimed by worker processes"""
+    __tablename__ = "jobs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    kind = Column(String, nullable=False)  # Handler name, e.g. "sync"
+    payload = Column(JSON, nullable=True)
+    status = Column(String, nullable=False, default="queued")  # queued, running, done, dead (retries exhausted)
+    dedupe_key = Column(String, nullable=True)  # At most one queued/running job per key
+    attempts = Column(Integer, default=0)
+    max_attempts = Column(Integer, default=3)
+    run_after = Column(DateTime, default=datetime.utcnow)
+    locked_by = Column(String, nullable=True)  # Worker holding the job
+    locked_at = Column(DateTime, nullable=True)  # Heartbeat; stale locks are reclaimed
+    events = Column(JSON, nullable=True)  # Progress events, for SSE followers in other processes
+    result = Column(JSON, nullable=True)
+    last_error = Column(String, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        Index("ix_jobs_claim", "status", "run_after"),
+        Index(
+            "uq_jobs_active_dedupe", "dedupe_key", unique=True,
+            postgresql_where=text(ACTIVE_DEDUPE_PREDICATE)
+        ),
+    )
@@ -0,0 +1,24 @@
+from sqlalchemy import Column, Integer, BigInteger, String, DateTime, ForeignKey
+from app.database import Base
+from datetime import datetime
+
+class MirrorBlob(Base):
+    """A file stored once in the local mirror, named by its content hash"""
+    __tablename__ = "mirror_blobs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    sha256 = Column(String(64), unique=True, nullable=False, index=True)
+    size = Column(BigInteger, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    last_accessed_at = Column(DateTime, default=datetime.utcnow, index=True)  # LRU eviction order
+
+class MirrorEntry(Base):
+    """Which blob holds a Moodle file, and the version of the file it was taken from"""
+    __tablename__ = "mirror_entries"
+
+    id = Column(Integer, primary_key=True, index=True)
+    file_url = Column(String, unique=True, nullable=False, index=True)  # Resource.file_url (no token)
+    filesize = Column(BigInteger, nullable=True)  # Moodle's filesize/timemodified when stored;
+    time_modified = Column(DateTime, nullable=True)  # a copy is stale once the resource's differ
+    sha256 = Column(String(64), ForeignKey("mirror_blobs.sha256", ondelete="CASCADE"), nullable=False, index=True)
+    stored_at = Column(DateTime, default=datetime.utcnow)
@@ -15,6 +15,11 @@ class Resource(Base):
     filesize = Column(Integer)
     section = Column(String, nullable=True)
     time_created = Column(DateTime, nullable=True)
+    time_modified = Column(DateTime, nullable=True)  # Moodle timemodified, tells mirrored copies apart
     is_new = Column(Boolean, default=True)
+    deleted_at = Column(DateTime, nullable=True, index=True)  # Set when the file disappears from Moodle
+    prefetch_status = Column(String, nullable=True)  # queued, done, failed (post-sync prefetch into the mirror)
+    prefetch_error = Column(String, nullable=True)
+    prefetch_attempted_at = Column(DateTime, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
@@ -0,0 +1,11 @@
+from sqlalchemy import Column, String, DateTime
+from app.database import Base
+
+class SyncLock(Base):
+    """Lease held by the process currently allowed to run a given job (e.g. the Moodle sync)"""
+    __tablename__ = "sync_locks"
+
+    name = Column(String, primary_key=True)
+    holder = Column(String, nullable=False)  # hostname:pid:nonce of the holding process, plus a nonce per lease
+    acquired_at = Column(DateTime, nullable=False)
+    expires_at = Column(DateTime, nullable=False)  # Holder must renew before this; afterwards anyone may take over
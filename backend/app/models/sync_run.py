@@ -0,0 +1,24 @@
+from sqlalchemy import Column, Integer, BigInteger, String, DateTime, Float, JSON
+from app.database import Base
+from datetime import datetime
+
+class SyncRun(Base):
+    """Ledger entry for one scheduled or manual sync"""
+    __tablename__ = "sync_runs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    trigger = Column(String, nullable=False)  # scheduled, manual
+    user_id = Column(Integer, nullable=True, index=True)  # moodle_users.id the run synced
+    mode = Column(String, nullable=False)  # full, incremental
+    status = Column(String, nullable=False, default="running")  # running, success, failed
+    started_at = Column(DateTime, default=datetime.utcnow, index=True)
+    finished_at = Column(DateTime, nullable=True)
+    duration = Column(Float, nullable=True)  # Seconds
+    phase_timings = Column(JSON, nullable=True)  # {"courses": 1.2, "contents": 8.4, ...}
+    moodle_calls = Column(JSON, nullable=True)  # {"core_course_get_contents": 13, ...}
+    response_bytes = Column(BigInteger, nullable=True)
+    rows = Column(JSON, nullable=True)  # {"resources": {"inserted": 3, "updated": 1}, ...}
+    errors = Column(JSON, nullable=True)  # Non-fatal errors (per course/assignment)
+    error = Column(String, nullable=True)  # Fatal error that failed the run
+    checkpoint = Column(JSON, nullable=True)  # {"phases": ["courses", ...], "courses": [ids with contents committed]}
+    resumed_from = Column(Integer, nullable=True)  # Failed run whose checkpoint this run continued
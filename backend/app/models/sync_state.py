@@ -0,0 +1,18 @@
+from sqlalchemy import Column, Integer, BigInteger, String, DateTime, ForeignKey
+from app.database import Base
+
+class CourseSyncState(Base):
+    """Shared per-course content state; per-user watermarks live in user_courses"""
+    __tablename__ = "course_sync_state"
+
+    id = Column(Integer, primary_key=True, index=True)
+    course_id = Column(BigInteger, ForeignKey("courses.moodle_id"), unique=True, nullable=False, index=True)
+    last_synced_at = Column(DateTime, nullable=True)  # Start time of the last sync that refreshed this course
+    last_full_sync_at = Column(DateTime, nullable=True)
+    last_synced_by = Column(Integer, nullable=True)  # moodle_users.id whose sync last fetched the contents
+    content_hash = Column(String, nullable=True)  # Fingerprint of the last core_course_get_contents payload
+    assignments_hash = Column(String, nullable=True)  # Fingerprint of the course's mod_assign_get_assignments entry
+    fingerprint_hits = Column(Integer, default=0)  # Syncs where unchanged contents skipped DB reconciliation
+    fingerprint_misses = Column(Integer, default=0)
+    course_timemodified = Column(DateTime, nullable=True)
+    course_lastaccess = Column(DateTime, nullable=True)
@@ -0,0 +1,17 @@
+from sqlalchemy import Column, Integer, BigInteger, String, DateTime, Boolean
+from app.database import Base
+from datetime import datetime
+
+class MoodleUser(Base):
+    """A Moodle account whose data is synced, with its own web-service token"""
+    __tablename__ = "moodle_users"
+
+    id = Column(Integer, primary_key=True, index=True)
+    moodle_user_id = Column(BigInteger, unique=True, nullable=False, index=True)
+    name = Column(String, nullable=True)
+    token = Column(String, nullable=False)
+    enabled = Column(Boolean, default=True)
+    last_synced_at = Column(DateTime, nullable=True)  # End of the user's last sync, used for fair ordering
+    last_sync_status = Column(String, nullable=True)  # success, failed, skipped
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
@@ -1,23 +1,30 @@
 from fastapi import APIRouter, Depends
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
+from sqlalchemy import select, and_, func
 from app.database import get_db
-from app.models.assignment import Assignment
-from app.models.course import Course
+from app.models.assignment import Assignment, UserAssignment
+from app.models.course import Course, UserCourse
+from app.models.user import MoodleUser
+from app.services.users import get_current_user
 from datetime import datetime, timezone
 
 router = APIRouter(prefix="/api/assignments", tags=["Assignments"])
 
 @router.get("/")
-async def get_assignments(db: AsyncSession = Depends(get_db)):
+async def get_assignments(user: MoodleUser = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    submitted = func.coalesce(UserAssignment.submitted, False)
     result = await db.execute(
-        select(Assignment)
-        .order_by(Assignment.submitted.asc(), Assignment.due_date.asc())
+        select(Assignment, submitted.label("submitted"), UserAssignment.grade)
+        .join(UserCourse, and_(UserCourse.course_id == Assignment.course_id, UserCourse.user_id == user.id))
+        .outerjoin(UserAssignment, and_(
+            UserAssignment.assignment_id == Assignment.moodle_id, UserAssignment.user_id == user.id
+        ))
+        .order_by(submitted.asc(), Assignment.due_date.asc())
     )
-    assignments = result.scalars().all()
+    rows = result.all()
 
     # Fetch course names
-    course_ids = list(set(a.course_id for a in assignments))
+    course_ids = list(set(a.course_id for a, _, _ in rows))
     courses_result = await db.execute(
         select(Course).where(Course.moodle_id.in_(course_ids))
     )
@@ -31,9 +38,9 @@ async def get_assignments(db: AsyncSession = Depends(get_db)):
             "course_name": courses.get(a.course_id).fullname if a.course_id in courses else "",
             "name": a.name,
             "due_date": a.due_date.replace(tzinfo=timezone.utc).isoformat() if a.due_date else None,
-            "submitted": a.submitted,
-            "grade": a.grade,
+            "submitted": is_submitted,
+            "grade": grade,
             "is_new": a.is_new
         }
-        for a in assignments
+        for a, is_submitted, grade in rows
     ]
@@ -2,24 +2,30 @@ from fastapi import APIRouter, Depends
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 from app.database import get_db
-from app.models.course import Course
+from app.models.course import Course, UserCourse
+from app.models.user import MoodleUser
+from app.services.users import get_current_user
 from typing import List
 
 router = APIRouter(prefix="/api/courses", tags=["Courses"])
 
 @router.get("/")
-async def get_courses(db: AsyncSession = Depends(get_db)):
-    result = await db.execute(select(Course).where(Course.visible == True))
-    courses = result.scalars().all()
+async def get_courses(user: MoodleUser = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    result = await db.execute(
+        select(Course, UserCourse.progress)
+        .join(UserCourse, UserCourse.course_id == Course.moodle_id)
+        .where(UserCourse.user_id == user.id)
+        .where(Course.visible == True)
+    )
     return [
         {
             "id": c.moodle_id,
             "moodle_id": c.moodle_id,
             "fullname": c.fullname,
             "shortname": c.shortname,
-            "progress": c.progress,
+            "progress": progress,
             "notebook_url": c.notebook_url,
             "updated_at": c.updated_at.isoformat() if c.updated_at else None
         }
-        for c in courses
+        for c, progress in result.all()
     ]
@@ -0,0 +1,32 @@
+from fastapi import APIRouter, Depends
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select
+from app.database import get_db
+from app.models.grade import GradeItem
+from app.models.user import MoodleUser
+from app.services.users import get_current_user
+
+router = APIRouter(prefix="/api/grades", tags=["Grades"])
+
+@router.get("/")
+async def get_grades(course_id: int = None, user: MoodleUser = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    query = select(GradeItem).where(GradeItem.user_id == user.id)
+    if course_id:
+        query = query.where(GradeItem.course_id == course_id)
+
+    result = await db.execute(query.order_by(GradeItem.course_id, GradeItem.id))
+    return [
+        {
+            "id": g.moodle_id,
+            "course_id": g.course_id,
+            "cmid": g.cmid,
+            "item_type": g.item_type,
+            "item_module": g.item_module,
+            "name": g.name,
+            "grade": g.grade,
+            "grade_raw": g.grade_raw,
+            "grade_max": g.grade_max,
+            "updated_at": g.updated_at.isoformat() if g.updated_at else None
+        }
+        for g in result.scalars().all()
+    ]
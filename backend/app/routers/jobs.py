@@ -0,0 +1,46 @@
+from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select
+from app.database import get_db
+from app.models.job import Job
+from app.services import job_queue
+
+router = APIRouter(prefix="/api/jobs", tags=["Jobs"])
+
+@router.get("/")
+async def get_jobs(status: str = None, kind: str = None, limit: int = 50, db: AsyncSession = Depends(get_db)):
+    """Background jobs, newest first (status=dead lists the dead-letter queue)"""
+    query = select(Job)
+    if status:
+        query = query.where(Job.status == status)
+    if kind:
+        query = query.where(Job.kind == kind)
+
+    result = await db.execute(query.order_by(Job.id.desc()).limit(limit))
+    return [
+        {
+            "id": j.id,
+            "kind": j.kind,
+            "payload": j.payload,
+            "status": j.status,
+            "attempts": j.attempts,
+            "max_attempts": j.max_attempts,
+            "locked_by": j.locked_by,
+            "last_error": j.last_error,
+            "result": j.result,
+            "created_at": j.created_at.isoformat() if j.created_at else None,
+            "finished_at": j.finished_at.isoformat() if j.finished_at else None
+        }
+        for j in result.scalars().all()
+    ]
+
+@router.post("/{job_id}/retry")
+async def retry_job(job_id: int):
+    """Requeue a dead-lettered job (or point at the active job doing the same work)"""
+    retried = await job_queue.retry_dead(job_id)
+    if not retried:
+        raise HTTPException(status_code=404, detail="Dead job not found")
+    active_id, requeued = retried
+    if not requeued:
+        return {"message": "An identical job is already queued or running", "id": active_id}
+    return {"message": "Job requeued", "id": active_id}
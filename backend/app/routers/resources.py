@@ -1,238 +1,237 @@
-from fastapi import APIRouter, Depends, HTTPException, BackgroundTasks
-from fastapi.responses import FileResponse
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.responses import Response, StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 from app.database import get_db
 from app.models.resource import Resource
-from app.models.course import Course
-from app.config import settings
-import httpx
-import os
-import shutil
-import tempfile
-import zipfile
-import asyncio
+from app.models.course import Course, UserCourse
+from app.models.user import MoodleUser
+from app.services.users import get_current_user
+from app.services.course_zips import archive_files, get_zip_cache, load_course_archive, start_zip
+from app.services.download_links import sign_download, verify_download
+from app.services.downloads import DownloadFailed, DownloadItem, attach_progress, get_download_engine, get_progress
+from app.services.file_mirror import MirrorKey, get_file_mirror
+from app.services.file_responses import etag_matches, file_response
+from urllib.parse import quote
 from datetime import timezone
+import uuid
 
 router = APIRouter(prefix="/api/resources", tags=["Resources"])
 
+def _enrolled_courses(user: MoodleUser):
+    return select(UserCourse.course_id).where(UserCourse.user_id == user.id)
+
+def _download_url(request: Request, resource: Resource, user: MoodleUser) -> str:
+    """Signed link to the download proxy below, so the Moodle token never reaches the browser"""
+    expires, sig = sign_download(resource.id, user.id)
+    url = request.url_for("download_resource", resource_id=resource.id)
+    return str(url.include_query_params(user_id=user.id, expires=expires, sig=sig))
+
+def _resource_dict(r: Resource, download_url: str) -> dict:
+    return {
+        "id": r.id,  # Use database primary key, not moodle_id (which is not unique)
+        "moodle_id": r.moodle_id,
+        "course_id": r.course_id,
+        "filename": r.filename,
+        "section": r.section,
+        "download_url": download_url,
+        "mimetype": r.mimetype,
+        "filesize": r.filesize,
+        "is_new": r.is_new,
+        "time_created": r.time_created.replace(tzinfo=timezone.utc).isoformat() if r.time_created else None
+    }
+
 @router.get("/")
-async def get_resources(course_id: int = None, db: AsyncSession = Depends(get_db)):
-    query = select(Resource)
+async def get_resources(request: Request, course_id: int = None, user: MoodleUser = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    query = (
+        select(Resource)
+        .where(Resource.course_id.in_(_enrolled_courses(user)))
+        .where(Resource.deleted_at.is_(None))
+    )
     if course_id:
         query = query.where(Resource.course_id == course_id)
 
     result = await db.execute(query.order_by(Resource.time_created.desc()))
     resources = result.scalars().all()
 
-    return [
-        {
-            "id": r.id,  # Use database primary key, not moodle_id (which is not unique)
-            "moodle_id": r.moodle_id,
-            "course_id": r.course_id,
-            "filename": r.filename,
-            "section": r.section,
-            "download_url": f"{r.file_url}&token={settings.moodle_token}",
-            "mimetype": r.mimetype,
-            "filesize": r.filesize,
-            "is_new": r.is_new,
-            "time_created": r.time_created.replace(tzinfo=timezone.utc).isoformat() if r.time_created else None
-        }
-        for r in resources
-    ]
-
-def remove_file(path: str):
-    try:
-        if os.path.exists(path):
-            os.remove(path)
-    except Exception as e:
-        print(f"Error deleting file {path}: {e}")
+    return [_resource_dict(r, _download_url(request, r, user)) for r in resources]
+
+def _attachment(filename: str) -> dict:
+    """Content-Disposition header, RFC 5987-encoded for non-ASCII names (as FileResponse does)"""
+    quoted = quote(filename)
+    if quoted != filename:
+        return {"Content-Disposition": f"attachment; filename*=utf-8''{quoted}"}
+    return {"Content-Disposition": f'attachment; filename="{filename}"'}
+
+def _zip_response(files: list, user: MoodleUser, zip_filename: str, download_id: str = None) -> StreamingResponse:
+    chunks, progress = start_zip(files, user.token, download_id, user.id)
+    return StreamingResponse(
+        chunks,
+        media_type='application/zip',
+        headers={**_attachment(zip_filename), "X-Download-Id": progress.id},
+    )
 
 @router.get("/download-zip/{course_id}")
-async def download_course_zip(course_id: int, flat: bool = False, background_tasks: BackgroundTasks = None, db: AsyncSession = Depends(get_db)):
+async def download_course_zip(request: Request, course_id: int, flat: bool = False, download_id: str = None, user: MoodleUser = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    """
+    Course archive, served from the prebuilt-archive cache while the course's
+    files are unchanged (with ETag and Range support). An archive not built
+    yet streams while it is written to the cache; concurrent requests for it
+    share that build.
+    """
     # Get course info
-    course_stmt = select(Course).where(Course.moodle_id == course_id)
+    course_stmt = select(Course).where(Course.moodle_id == course_id, Course.moodle_id.in_(_enrolled_courses(user)))
     course_res = await db.execute(course_stmt)
     course = course_res.scalar_one_or_none()
 
     if not course:
         raise HTTPException(status_code=404, detail="Course not found")
 
-    # Get all resources for the course
-    stmt = select(Resource).where(Resource.course_id == course_id)
-    result = await db.execute(stmt)
-    resources = result.scalars().all()
+    # All resources of the course, without files removed from Moodle
+    files, key = await load_course_archive(db, course_id, flat)
 
-    if not resources:
+    if not files:
         raise HTTPException(status_code=404, detail="No resources found for this course")
 
-    # Create temporary directory
-    temp_dir = tempfile.mkdtemp()
     zip_filename = f"{course.shortname}_files.zip".replace(" ", "_")
-    zip_path = os.path.join(tempfile.gettempdir(), zip_filename)
-
-    try:
-        async with httpx.AsyncClient() as client:
-            tasks = []
-            filenames_count = {}  # Track duplicate filenames for flat mode
-
-            for resource in resources:
-                download_url = f"{resource.file_url}&token={settings.moodle_token}"
-
-                if flat:
-                    # Flat mode: all files in root, handle duplicates
-                    base_filename = resource.filename
-                    if base_filename in filenames_count:
-                        filenames_count[base_filename] += 1
-                        name, ext = os.path.splitext(base_filename)
-                        actual_filename = f"{name}_{filenames_count[base_filename]}{ext}"
-                    else:
-                        filenames_count[base_filename] = 0
-                        actual_filename = base_filename
-                    file_path = os.path.join(temp_dir, actual_filename)
-                else:
-                    # Organized mode: files in section folders
-                    section_name = resource.section if resource.section else "General"
-                    section_name = "".join([c for c in section_name if c.isalnum() or c in (' ', '-', '_')]).strip()
-                    section_dir = os.path.join(temp_dir, section_name)
-                    os.makedirs(section_dir, exist_ok=True)
-                    file_path = os.path.join(section_dir, resource.filename)
-
-                async def download_file(url, path):
-                    try:
-                        resp = await client.get(url, follow_redirects=True, timeout=30.0)
-                        if resp.status_code == 200:
-                            with open(path, "wb") as f:
-                                f.write(resp.content)
-                    except Exception as e:
-                        print(f"Error downloading {url}: {e}")
-
-                tasks.append(download_file(download_url, file_path))
-
-            # Download concurrently
-            await asyncio.gather(*tasks)
-
-        # Create ZIP file
-        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            if flat:
-                # Flat: just list files in temp_dir
-                for file in os.listdir(temp_dir):
-                    file_path = os.path.join(temp_dir, file)
-                    if os.path.isfile(file_path):
-                        zipf.write(file_path, file)
-            else:
-                # Organized: preserve folder structure
-                for root, dirs, files in os.walk(temp_dir):
-                    for file in files:
-                        file_path = os.path.join(root, file)
-                        arcname = os.path.relpath(file_path, temp_dir)
-                        zipf.write(file_path, arcname)
-
-    finally:
-        # Cleanup temp directory
-        shutil.rmtree(temp_dir)
-
-    # Schedule cleanup of zip file
-    background_tasks.add_task(remove_file, zip_path)
-
-    return FileResponse(
-        zip_path,
-        media_type='application/zip',
-        filename=zip_filename
-    )
+    cache = get_zip_cache()
+    if cache is None:
+        return _zip_response(files, user, zip_filename, download_id)
+    if etag_matches(request.headers.get("if-none-match"), key.etag):
+        # Same resource set as the archive the client already has
+        return Response(status_code=304, headers={"ETag": key.etag})
+
+    # A cold build can take minutes: do not hold a pooled connection meanwhile
+    await db.close()
+    download_id = download_id or uuid.uuid4().hex
+    cached = await cache.get_or_build(key, lambda: start_zip(files, user.token, download_id, user.id))
+    headers = _attachment(zip_filename)
+    if cached.file is None:
+        # The build may be another request's: poll it under this client's own id
+        attach_progress(user.id, download_id, cached.progress)
+        # Being built: no validator, an archive with failed files is not cached
+        return StreamingResponse(cached.chunks, media_type="application/zip", headers={**headers, "X-Download-Id": download_id})
+    return file_response(request, cached.file, cached.size, "application/zip", key.etag, headers)
 
 @router.get("/download-all-zip")
-async def download_all_resources_zip(background_tasks: BackgroundTasks, db: AsyncSession = Depends(get_db)):
+async def download_all_resources_zip(download_id: str = None, user: MoodleUser = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
     """Download all resources from all courses as a flat zip (no folders)"""
-    # Get all resources
-    stmt = select(Resource)
+    # Get all resources of the user's courses, without files removed from Moodle
+    stmt = select(Resource).where(Resource.course_id.in_(_enrolled_courses(user)), Resource.deleted_at.is_(None))
     result = await db.execute(stmt)
     resources = result.scalars().all()
 
     if not resources:
         raise HTTPException(status_code=404, detail="No resources found")
 
-    # Create temporary directory
-    temp_dir = tempfile.mkdtemp()
-    zip_filename = "all_course_materials.zip"
-    zip_path = os.path.join(tempfile.gettempdir(), zip_filename)
-
+    return _zip_response(archive_files(resources, flat=True), user, "all_course_materials.zip", download_id)
+
+@router.get("/{resource_id}/download")
+async def download_resource(request: Request, resource_id: int, inline: bool = False, expires: int = None, sig: str = None, user: MoodleUser = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    """
+    Single file through the backend, with the user's token kept server-side.
+    Served from the local mirror when it holds the current version, with
+    If-None-Match and Range support so videos seek and large PDFs resume.
+    Otherwise Moodle's bytes are passed on as they arrive while one fetch,
+    shared by concurrent requests, fills the mirror. Only links signed by
+    the listings (download_url) are served, as the file is fetched with the
+    linked user's token.
+    """
+    if not verify_download(resource_id, user.id, expires, sig):
+        raise HTTPException(status_code=403, detail="Invalid or expired download link")
+    result = await db.execute(
+        select(Resource).where(
+            Resource.id == resource_id,
+            Resource.course_id.in_(_enrolled_courses(user)),
+            Resource.deleted_at.is_(None),
+        )
+    )
+    resource = result.scalar_one_or_none()
+    if not resource:
+        raise HTTPException(status_code=404, detail="Resource not found")
+
+    key = MirrorKey(resource.file_url, resource.filesize, resource.time_modified)
+    if etag_matches(request.headers.get("if-none-match"), key.etag):
+        return Response(status_code=304, headers={"ETag": key.etag})
+
+    item = DownloadItem(f"{resource.file_url}&token={user.token}", resource.filename, key)
+    filename, mimetype = resource.filename, resource.mimetype or "application/octet-stream"
+    # Do not hold a pooled connection while Moodle sends the file
+    await db.close()
     try:
-        async with httpx.AsyncClient() as client:
-            tasks = []
-            filenames_count = {}  # Track duplicate filenames
-
-            for resource in resources:
-                download_url = f"{resource.file_url}&token={settings.moodle_token}"
-
-                # Handle duplicate filenames by adding a suffix
-                base_filename = resource.filename
-                if base_filename in filenames_count:
-                    filenames_count[base_filename] += 1
-                    name, ext = os.path.splitext(base_filename)
-                    actual_filename = f"{name}_{filenames_count[base_filename]}{ext}"
-                else:
-                    filenames_count[base_filename] = 0
-                    actual_filename = base_filename
-
-                file_path = os.path.join(temp_dir, actual_filename)
-
-                async def download_file(url, path):
-                    try:
-                        resp = await client.get(url, follow_redirects=True, timeout=30.0)
-                        if resp.status_code == 200:
-                            with open(path, "wb") as f:
-                                f.write(resp.content)
-                    except Exception as e:
-                        print(f"Error downloading {url}: {e}")
-
-                tasks.append(download_file(download_url, file_path))
-
-            # Download concurrently
-            await asyncio.gather(*tasks)
-
-        # Create ZIP file (flat structure - all files in root)
-        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for file in os.listdir(temp_dir):
-                file_path = os.path.join(temp_dir, file)
-                if os.path.isfile(file_path):
-                    zipf.write(file_path, file)
-
-    finally:
-        # Cleanup temp directory
-        shutil.rmtree(temp_dir)
-
-    # Schedule cleanup of zip file
-    background_tasks.add_task(remove_file, zip_path)
-
-    return FileResponse(
-        zip_path,
-        media_type='application/zip',
-        filename=zip_filename
+        download = await get_download_engine().stream(item)
+    except DownloadFailed as e:
+        raise HTTPException(status_code=502, detail=f"Could not download file from Moodle: {e}")
+
+    headers = _attachment(filename)
+    if inline:
+        headers["Content-Disposition"] = headers["Content-Disposition"].replace("attachment", "inline", 1)
+    headers = {**headers, "Cache-Control": "private, no-cache"}
+    if download.file is None:
+        # Not mirrored yet: whole file only, Range works once it is
+        return StreamingResponse(download.chunks, media_type=mimetype, headers={**headers, "ETag": key.etag})
+    return file_response(request, download.file, download.size, mimetype, key.etag, headers)
+
+@router.get("/{resource_id}/prefetch")
+async def get_prefetch_status(resource_id: int, user: MoodleUser = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    """Whether the current version of a file is in the local mirror, and how its prefetch went"""
+    result = await db.execute(
+        select(Resource).where(Resource.id == resource_id, Resource.course_id.in_(_enrolled_courses(user)))
     )
+    resource = result.scalar_one_or_none()
+    if not resource:
+        raise HTTPException(status_code=404, detail="Resource not found")
+
+    mirror = get_file_mirror()
+    key = MirrorKey(resource.file_url, resource.filesize, resource.time_modified)
+    cached = mirror is not None and bool(await mirror.lookup([key]))
+    return {
+        "resource_id": resource.id,
+        "cached": cached,
+        "status": resource.prefetch_status,
+        "error": resource.prefetch_error,
+        "attempted_at": resource.prefetch_attempted_at.replace(tzinfo=timezone.utc).isoformat() if resource.prefetch_attempted_at else None,
+    }
+
+@router.get("/mirror")
+async def get_mirror_status():
+    """Size of the local file mirror against its byte budget"""
+    mirror = get_file_mirror()
+    if mirror is None:
+        return {"enabled": False}
+    return {"enabled": True, **await mirror.status()}
+
+@router.get("/zip-cache")
+async def get_zip_cache_status():
+    """Prebuilt course archives on disk against their byte budget"""
+    cache = get_zip_cache()
+    if cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **cache.status()}
+
+@router.get("/downloads/{download_id}")
+async def get_download_progress(download_id: str, user: MoodleUser = Depends(get_current_user)):
+    """
+    Progress of a ZIP download: files/bytes done and the files that failed.
+    Pass the same download_id to the ZIP endpoint to poll while it streams
+    (it is also returned in the X-Download-Id header). Ids are per user: only
+    the user who started the download can read it.
+    """
+    progress = get_progress(user.id, download_id)
+    if not progress:
+        raise HTTPException(status_code=404, detail="Download not found")
+    return progress.to_dict()
 
 @router.get("/new")
-async def get_new_resources(db: AsyncSession = Depends(get_db)):
+async def get_new_resources(request: Request, user: MoodleUser = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
     result = await db.execute(
         select(Resource)
+        .where(Resource.course_id.in_(_enrolled_courses(user)))
         .where(Resource.is_new == True)
+        .where(Resource.deleted_at.is_(None))
         .order_by(Resource.time_created.desc())
         .limit(20)
     )
     resources = result.scalars().all()
 
-    return [
-        {
-            "id": r.id,  # Use database primary key, not moodle_id (which is not unique)
-            "moodle_id": r.moodle_id,
-            "course_id": r.course_id,
-            "filename": r.filename,
-            "section": r.section,
-            "download_url": f"{r.file_url}&token={settings.moodle_token}",
-            "mimetype": r.mimetype,
-            "filesize": r.filesize,
-            "is_new": r.is_new,
-            "time_created": r.time_created.replace(tzinfo=timezone.utc).isoformat() if r.time_created else None
-        }
-        for r in resources
-    ]
+    return [_resource_dict(r, _download_url(request, r, user)) for r in resources]
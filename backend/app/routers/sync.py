@@ -1,21 +1,99 @@
-from fastapi import APIRouter, Depends, BackgroundTasks, HTTPException
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select
 from app.database import get_db
-from app.services.sync_service import SyncService
-import traceback
+from app.services.sync_jobs import sync_jobs, format_sse
+from app.models.sync_state import CourseSyncState
+from app.models.sync_run import SyncRun
 
 router = APIRouter(prefix="/api/sync", tags=["Sync"])
 
-@router.post("/")
-async def trigger_sync(
-    db: AsyncSession = Depends(get_db)
-):
-    """Manual sync trigger"""
-    try:
-        sync_service = SyncService(db)
-        await sync_service.sync_all()
-        return {"message": "Sync completed successfully"}
-    except Exception as e:
-        print(f"[SYNC ERROR] {type(e).__name__}: {e}")
-        traceback.print_exc()
-        raise HTTPException(status_code=500, detail=f"Sync failed: {str(e)}")
+@router.post("/", status_code=202)
+async def trigger_sync(full: bool = False, user_id: int = None):
+    """
+    Manual sync trigger (full=true refetches every course regardless of watermarks).
+
+    Syncs every enabled user, or only user_id. Returns immediately with a job
+    id; a trigger while the same sync is running joins that job instead of
+    starting a second one.
+    """
+    job, coalesced = await sync_jobs.start(trigger="manual", full=full, user_id=user_id)
+    return {"message": "Sync started", "coalesced": coalesced, **job.to_dict()}
+
+@router.get("/jobs/{job_id}")
+async def get_sync_job(job_id: str):
+    job = await sync_jobs.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Sync job not found")
+    return job.to_dict()
+
+@router.get("/jobs/{job_id}/events")
+async def stream_sync_job(job_id: str):
+    """Server-sent events with the job's phase/progress updates"""
+    job = await sync_jobs.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Sync job not found")
+
+    async def event_stream():
+        async for entry in job.subscribe():
+            yield format_sse(entry)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@router.get("/fingerprints")
+async def get_fingerprint_stats(db: AsyncSession = Depends(get_db)):
+    """Per-course payload fingerprint hit/skip counts"""
+    result = await db.execute(select(CourseSyncState).order_by(CourseSyncState.course_id))
+    return [
+        {
+            "course_id": s.course_id,
+            "content_hash": s.content_hash,
+            "assignments_hash": s.assignments_hash,
+            "hits": s.fingerprint_hits or 0,
+            "misses": s.fingerprint_misses or 0,
+            "last_synced_at": s.last_synced_at.isoformat() if s.last_synced_at else None,
+            "last_synced_by": s.last_synced_by
+        }
+        for s in result.scalars().all()
+    ]
+
+def _serialize_run(run: SyncRun) -> dict:
+    return {
+        "id": run.id,
+        "trigger": run.trigger,
+        "user_id": run.user_id,
+        "mode": run.mode,
+        "status": run.status,
+        "started_at": run.started_at.isoformat() if run.started_at else None,
+        "finished_at": run.finished_at.isoformat() if run.finished_at else None,
+        "duration": run.duration,
+        "phase_timings": run.phase_timings,
+        "moodle_calls": run.moodle_calls,
+        "response_bytes": run.response_bytes,
+        "rows": run.rows,
+        "errors": run.errors,
+        "error": run.error,
+        "checkpoint": run.checkpoint,
+        "resumed_from": run.resumed_from
+    }
+
+@router.get("/runs")
+async def get_sync_runs(limit: int = 50, user_id: int = None, db: AsyncSession = Depends(get_db)):
+    """Recent sync runs, newest first"""
+    query = select(SyncRun)
+    if user_id is not None:
+        query = query.where(SyncRun.user_id == user_id)
+    result = await db.execute(query.order_by(SyncRun.started_at.desc()).limit(limit))
+    return [_serialize_run(r) for r in result.scalars().all()]
+
+@router.get("/runs/{run_id}")
+async def get_sync_run(run_id: int, db: AsyncSession = Depends(get_db)):
+    run = await db.get(SyncRun, run_id)
+    if not run:
+        raise HTTPException(status_code=404, detail="Sync run not found")
+    return _serialize_run(run)
@@ -0,0 +1,77 @@
+from fastapi import APIRouter, Depends, HTTPException
+from pydantic import BaseModel
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select
+from app.database import get_db
+from app.models.user import MoodleUser
+from app.services.moodle_client import MoodleClient
+from app.services.response_cache import invalidate_responses
+from app.services.sync_jobs import sync_jobs
+from typing import Optional
+
+router = APIRouter(prefix="/api/users", tags=["Users"])
+
+class UserCreate(BaseModel):
+    token: str
+    name: Optional[str] = None
+    moodle_user_id: Optional[int] = None  # Looked up from the token when omitted
+
+class UserUpdate(BaseModel):
+    token: Optional[str] = None
+    name: Optional[str] = None
+    enabled: Optional[bool] = None
+
+def _serialize_user(user: MoodleUser) -> dict:
+    # The token is never returned
+    return {
+        "id": user.id,
+        "moodle_user_id": user.moodle_user_id,
+        "name": user.name,
+        "enabled": user.enabled,
+        "last_synced_at": user.last_synced_at.isoformat() if user.last_synced_at else None,
+        "last_sync_status": user.last_sync_status
+    }
+
+@router.get("/")
+async def get_users(db: AsyncSession = Depends(get_db)):
+    result = await db.execute(select(MoodleUser).order_by(MoodleUser.id))
+    return [_serialize_user(u) for u in result.scalars().all()]
+
+@router.post("/", status_code=201)
+async def create_user(body: UserCreate, db: AsyncSession = Depends(get_db)):
+    """Register a Moodle account by its web-service token"""
+    moodle_user_id, name = body.moodle_user_id, body.name
+    if moodle_user_id is None:
+        info = await MoodleClient(token=body.token).get_site_info()
+        if not isinstance(info, dict) or 'userid' not in info:
+            raise HTTPException(status_code=400, detail="Could not identify the token's Moodle user")
+        moodle_user_id, name = info['userid'], name or info.get('fullname')
+
+    existing = await db.execute(select(MoodleUser).where(MoodleUser.moodle_user_id == moodle_user_id))
+    if existing.scalar_one_or_none():
+        raise HTTPException(status_code=409, detail="Moodle user already registered")
+
+    user = MoodleUser(moodle_user_id=moodle_user_id, name=name, token=body.token, enabled=True)
+    db.add(user)
+    await db.commit()
+    await invalidate_responses()
+    return _serialize_user(user)
+
+@router.patch("/{user_id}")
+async def update_user(user_id: int, body: UserUpdate, db: AsyncSession = Depends(get_db)):
+    user = await db.get(MoodleUser, user_id)
+    if not user:
+        raise HTTPException(status_code=404, detail="Moodle user not found")
+    for field, value in body.model_dump(exclude_unset=True).items():
+        setattr(user, field, value)
+    await db.commit()
+    await invalidate_responses()
+    return _serialize_user(user)
+
+@router.post("/{user_id}/sync", status_code=202)
+async def sync_user(user_id: int, full: bool = False, db: AsyncSession = Depends(get_db)):
+    """Sync a single user now"""
+    if not await db.get(MoodleUser, user_id):
+        raise HTTPException(status_code=404, detail="Moodle user not found")
+    job, coalesced = await sync_jobs.start(trigger="manual", full=full, user_id=user_id)
+    return {"message": "Sync started", "coalesced": coalesced, **job.to_dict()}
@@ -1,22 +1,46 @@
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
-from app.services.sync_service import SyncService
-from app.database import AsyncSessionLocal
+from apscheduler.triggers.interval import IntervalTrigger
+from app.services.sync_jobs import sync_jobs, refresh_urgent_statuses_all
+from app.services.sync_lock import LeaseLock, LockNotAcquired, URGENT_REFRESH_LOCK
+from app.services.job_queue import enqueue
 from app.config import settings
 import asyncio
 
 scheduler = AsyncIOScheduler()
 
 async def scheduled_sync():
-    """Background sync task"""
+    """Background sync of every enabled user, staggered over settings.sync_window_minutes"""
     print("[Scheduler] Starting scheduled sync...")
-    async with AsyncSessionLocal() as db:
-        sync_service = SyncService(db)
-        try:
-            await sync_service.sync_all()
+    # Goes through the job manager so a manual sync in flight is joined, not duplicated
+    job, coalesced = await sync_jobs.start(trigger="scheduled")
+    if coalesced:
+        print(f"[Scheduler] Joining sync job {job.id} already in progress")
+    if settings.job_queue_enabled:
+        print(f"[Scheduler] Sync queued as job {job.id}")
+        return
+    try:
+        await job.wait()
+        if job.status == "skipped":
+            print("[Scheduler] Sync is running in another process, skipped")
+        else:
             print("[Scheduler] Scheduled sync completed successfully")
-        except Exception as e:
-            print(f"[Scheduler] Sync failed: {e}")
+    except Exception as e:
+        print(f"[Scheduler] Sync failed: {e}")
+
+async def scheduled_urgent_refresh():
+    """Frequent submission-status poll for assignments due soon"""
+    if settings.job_queue_enabled:
+        await enqueue("urgent_refresh", dedupe_key="urgent_refresh", max_attempts=1)
+        return
+    try:
+        async with LeaseLock(URGENT_REFRESH_LOCK).hold():
+            await refresh_urgent_statuses_all()
+    except LockNotAcquired:
+        # Another worker/replica is polling this round
+        pass
+    except Exception as e:
+        print(f"[Scheduler] Urgent status refresh failed: {e}")
 
 def start_scheduler():
     """Start the background scheduler"""
@@ -32,6 +56,12 @@ def start_scheduler():
     )
 
     scheduler.add_job(scheduled_sync, trigger, id='sync_moodle', replace_existing=True)
+    scheduler.add_job(
+        scheduled_urgent_refresh,
+        IntervalTrigger(minutes=settings.status_urgent_interval_minutes),
+        id='refresh_urgent_statuses',
+        replace_existing=True
+    )
     scheduler.start()
     print(f"[Scheduler] Started with schedule: {settings.sync_schedule_cron}")
     print(f"[Scheduler] Next run: {scheduler.get_job('sync_moodle').next_run_time}")
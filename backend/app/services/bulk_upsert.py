@@ -0,0 +1,52 @@
+from datetime import datetime
+from typing import Dict, List, Sequence, Tuple, Union
+from sqlalchemy import tuple_, literal_column
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+DEFAULT_CHUNK_SIZE = 500
+
+async def bulk_upsert(
+    db: AsyncSession,
+    model,
+    rows: List[Dict],
+    conflict_column: Union[str, Sequence[str]],
+    update_columns: Sequence[str],
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+) -> Tuple[int, int]:
+    """
+    INSERT ... ON CONFLICT (conflict_column) DO UPDATE in chunks.
+    conflict_column may be a list for composite keys, e.g. ["user_id", "moodle_id"].
+
+    Existing rows are only touched when one of update_columns actually differs,
+    so updated_at keeps meaning "last changed" and unchanged rows cost nothing.
+    Returns (inserted, updated) counts.
+    """
+    keys = [conflict_column] if isinstance(conflict_column, str) else list(conflict_column)
+    # A single INSERT cannot touch the same conflict key twice - last row wins
+    deduped = list({tuple(row[k] for k in keys): row for row in rows}.values())
+
+    table = model.__table__
+    inserted = updated = 0
+    for start in range(0, len(deduped), chunk_size):
+        chunk = deduped[start:start + chunk_size]
+        stmt = pg_insert(table).values(chunk)
+        changed = tuple_(*[table.c[col] for col in update_columns]).is_distinct_from(
+            tuple_(*[stmt.excluded[col] for col in update_columns])
+        )
+        set_ = {col: stmt.excluded[col] for col in update_columns}
+        if "updated_at" in table.c:
+            set_["updated_at"] = datetime.utcnow()
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c[k] for k in keys],
+            set_=set_,
+            where=changed,
+        ).returning(literal_column("(xmax = 0)").label("inserted"))
+
+        result = await db.execute(stmt)
+        for (was_inserted,) in result.all():
+            if was_inserted:
+                inserted += 1
+            else:
+                updated += 1
+    return inserted, updated
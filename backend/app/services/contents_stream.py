@@ -0,0 +1,131 @@
+"""
+Incremental parser for core_course_get_contents responses.
+
+Big courses return multi-megabyte payloads (section summaries, module HTML,
+recordings metadata). Instead of materializing the whole document, the response
+body is fed through ijson and only the file entries are kept, one flat record
+at a time.
+"""
+import ijson
+from ijson.common import ObjectBuilder
+from typing import AsyncIterator, Dict
+
+SECTION = "item"
+SECTION_NAME = "item.name"
+MODULE = "item.modules.item"
+# visible=0: hidden by the teacher for everyone, the files are listed but cannot
+# be downloaded. Moodle serializes it before a section's modules and a module's
+# contents. uservisible is deliberately ignored: it depends on the token's user,
+# while the resources rows and the course content hash are shared by all users.
+SECTION_VISIBILITY = "item.visible"
+MODULE_VISIBILITY = "item.modules.item.visible"
+MODULE_FIELDS = {"item.modules.item.id": "module_id", "item.modules.item.name": "module_name", "item.modules.item.modname": "modname"}
+CONTENT = "item.modules.item.contents.item"
+DEFAULT_SECTION = "General"
+
+class MoodleAPIError(Exception):
+    """Moodle answered with an exception payload (invalid token, no access, ...) instead of data"""
+    pass
+
+class AsyncByteReader:
+    """Minimal async file object over an async byte iterator, as ijson's async API expects"""
+
+    def __init__(self, chunks):
+        self._chunks = chunks.__aiter__()
+        self._buffer = b""
+
+    async def read(self, size: int = -1) -> bytes:
+        while size < 0 or len(self._buffer) < size:
+            try:
+                self._buffer += await self._chunks.__anext__()
+            except StopAsyncIteration:
+                break
+        if size < 0:
+            data, self._buffer = self._buffer, b""
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    async def aclose(self):
+        """Release the underlying stream (and its HTTP connection) if parsing stops early"""
+        close = getattr(self._chunks, "aclose", None)
+        if close is not None:
+            await close()
+
+def _record(section: str, module: dict, content: dict) -> Dict:
+    return {"section": section, **module, **content}
+
+async def iter_file_records(chunks) -> AsyncIterator[Dict]:
+    """
+    Yield one flat record per file in a core_course_get_contents body:
+    {"section", "module_id", "module_name", "modname", <content fields>}.
+
+    Files of hidden sections and modules are left out, so they are reconciled
+    like files removed from Moodle. Raises MoodleAPIError when Moodle returns
+    an error payload.
+    Only the file entry currently being parsed (and, rarely, files of a section
+    whose name comes after its modules) is held in memory.
+    """
+    section_name = None
+    pending = []  # (module, content) seen before the section's name
+    module = {}
+    section_hidden = module_hidden = False
+    builder = None
+    error = None
+
+    reader = AsyncByteReader(chunks)
+    try:
+        async for prefix, event, value in ijson.parse_async(reader, use_float=True):
+            if error is not None:
+                error.event(event, value)
+                continue
+            if builder is not None:
+                builder.event(event, value)
+                if prefix == CONTENT and event == "end_map":
+                    content, builder = builder.value, None
+                    if content.get("type") != "file" or not content.get("fileurl"):
+                        continue
+                    if section_hidden or module_hidden:
+                        continue
+                    if section_name is None:
+                        pending.append((dict(module), content))
+                    else:
+                        yield _record(section_name, module, content)
+                continue
+
+            if prefix == "" and event == "start_map":
+                # Moodle error payload instead of the sections list
+                error = ObjectBuilder()
+                error.event(event, value)
+            elif prefix == CONTENT and event == "start_map":
+                builder = ObjectBuilder()
+                builder.event(event, value)
+            elif prefix in MODULE_FIELDS:
+                module[MODULE_FIELDS[prefix]] = value
+            elif prefix == MODULE_VISIBILITY:
+                module_hidden = module_hidden or not value
+            elif prefix == SECTION_VISIBILITY:
+                section_hidden = section_hidden or not value
+            elif prefix == MODULE and event == "start_map":
+                module = {}
+                module_hidden = False
+            elif prefix == SECTION_NAME and event == "string":
+                section_name = value
+                for pending_module, content in pending:
+                    yield _record(section_name, pending_module, content)
+                pending = []
+            elif prefix == SECTION and event == "start_map":
+                section_name = None
+                section_hidden = False
+            elif prefix == SECTION and event == "end_map":
+                for pending_module, content in pending:
+                    yield _record(DEFAULT_SECTION, pending_module, content)
+                pending = []
+    finally:
+        await reader.aclose()
+
+    if error is not None:
+        # Not an empty course: callers must not treat its files as removed
+        payload = error.value or {}
+        print(f"[MOODLE API ERROR] core_course_get_contents: {payload.get('message', payload)}")
+        raise MoodleAPIError(payload.get('message', 'Unknown Moodle API error'))
@@ -0,0 +1,396 @@
+"""
+Course archives: the ZIP members for a set of files, and a disk cache of
+prebuilt per-course archives.
+
+A cached archive is keyed by (course, flat/organized, fingerprint of the
+course's live resource set), so any sync that adds, changes or removes a file
+makes the next request build a fresh one. Concurrent requests for the same
+archive share a single build, and all of them stream it while it is written.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import tempfile
+import time
+from datetime import datetime
+from typing import AsyncIterator, Callable, Dict, List, NamedTuple, Optional, Set, Tuple
+import anyio
+from sqlalchemy import select
+from app.config import settings
+from app.database import AsyncSessionLocal
+from app.models.course import UserCourse
+from app.models.job import Job
+from app.models.resource import Resource
+from app.models.user import MoodleUser
+from app.services import job_queue
+from app.services.downloads import (
+    DownloadItem, DownloadProgress, GrowingFile, get_download_engine, read_chunks, start_progress
+)
+from app.services.file_mirror import MirrorKey
+from app.services.job_queue import job_handler
+from app.services.zip_stream import ZipMember, compress_type_for, stream_zip
+
+FAILED_MANIFEST = "_FAILED_DOWNLOADS.txt"
+
+class ArchiveFile(NamedTuple):
+    """One file of an archive, as plain values: the DB session is closed before the body is streamed"""
+    arcname: str
+    file_url: str
+    filesize: Optional[int]
+    mimetype: Optional[str]
+    modified: Optional[datetime]  # Entry timestamp
+    time_modified: Optional[datetime]  # Moodle's timemodified, for the mirror
+
+def archive_name(resource: Resource, flat: bool) -> str:
+    if flat:
+        return resource.filename
+    # Organized mode: files in section folders
+    section_name = resource.section if resource.section else "General"
+    section_name = "".join([c for c in section_name if c.isalnum() or c in (' ', '-', '_')]).strip()
+    return f"{section_name}/{resource.filename}" if section_name else resource.filename
+
+def archive_files(resources: List[Resource], flat: bool) -> List[ArchiveFile]:
+    """Archive entries in a stable order, so the same resource set always yields the same archive"""
+    ordered = sorted(resources, key=lambda r: (archive_name(r, flat), r.id))
+    return [
+        ArchiveFile(archive_name(r, flat), r.file_url, r.filesize, r.mimetype, r.time_created, r.time_modified)
+        for r in ordered
+    ]
+
+def unique_name(arcname: str, seen: dict) -> str:
+    """Suffix repeated archive names: notes.pdf, notes_1.pdf, ..."""
+    if arcname not in seen:
+        seen[arcname] = 0
+        return arcname
+    seen[arcname] += 1
+    name, ext = os.path.splitext(arcname)
+    return f"{name}_{seen[arcname]}{ext}"
+
+async def _single_chunk(data: bytes):
+    yield data
+
+async def zip_members(files: List[ArchiveFile], token: str, progress: DownloadProgress):
+    """
+    Download the files through the shared engine (a few ahead of the archive,
+    up-to-date copies straight from the local mirror) and hand each one to the
+    ZIP writer as it completes. Files that failed
+    after retries are listed in a manifest at the end of the archive.
+    """
+    engine = get_download_engine()
+    seen = {}
+    items = [
+        DownloadItem(f"{f.file_url}&token={token}", f.arcname, MirrorKey(f.file_url, f.filesize, f.time_modified))
+        for f in files
+    ]
+    try:
+        async for index, spool, size, error in engine.iter_downloads(items, settings.download_zip_window):
+            file = files[index]
+            if error is not None:
+                progress.file_failed(file.arcname, error)
+                continue
+            yield ZipMember(
+                arcname=unique_name(file.arcname, seen),
+                chunks=read_chunks(spool),
+                size=size,
+                compress_type=compress_type_for(file.arcname, file.mimetype),
+                modified=file.modified,
+            )
+            progress.file_done(size)
+
+        if progress.failed:
+            lines = [f"{len(progress.failed)} of {len(files)} files could not be downloaded from Moodle:", ""]
+            lines += [f"{entry['filename']}\t{entry['error']}" for entry in progress.failed]
+            yield ZipMember(arcname=FAILED_MANIFEST, chunks=_single_chunk(("\n".join(lines) + "\n").encode()))
+        progress.finish("done")
+    except (asyncio.CancelledError, GeneratorExit):
+        # Client went away: stop downloading instead of finishing the archive for nobody
+        print(f"[DOWNLOAD] ZIP {progress.id} cancelled after {progress.files_done}/{progress.files_total} files")
+        progress.finish("cancelled")
+        raise
+    except Exception:
+        progress.finish("failed")
+        raise
+
+def start_zip(files: List[ArchiveFile], token: str, download_id: Optional[str] = None,
+              owner: Optional[int] = None) -> Tuple[AsyncIterator[bytes], DownloadProgress]:
+    """The archive's bytes (streamed as the files download) and the progress entry user `owner` polls"""
+    progress = start_progress(download_id, len(files), sum(f.filesize or 0 for f in files), owner)
+    return stream_zip(zip_members(files, token, progress)), progress
+
+class ZipCacheKey(NamedTuple):
+    course_id: int
+    flat: bool
+    fingerprint: str
+
+    @property
+    def prefix(self) -> str:
+        # Shared by every version of this course's archive in one mode
+        return f"{self.course_id}-{'flat' if self.flat else 'sections'}-"
+
+    @property
+    def name(self) -> str:
+        return f"{self.prefix}{self.fingerprint}"
+
+    @property
+    def etag(self) -> str:
+        return f'"{self.name}"'
+
+def resource_set_fingerprint(files: List[ArchiveFile]) -> str:
+    """Hash of everything that ends up in the archive: names, file versions and entry timestamps"""
+    rows = [
+        [f.arcname, f.file_url, f.filesize,
+         f.time_modified.isoformat() if f.time_modified else None,
+         f.modified.isoformat() if f.modified else None]
+        for f in files
+    ]
+    return hashlib.sha256(json.dumps(rows).encode()).hexdigest()[:32]
+
+async def load_course_archive(db, course_id: int, flat: bool) -> Tuple[List[ArchiveFile], ZipCacheKey]:
+    """A course's live files as archive entries, and the cache key of that archive"""
+    result = await db.execute(select(Resource).where(Resource.course_id == course_id, Resource.deleted_at.is_(None)))
+    files = archive_files(result.scalars().all(), flat)
+    return files, ZipCacheKey(course_id, flat, resource_set_fingerprint(files))
+
+class CachedZip(NamedTuple):
+    file: Optional[object]  # Open for reading on a cache hit
+    size: Optional[int]
+    chunks: Optional[AsyncIterator[bytes]]  # On a miss: the archive's bytes as the build writes them
+    progress: Optional[DownloadProgress]  # None on a cache hit
+
+def _append(out, chunk: bytes):
+    out.write(chunk)
+    # Readers follow the file through their own descriptors
+    out.flush()
+
+class _ZipBuild(GrowingFile):
+    """An archive being written to the cache; readers follow the file as it grows"""
+
+    def __init__(self, part: str, progress: DownloadProgress):
+        super().__init__(part)
+        self.part = part
+        self.progress = progress
+
+class ZipCache:
+    """
+    Prebuilt course archives on disk, least recently served evicted first once
+    the directory exceeds its byte budget. Older versions of a course's
+    archive are deleted as soon as a newer one is built.
+    """
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._tmp = os.path.join(root, "tmp")
+        os.makedirs(self._tmp, exist_ok=True)
+        self._builds: Dict[str, _ZipBuild] = {}
+
+    def _path(self, key: ZipCacheKey, complete: bool = True) -> str:
+        return os.path.join(self.root, key.name + (".zip" if complete else ".incomplete.zip"))
+
+    def has(self, key: ZipCacheKey) -> bool:
+        return os.path.exists(self._path(key))
+
+    def _open(self, path: str) -> Tuple[object, int]:
+        file = open(path, "rb")
+        os.utime(path)  # Recently served
+        return file, os.fstat(file.fileno()).st_size
+
+    async def get_or_build(self, key: ZipCacheKey, build: Callable[[], Tuple[AsyncIterator[bytes], DownloadProgress]]) -> CachedZip:
+        """
+        The cached archive for key or, on a miss, its bytes streamed while
+        build() writes them to the cache. A request arriving while the same
+        archive is being built follows that build from the first byte; its
+        progress is the shared build's.
+        """
+        try:
+            file, size = await anyio.to_thread.run_sync(self._open, self._path(key))
+            return CachedZip(file, size, None, None)
+        except FileNotFoundError:
+            pass
+        running = self._start(key, build)
+        return CachedZip(None, None, running.follow(), running.progress)
+
+    async def ensure(self, key: ZipCacheKey, build: Callable[[], Tuple[AsyncIterator[bytes], DownloadProgress]]):
+        """Build the archive for key unless it is cached, without reading it"""
+        if self.has(key):
+            return
+        # Shielded: the build keeps going for the others (and the cache) if this caller gives up
+        await asyncio.shield(self._start(key, build).task)
+
+    def _start(self, key: ZipCacheKey, build: Callable[[], Tuple[AsyncIterator[bytes], DownloadProgress]]) -> _ZipBuild:
+        running = self._builds.get(key.name)
+        if running is not None:
+            return running
+        chunks, progress = build()
+        fd, part = tempfile.mkstemp(dir=self._tmp, suffix=".part")
+        running = _ZipBuild(part, progress)
+        # Runs on its own: clients that go away do not stop the build for the cache
+        running.start(self._build(key, running, chunks, os.fdopen(fd, "wb")))
+        running.task.add_done_callback(lambda t: self._build_done(key, running, t))
+        self._builds[key.name] = running
+        return running
+
+    def _build_done(self, key: ZipCacheKey, running: _ZipBuild, task: asyncio.Task):
+        self._builds.pop(key.name, None)
+        if task.cancelled() or task.exception() is not None:
+            # Also when cancelled before it started writing
+            try:
+                os.remove(running.part)
+            except FileNotFoundError:
+                pass
+        if not task.cancelled() and task.exception() is not None:
+            print(f"[ZIP CACHE ERROR] Building {key.name}: {type(task.exception()).__name__}: {task.exception()}")
+
+    async def _build(self, key: ZipCacheKey, running: _ZipBuild, chunks: AsyncIterator[bytes], out) -> str:
+        started = time.monotonic()
+        progress = running.progress
+        with out:
+            async for chunk in chunks:
+                await anyio.to_thread.run_sync(_append, out, chunk)
+                running.grew(running.written + len(chunk))
+        path = self._path(key, complete=not progress.failed)
+        os.replace(running.part, path)
+
+        self._drop_older_versions(key, path)
+        self.evict(keep=path)
+        print(
+            f"[ZIP CACHE] Built {key.name} ({progress.files_total} files, {running.written / 1024 ** 2:.1f} MiB) "
+            f"in {time.monotonic() - started:.1f}s" + (f", {len(progress.failed)} failed" if progress.failed else "")
+        )
+        return path
+
+    def _drop_older_versions(self, key: ZipCacheKey, keep: str):
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if name.startswith(key.prefix) and path != keep:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def _archives(self) -> List[Tuple[str, os.stat_result]]:
+        archives = []
+        for name in os.listdir(self.root):
+            if name.endswith(".zip"):
+                try:
+                    archives.append((os.path.join(self.root, name), os.stat(os.path.join(self.root, name))))
+                except FileNotFoundError:
+                    pass
+        return archives
+
+    def evict(self, keep: Optional[str] = None) -> int:
+        """Delete least recently served archives until the cache fits the byte budget"""
+        archives = sorted(self._archives(), key=lambda a: a[1].st_mtime)
+        total = sum(stat.st_size for _, stat in archives)
+        evicted = 0
+        for path, stat in archives:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= stat.st_size
+            evicted += 1
+        if evicted:
+            print(f"[ZIP CACHE] Evicted {evicted} archives, {total / 1024 ** 2:.0f} MiB of {self.max_bytes / 1024 ** 2:.0f} MiB used")
+        return evicted
+
+    def status(self) -> dict:
+        archives = self._archives()
+        return {
+            "archives": len(archives),
+            "bytes": sum(stat.st_size for _, stat in archives),
+            "max_bytes": self.max_bytes,
+            "building": len(self._builds),
+        }
+
+_cache: Optional[ZipCache] = None
+_cache_failed = False
+
+def get_zip_cache() -> Optional[ZipCache]:
+    """The process's archive cache, or None when disabled or its directory is unusable"""
+    global _cache, _cache_failed
+    if not settings.zip_cache_enabled or _cache_failed:
+        return None
+    if _cache is None:
+        try:
+            _cache = ZipCache(settings.zip_cache_dir, settings.zip_cache_max_bytes)
+        except OSError as e:
+            print(f"[ZIP CACHE] Disabled, cannot use {settings.zip_cache_dir}: {e}")
+            _cache_failed = True
+            return None
+    return _cache
+
+async def prebuild_course_zips(user_id: int) -> dict:
+    """
+    Build the organized archive of each of a user's courses that is not
+    cached yet, one course at a time. Courses shared with other users are
+    skipped once any of their syncs has built the current version.
+    """
+    cache = get_zip_cache()
+    if cache is None:
+        return {"built": 0, "cached": 0}
+    async with AsyncSessionLocal() as db:
+        user = await db.get(MoodleUser, user_id)
+        if user is None:
+            return {"built": 0, "cached": 0}
+        token = user.token
+        course_ids = (await db.execute(select(UserCourse.course_id).where(UserCourse.user_id == user_id))).scalars().all()
+        archives = [await load_course_archive(db, course_id, flat=False) for course_id in course_ids]
+
+    counts = {"built": 0, "cached": 0}
+    for files, key in archives:
+        if not files:
+            continue
+        if cache.has(key):
+            counts["cached"] += 1
+            continue
+        await cache.ensure(key, lambda: start_zip(files, token))
+        counts["built"] += 1
+    if counts["built"]:
+        print(f"[ZIP CACHE] Prebuilt {counts['built']} course archives for user {user_id} ({counts['cached']} already cached)")
+    return counts
+
+_prebuilds: Dict[int, asyncio.Task] = {}
+_rerun: Set[int] = set()
+
+async def _prebuild_loop(user_id: int):
+    try:
+        while True:
+            _rerun.discard(user_id)
+            try:
+                await prebuild_course_zips(user_id)
+            except Exception as e:
+                print(f"[ZIP CACHE ERROR] Prebuild for user {user_id}: {type(e).__name__}: {e}")
+            if user_id not in _rerun:
+                return
+    finally:
+        _prebuilds.pop(user_id, None)
+
+async def request_zip_prebuild(user_id: int):
+    """
+    Ask for a user's course archives to be prebuilt after their sync. With the
+    job queue it becomes a job; otherwise it runs (or re-runs once the
+    current pass finishes) as a task in this process.
+    """
+    if not settings.zip_prebuild_enabled or get_zip_cache() is None:
+        return
+    if settings.job_queue_enabled:
+        await job_queue.enqueue("zip_prebuild", {"user_id": user_id}, dedupe_key=f"zip_prebuild:{user_id}")
+        return
+    if user_id in _prebuilds:
+        _rerun.add(user_id)
+        return
+    _prebuilds[user_id] = asyncio.create_task(_prebuild_loop(user_id))
+
+async def stop_zip_prebuilds():
+    for task in list(_prebuilds.values()):
+        task.cancel()
+
+@job_handler("zip_prebuild")
+async def run_zip_prebuild_job(job: Job, report):
+    return await prebuild_course_zips((job.payload or {})["user_id"])
@@ -0,0 +1,39 @@
+"""
+Signed links to the single-file download proxy.
+
+The proxy fetches with the token of the user in the link, so a link is only
+honoured with an HMAC over (resource, user, expiry) that the listings
+endpoints issued. Expiry times are rounded to whole download_url_ttl
+windows: listings rendered within one window carry identical links (and so
+identical cached bodies and ETags), and each stays valid for at least one
+full window.
+"""
+import hashlib
+import hmac
+import time
+from typing import Optional, Tuple
+from app.config import settings
+
+def _secret() -> bytes:
+    if settings.download_url_secret:
+        return settings.download_url_secret.encode()
+    # Same in every API process without extra configuration, and not guessable without the DB password
+    return hashlib.sha256(f"download-links|{settings.database_url}".encode()).digest()
+
+def _signature(resource_id: int, user_id: int, expires: int) -> str:
+    message = f"{resource_id}:{user_id}:{expires}".encode()
+    return hmac.new(_secret(), message, hashlib.sha256).hexdigest()[:32]
+
+def sign_download(resource_id: int, user_id: int, now: Optional[float] = None) -> Tuple[int, str]:
+    """(expires, sig) query parameters for a download link"""
+    ttl = settings.download_url_ttl
+    expires = (int(now if now is not None else time.time()) // ttl + 2) * ttl
+    return expires, _signature(resource_id, user_id, expires)
+
+def verify_download(resource_id: int, user_id: int, expires: Optional[int], sig: Optional[str],
+                    now: Optional[float] = None) -> bool:
+    if expires is None or not sig:
+        return False
+    if expires < (now if now is not None else time.time()):
+        return False
+    return hmac.compare_digest(sig, _signature(resource_id, user_id, expires))
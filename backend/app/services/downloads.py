@@ -0,0 +1,392 @@
+import asyncio
+import os
+import tempfile
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, NamedTuple, Optional, Tuple
+from urllib.parse import urlsplit
+import anyio
+import httpx
+from app.config import settings
+from app.services.file_mirror import MirrorKey, get_file_mirror
+from app.services.http_client import get_http_client
+from app.services.moodle_client import RETRYABLE_STATUS
+from app.services.rate_limiter import backoff_delay
+
+# Keep this many finished downloads around so a client can read the final state
+MAX_FINISHED_DOWNLOADS = 20
+
+class DownloadFailed(Exception):
+    """A file could not be downloaded, after retries where they make sense"""
+    pass
+
+class DownloadItem(NamedTuple):
+    url: str  # With token
+    label: str  # For logs and error reports
+    key: Optional[MirrorKey] = None  # Set to serve/fill the local mirror
+
+class Download(NamedTuple):
+    """A file for one client: already on disk, or arriving from Moodle"""
+    file: Optional[object]  # Open for reading when the mirror holds the file
+    size: Optional[int]
+    chunks: Optional[AsyncIterator[bytes]]  # Otherwise its bytes as they are downloaded
+
+class DownloadEngine:
+    """Process-wide file downloader with per-host concurrency limits, retries and chunked transfer"""
+
+    def __init__(self):
+        self._hosts: Dict[str, asyncio.Semaphore] = {}
+        # Mirror downloads in flight, so concurrent requests for a file share one fetch
+        self._inflight: Dict[MirrorKey, asyncio.Task] = {}
+
+    def _host_slot(self, url: str) -> asyncio.Semaphore:
+        host = urlsplit(url).netloc
+        if host not in self._hosts:
+            self._hosts[host] = asyncio.Semaphore(settings.download_host_concurrency)
+        return self._hosts[host]
+
+    async def fetch(self, url: str, sink, label: Optional[str] = None,
+                    throttle: Optional[Callable[[int], Awaitable]] = None,
+                    follow: Optional["GrowingFile"] = None) -> int:
+        """
+        Download url into a seekable file object, chunk by chunk. The sink is
+        reset before each retry. Returns the number of bytes written, raises
+        DownloadFailed. label is used in logs instead of the (tokenized) URL;
+        throttle(n) is awaited after every chunk, e.g. for a bandwidth cap.
+        With follow, the sink is flushed after every chunk and follow's
+        readers are told how far it got.
+        """
+        client = get_http_client()
+        label = label or urlsplit(url).path
+        for attempt in range(settings.download_max_retries + 1):
+            retry_after = None
+            sink.seek(0)
+            sink.truncate()
+            if follow is not None:
+                follow.grew(0)
+            try:
+                async with self._host_slot(url):
+                    async with client.stream("GET", url, follow_redirects=True, timeout=settings.download_timeout) as resp:
+                        if resp.status_code == 200:
+                            written = 0
+                            async for chunk in resp.aiter_bytes(settings.download_chunk_size):
+                                sink.write(chunk)
+                                written += len(chunk)
+                                if follow is not None:
+                                    sink.flush()
+                                    follow.grew(written)
+                                if throttle is not None:
+                                    await throttle(len(chunk))
+                            return written
+                        if resp.status_code not in RETRYABLE_STATUS:
+                            # 403, 404, ... will not get better
+                            raise DownloadFailed(f"HTTP {resp.status_code}")
+                        if resp.headers.get("retry-after", "").isdigit():
+                            retry_after = float(resp.headers["retry-after"])
+                        error = f"HTTP {resp.status_code}"
+            except httpx.TransportError as e:
+                # Timeouts, resets, also midway through the body
+                error = f"{type(e).__name__}: {e}"
+
+            if attempt == settings.download_max_retries:
+                break
+            delay = backoff_delay(attempt, retry_after)
+            print(f"[DOWNLOAD RETRY] {label} attempt {attempt + 1} failed ({error}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+        raise DownloadFailed(error)
+
+    async def _open(self, item: DownloadItem, mirrored: Optional[Tuple[str, int]]):
+        """(file, size) for an item: the mirrored copy, a fresh download into the mirror or a spool"""
+        mirror = get_file_mirror() if item.key is not None else None
+        if mirror is not None:
+            if mirrored is not None:
+                blob = await anyio.to_thread.run_sync(mirror.open_blob, mirrored[0])
+                if blob is not None:
+                    return blob, mirrored[1]
+            return await self._mirror_download(mirror, item)
+
+        spool = tempfile.SpooledTemporaryFile(max_size=settings.download_spool_memory_bytes)
+        try:
+            size = await self.fetch(item.url, spool, item.label)
+        except BaseException:
+            spool.close()
+            raise
+        spool.seek(0)
+        return spool, size
+
+    async def _fetch_into_mirror(self, mirror, item: DownloadItem, part, transfer: "GrowingFile") -> Tuple[str, int]:
+        stored = await mirror.download(self, item.url, item.key, item.label, part=part, follow=transfer)
+        stored.file.close()
+        return stored.sha256, stored.size
+
+    def _mirrored(self, key: MirrorKey, task: asyncio.Task):
+        self._inflight.pop(key, None)
+        if not task.cancelled() and task.exception() is not None:
+            task.exception()  # Reported to the waiters; nobody may be left to retrieve it
+
+    def _transfer(self, mirror, item: DownloadItem) -> "GrowingFile":
+        """
+        The item's download into the mirror, started unless one is running:
+        concurrent requests for the same file version share one upstream
+        fetch, which finishes (for the mirror) even if they all give up.
+        """
+        transfer = self._inflight.get(item.key)
+        if transfer is None:
+            part = mirror.new_part()
+            transfer = GrowingFile(part.path)
+            transfer.start(self._fetch_into_mirror(mirror, item, part, transfer))
+            transfer.task.add_done_callback(lambda t: self._mirrored(item.key, t))
+            self._inflight[item.key] = transfer
+        return transfer
+
+    async def _mirror_download(self, mirror, item: DownloadItem):
+        """Download an item into the mirror (or wait for its running download) and open the stored copy"""
+        sha256, size = await asyncio.shield(self._transfer(mirror, item).task)
+        blob = await anyio.to_thread.run_sync(mirror.open_blob, sha256)
+        if blob is not None:
+            return blob, size
+        # Evicted right after the shared fetch (a budget smaller than a few files)
+        stored = await mirror.download(self, item.url, item.key, item.label)
+        return stored.file, stored.size
+
+    async def _fetch_unmirrored(self, item: DownloadItem, sink, transfer: "GrowingFile") -> int:
+        with sink:
+            return await self.fetch(item.url, sink, item.label, follow=transfer)
+
+    async def open(self, item: DownloadItem):
+        """Download one file (or take it from the mirror); returns (file, size), raises DownloadFailed"""
+        mirror = get_file_mirror() if item.key is not None else None
+        mirrored = (await mirror.lookup([item.key])).get(item.key.file_url) if mirror is not None else None
+        return await self._open(item, mirrored)
+
+    async def stream(self, item: DownloadItem) -> Download:
+        """
+        One file for a client. The mirrored copy when it is up to date;
+        otherwise Moodle's bytes are passed on as they arrive while the same
+        download fills the mirror (shared with concurrent requests for the
+        file), or a temp file when there is no mirror. Returns once the first
+        bytes are in, so a file Moodle refuses still raises DownloadFailed.
+        """
+        mirror = get_file_mirror() if item.key is not None else None
+        if mirror is not None:
+            mirrored = (await mirror.lookup([item.key])).get(item.key.file_url)
+            if mirrored is not None:
+                blob = await anyio.to_thread.run_sync(mirror.open_blob, mirrored[0])
+                if blob is not None:
+                    return Download(blob, mirrored[1], None)
+            transfer = self._transfer(mirror, item)
+        else:
+            fd, path = tempfile.mkstemp(suffix=".part")
+            try:
+                transfer = GrowingFile(path, abandon=True)
+            finally:
+                # Only the open descriptors are needed
+                os.remove(path)
+            transfer.start(self._fetch_unmirrored(item, os.fdopen(fd, "wb"), transfer))
+        try:
+            await transfer.ready()
+        except BaseException:
+            if transfer.abandon:
+                transfer.task.cancel()
+            raise
+        return Download(None, None, transfer.follow())
+
+    async def _fetch_item(self, index: int, item: DownloadItem, mirrored):
+        try:
+            file, size = await self._open(item, mirrored)
+        except DownloadFailed as e:
+            print(f"[DOWNLOAD ERROR] {item.label}: {e}")
+            return index, None, 0, str(e)
+        return index, file, size, None
+
+    async def iter_downloads(self, items: List[DownloadItem], window: int) -> AsyncIterator[Tuple[int, Optional[object], int, Optional[str]]]:
+        """
+        Fetch items, at most `window` ahead of the caller, and yield
+        (index, file, size, error) in completion order. Files with an up-to-date
+        copy in the mirror are read from disk. The file is closed once the
+        caller moves on; error is set and the file None for a failed download.
+        Leaving early cancels the downloads still running.
+        """
+        mirror = get_file_mirror()
+        keys = [item.key for item in items if item.key is not None]
+        mirrored = await mirror.lookup(keys) if mirror is not None and keys else {}
+        hits = sum(1 for key in keys if key.file_url in mirrored)
+        if hits:
+            print(f"[DOWNLOAD] {hits}/{len(items)} files served from the local mirror")
+
+        remaining = iter(enumerate(items))
+        pending = set()
+
+        def start_next():
+            for index, item in remaining:
+                hit = mirrored.get(item.key.file_url) if item.key is not None else None
+                pending.add(asyncio.create_task(self._fetch_item(index, item, hit)))
+                return
+
+        try:
+            for _ in range(max(1, window)):
+                start_next()
+            while pending:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    pending.discard(task)
+                    index, file, size, error = task.result()
+                    try:
+                        yield index, file, size, error
+                    finally:
+                        if file is not None:
+                            file.close()
+                    start_next()
+        finally:
+            for task in pending:
+                if task.done() and not task.cancelled() and task.exception() is None:
+                    # Finished but never handed out
+                    file = task.result()[1]
+                    if file is not None:
+                        file.close()
+                else:
+                    task.cancel()
+
+async def read_chunks(file) -> AsyncIterator[bytes]:
+    """
+    A downloaded (or cached) file as chunks, for streaming responses and ZIP
+    entries. Reads run in a worker thread so they do not block the event loop.
+    """
+    while True:
+        chunk = await anyio.to_thread.run_sync(file.read, settings.download_chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+class GrowingFile:
+    """
+    A file written by one task and streamed to any number of readers while it
+    grows, each from the first byte. Readers share a descriptor opened up
+    front, so the writer may rename or delete the file meanwhile.
+    """
+
+    def __init__(self, path: str, abandon: bool = False):
+        self._fd = os.open(path, os.O_RDONLY)
+        self.abandon = abandon  # Cancel the writer when its reader leaves (a single-reader download)
+        self.written = 0  # Bytes flushed to the file
+        self.task: Optional[asyncio.Task] = None
+        self._grown = asyncio.Event()
+
+    def __del__(self):
+        # Once the writer and every reader are done with it
+        if getattr(self, "_fd", None) is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def start(self, writer: Awaitable) -> asyncio.Task:
+        self.task = asyncio.create_task(writer)
+        self.task.add_done_callback(lambda t: self.grew(self.written))
+        return self.task
+
+    def grew(self, written: int):
+        """Called by the writer after flushing; a smaller value means it started over"""
+        self.written = written
+        self._grown.set()
+        self._grown = asyncio.Event()
+
+    def _check(self):
+        if self.task.cancelled():
+            raise DownloadFailed("Abandoned before it was complete")
+        self.task.result()  # The writer's error, if any
+
+    async def ready(self):
+        """Wait for the first bytes (or the end); raises if the writer failed first"""
+        while self.written == 0 and not self.task.done():
+            await self._grown.wait()
+        if self.task.done():
+            self._check()
+
+    async def follow(self) -> AsyncIterator[bytes]:
+        """The file's bytes as they are written; raises the writer's error"""
+        offset = 0
+        try:
+            while True:
+                if offset < self.written:
+                    length = min(settings.download_chunk_size, self.written - offset)
+                    chunk = await anyio.to_thread.run_sync(os.pread, self._fd, length, offset)
+                    offset += len(chunk)
+                    yield chunk
+                elif self.task.done():
+                    self._check()
+                    return
+                else:
+                    await self._grown.wait()
+        finally:
+            if self.abandon and not self.task.done():
+                self.task.cancel()
+
+_engine: Optional[DownloadEngine] = None
+
+def get_download_engine() -> DownloadEngine:
+    global _engine
+    if _engine is None:
+        _engine = DownloadEngine()
+    return _engine
+
+class DownloadProgress:
+    """Progress of one ZIP build, polled by the client while the archive streams"""
+
+    def __init__(self, download_id: str, files_total: int, bytes_total: int):
+        self.id = download_id
+        self.status = "running"
+        self.files_total = files_total
+        self.files_done = 0
+        self.bytes_total = bytes_total
+        self.bytes_done = 0
+        self.failed: List[dict] = []
+        self.started_at = datetime.utcnow()
+        self.finished_at: Optional[datetime] = None
+
+    def file_done(self, size: int):
+        self.files_done += 1
+        self.bytes_done += size
+
+    def file_failed(self, filename: str, error: str):
+        self.files_done += 1
+        self.failed.append({"filename": filename, "error": error})
+
+    def finish(self, status: str):
+        self.status = status
+        self.finished_at = datetime.utcnow()
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "status": self.status,
+            "files_total": self.files_total,
+            "files_done": self.files_done,
+            "files_failed": len(self.failed),
+            "bytes_total": self.bytes_total,
+            "bytes_done": self.bytes_done,
+            "failed": self.failed,
+            "started_at": self.started_at.isoformat(),
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+        }
+
+# (owner, download_id) -> progress. Ids come from clients, so they only name a
+# download within one user's entries
+_progress: "OrderedDict[Tuple[Optional[int], str], DownloadProgress]" = OrderedDict()
+
+def start_progress(download_id: Optional[str], files_total: int, bytes_total: int,
+                   owner: Optional[int] = None) -> DownloadProgress:
+    """Register a ZIP build of user `owner`; the client may pick the id up front to poll while downloading"""
+    progress = DownloadProgress(download_id or uuid.uuid4().hex, files_total, bytes_total)
+    _progress[(owner, progress.id)] = progress
+    finished = [key for key, entry in _progress.items() if entry.finished_at is not None]
+    for key in finished[:-MAX_FINISHED_DOWNLOADS]:
+        del _progress[key]
+    return progress
+
+def attach_progress(owner: Optional[int], download_id: str, progress: DownloadProgress):
+    """Let another client poll an already running build under its own id"""
+    _progress[(owner, download_id)] = progress
+
+def get_progress(owner: Optional[int], download_id: str) -> Optional[DownloadProgress]:
+    return _progress.get((owner, download_id))
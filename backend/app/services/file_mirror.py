@@ -0,0 +1,242 @@
+import hashlib
+import os
+import tempfile
+import time
+from datetime import datetime
+from typing import Dict, List, NamedTuple, Optional, Tuple
+from sqlalchemy import select, update, delete, func
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from app.config import settings
+from app.database import AsyncSessionLocal
+from app.models.mirror import MirrorBlob, MirrorEntry
+
+LOOKUP_CHUNK_SIZE = 1000
+# Recount the store from the index this often, for blobs other processes added
+RECOUNT_SECONDS = 300
+
+class MirrorKey(NamedTuple):
+    """Identity of one version of a Moodle file"""
+    file_url: str
+    filesize: Optional[int]
+    time_modified: Optional[datetime]
+
+    @property
+    def etag(self) -> str:
+        """Strong validator for HTTP: changes whenever Moodle reports a new version"""
+        version = f"{self.file_url}|{self.filesize}|{self.time_modified.isoformat() if self.time_modified else ''}"
+        return f'"{hashlib.sha256(version.encode()).hexdigest()[:32]}"'
+
+class StoredBlob(NamedTuple):
+    file: object  # Open for reading, valid even if the blob is evicted meanwhile
+    size: int
+    sha256: str
+
+class _HashingFile:
+    """Temp file that hashes what is written to it; reset by truncate() before a retry"""
+
+    def __init__(self, directory: str):
+        fd, self.path = tempfile.mkstemp(dir=directory, suffix=".part")
+        self._file = os.fdopen(fd, "wb")
+        self._hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data: bytes) -> int:
+        self._hash.update(data)
+        self.size += len(data)
+        return self._file.write(data)
+
+    def flush(self):
+        self._file.flush()
+
+    def seek(self, offset: int):
+        self._file.seek(offset)
+
+    def truncate(self):
+        # Only ever called at offset 0 (DownloadEngine.fetch starting over)
+        self._file.truncate()
+        self._hash = hashlib.sha256()
+        self.size = 0
+
+    def hexdigest(self) -> str:
+        return self._hash.hexdigest()
+
+    def close(self):
+        self._file.close()
+
+    def discard(self):
+        self.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+class FileMirror:
+    """
+    Local copy of Moodle files, so repeat downloads do not go over the uplink.
+
+    Blobs are stored once per content hash (the same handout posted in several
+    courses takes the space of one) and indexed by file_url together with the
+    filesize/timemodified Moodle reported, so a changed file is a miss. The
+    index lives in Postgres, shared by the API and the worker; the least
+    recently used blobs are evicted once the store exceeds its byte budget.
+    """
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._tmp = os.path.join(root, "tmp")
+        os.makedirs(self._tmp, exist_ok=True)
+        # Store size as of the last count plus what this process added since
+        self._stored_bytes = 0
+        self._counted_at: Optional[float] = None
+
+    def _blob_path(self, sha256: str) -> str:
+        return os.path.join(self.root, "blobs", sha256[:2], sha256)
+
+    def open_blob(self, sha256: str):
+        """Open a stored blob, or None if it was evicted in the meantime"""
+        try:
+            return open(self._blob_path(sha256), "rb")
+        except FileNotFoundError:
+            return None
+
+    async def lookup(self, keys: List[MirrorKey]) -> Dict[str, Tuple[str, int]]:
+        """file_url -> (sha256, size) for the keys with an up-to-date copy; marks them used"""
+        wanted = {key.file_url: key for key in keys}
+        urls = list(wanted)
+        fresh = {}
+        async with AsyncSessionLocal() as db:
+            for start in range(0, len(urls), LOOKUP_CHUNK_SIZE):
+                result = await db.execute(
+                    select(MirrorEntry.file_url, MirrorEntry.filesize, MirrorEntry.time_modified, MirrorBlob.sha256, MirrorBlob.size)
+                    .join(MirrorBlob, MirrorBlob.sha256 == MirrorEntry.sha256)
+                    .where(MirrorEntry.file_url.in_(urls[start:start + LOOKUP_CHUNK_SIZE]))
+                )
+                for row in result.all():
+                    key = wanted[row.file_url]
+                    if (row.filesize, row.time_modified) == (key.filesize, key.time_modified):
+                        fresh[row.file_url] = (row.sha256, row.size)
+            if fresh:
+                await db.execute(
+                    update(MirrorBlob)
+                    .where(MirrorBlob.sha256.in_({sha256 for sha256, _ in fresh.values()}))
+                    .values(last_accessed_at=datetime.utcnow())
+                )
+                await db.commit()
+        return fresh
+
+    def new_part(self) -> _HashingFile:
+        """Temp file for a download into the mirror, for readers that follow it (see download)"""
+        return _HashingFile(self._tmp)
+
+    async def download(self, engine, url: str, key: MirrorKey, label: str, throttle=None, part=None,
+                       follow=None) -> StoredBlob:
+        """
+        Fetch a file through the download engine into the mirror and return
+        the stored blob, already open. Raises DownloadFailed. part is a
+        new_part() to write to, follow is handed on to the engine's fetch; the
+        index entry is only committed once the file is complete.
+        """
+        part = part or self.new_part()
+        try:
+            await engine.fetch(url, part, label, throttle, follow)
+            part.close()
+            sha256 = part.hexdigest()
+            path = self._blob_path(sha256)
+            # Opened before the part is moved or dropped, so an eviction in
+            # the meantime cannot take the file away from this caller
+            blob = open(part.path, "rb")
+            if os.path.exists(path):
+                # Identical content is already stored (e.g. posted in another course)
+                part.discard()
+                added = 0
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(part.path, path)
+                added = part.size
+        except BaseException:
+            part.discard()
+            raise
+
+        try:
+            now = datetime.utcnow()
+            async with AsyncSessionLocal() as db:
+                row = pg_insert(MirrorBlob).values(sha256=sha256, size=part.size, created_at=now, last_accessed_at=now)
+                await db.execute(row.on_conflict_do_update(index_elements=[MirrorBlob.sha256], set_={"last_accessed_at": now}))
+                entry = pg_insert(MirrorEntry).values(
+                    file_url=key.file_url, filesize=key.filesize, time_modified=key.time_modified, sha256=sha256, stored_at=now
+                )
+                await db.execute(entry.on_conflict_do_update(
+                    index_elements=[MirrorEntry.file_url],
+                    set_={"filesize": key.filesize, "time_modified": key.time_modified, "sha256": sha256, "stored_at": now},
+                ))
+                await db.commit()
+        except BaseException:
+            blob.close()
+            raise
+
+        # A file larger than the budget is still served once: the caller holds it open
+        self._stored_bytes += added
+        if self._over_budget():
+            try:
+                await self.evict()
+            except Exception as e:
+                print(f"[MIRROR] Eviction failed: {type(e).__name__}: {e}")
+        return StoredBlob(blob, part.size, sha256)
+
+    def _over_budget(self) -> bool:
+        """Whether to run evict(): the running count says so, or it is due for a recount"""
+        if self._counted_at is None or time.monotonic() - self._counted_at > RECOUNT_SECONDS:
+            return True
+        return self._stored_bytes > self.max_bytes
+
+    async def evict(self) -> int:
+        """Delete least recently used blobs until the store fits the byte budget"""
+        async with AsyncSessionLocal() as db:
+            total = await db.scalar(select(func.coalesce(func.sum(MirrorBlob.size), 0)))
+            self._stored_bytes, self._counted_at = total, time.monotonic()
+            if total <= self.max_bytes:
+                return 0
+            result = await db.execute(select(MirrorBlob.sha256, MirrorBlob.size).order_by(MirrorBlob.last_accessed_at))
+            victims = []
+            for sha256, size in result.all():
+                if total <= self.max_bytes:
+                    break
+                victims.append(sha256)
+                total -= size
+            # Index rows first, so no reader is pointed at a file about to go
+            await db.execute(delete(MirrorEntry).where(MirrorEntry.sha256.in_(victims)))
+            await db.execute(delete(MirrorBlob).where(MirrorBlob.sha256.in_(victims)))
+            await db.commit()
+        self._stored_bytes = total
+
+        for sha256 in victims:
+            try:
+                os.remove(self._blob_path(sha256))
+            except FileNotFoundError:
+                pass
+        print(f"[MIRROR] Evicted {len(victims)} files, {total / 1024 ** 2:.0f} MiB of {self.max_bytes / 1024 ** 2:.0f} MiB used")
+        return len(victims)
+
+    async def status(self) -> dict:
+        async with AsyncSessionLocal() as db:
+            blobs, size = (await db.execute(select(func.count(), func.coalesce(func.sum(MirrorBlob.size), 0)))).one()
+            entries = await db.scalar(select(func.count()).select_from(MirrorEntry))
+        return {"files": entries, "blobs": blobs, "bytes": size, "max_bytes": self.max_bytes}
+
+_mirror: Optional[FileMirror] = None
+_mirror_failed = False
+
+def get_file_mirror() -> Optional[FileMirror]:
+    """The process's mirror, or None when disabled or its directory is unusable"""
+    global _mirror, _mirror_failed
+    if not settings.mirror_enabled or _mirror_failed:
+        return None
+    if _mirror is None:
+        try:
+            _mirror = FileMirror(settings.mirror_dir, settings.mirror_max_bytes)
+        except OSError as e:
+            print(f"[MIRROR] Disabled, cannot use {settings.mirror_dir}: {e}")
+            _mirror_failed = True
+            return None
+    return _mirror
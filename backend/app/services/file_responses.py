@@ -0,0 +1,85 @@
+import re
+import anyio
+from typing import Optional, Tuple
+from fastapi import Request
+from fastapi.responses import Response, StreamingResponse
+from app.config import settings
+
+_RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """
+    (start, end) inclusive for a single "bytes=" range, None to send the whole
+    file (no header, multiple ranges or a syntax we do not serve). Raises
+    ValueError when the range lies outside the file.
+    """
+    match = _RANGE.match((header or "").strip())
+    if not match or match.group(1) == match.group(2) == "":
+        return None
+    first, last = match.groups()
+    if first == "":
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0:
+            raise ValueError("empty suffix range")
+        return max(0, size - length), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or end < start:
+        raise ValueError("range not satisfiable")
+    return start, end
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # Weak comparison, as for GET
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return etag.removeprefix("W/") in tags
+
+async def _read_range(file, start: int, length: int):
+    # Disk reads run in a worker thread, a slow disk must not stall the event loop
+    try:
+        await anyio.to_thread.run_sync(file.seek, start)
+        while length > 0:
+            chunk = await anyio.to_thread.run_sync(file.read, min(settings.download_chunk_size, length))
+            if not chunk:
+                return
+            length -= len(chunk)
+            yield chunk
+    finally:
+        file.close()
+
+def file_response(request: Request, file, size: int, media_type: str, etag: Optional[str],
+                  headers: Optional[dict] = None) -> Response:
+    """
+    Serve an open, seekable file with conditional and range support:
+    If-None-Match -> 304, Range (single range, honouring If-Range) -> 206,
+    unsatisfiable range -> 416. Without an etag only plain ranges are served.
+    Takes ownership of the file and closes it.
+    """
+    headers = {**(headers or {}), "Accept-Ranges": "bytes"}
+    if etag is not None:
+        headers["ETag"] = etag
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            file.close()
+            return Response(status_code=304, headers={"ETag": etag})
+
+    if_range = request.headers.get("if-range")
+    byte_range = None
+    if if_range is None or (etag is not None and if_range.strip() == etag):
+        try:
+            byte_range = parse_range(request.headers.get("range"), size)
+        except ValueError:
+            file.close()
+            return Response(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+
+    if byte_range is None:
+        headers["Content-Length"] = str(size)
+        return StreamingResponse(_read_range(file, 0, size), media_type=media_type, headers=headers)
+
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(_read_range(file, start, end - start + 1), status_code=206, media_type=media_type, headers=headers)
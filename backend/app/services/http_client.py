@@ -0,0 +1,41 @@
+import httpx
+from typing import Optional
+from app.config import settings
+
+# One pooled client per process, shared by MoodleClient and the download endpoints.
+# Reusing it keeps TCP/TLS connections alive between calls instead of
+# re-handshaking with Moodle for every web-service request.
+_client: Optional[httpx.AsyncClient] = None
+
+def _build_client() -> httpx.AsyncClient:
+    limits = httpx.Limits(
+        max_connections=settings.moodle_max_connections,
+        max_keepalive_connections=settings.moodle_max_keepalive_connections,
+        keepalive_expiry=settings.moodle_keepalive_expiry,
+    )
+    timeout = httpx.Timeout(
+        settings.moodle_timeout,
+        connect=settings.moodle_connect_timeout,
+    )
+    return httpx.AsyncClient(http2=settings.moodle_http2, limits=limits, timeout=timeout)
+
+def get_http_client() -> httpx.AsyncClient:
+    """Return the shared HTTP client, creating it lazily (e.g. for standalone scripts)"""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = _build_client()
+    return _client
+
+async def open_http_client() -> httpx.AsyncClient:
+    """Create the shared client on application startup"""
+    client = get_http_client()
+    print(f"[HTTP] Shared client ready (http2={settings.moodle_http2}, max_connections={settings.moodle_max_connections})")
+    return client
+
+async def close_http_client():
+    """Close the shared client and its connection pool on shutdown"""
+    global _client
+    if _client is not None and not _client.is_closed:
+        await _client.aclose()
+        print("[HTTP] Shared client closed")
+    _client = None
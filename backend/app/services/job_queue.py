@@ -0,0 +1,180 @@
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+from sqlalchemy import select, update, and_, or_, text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from app.config import settings
+from app.database import AsyncSessionLocal
+from app.models.job import ACTIVE_DEDUPE_PREDICATE, Job
+
+# Postgres LISTEN/NOTIFY channel used to wake idle workers
+NOTIFY_CHANNEL = "jobs"
+ACTIVE_STATUSES = ("queued", "running")
+
+# kind -> async handler(job, report) returning a JSON-serializable result
+_handlers: Dict[str, Callable[..., Awaitable]] = {}
+
+def job_handler(kind: str):
+    """Register a worker handler for a job kind"""
+    def register(func):
+        _handlers[kind] = func
+        return func
+    return register
+
+def get_handler(kind: str):
+    return _handlers.get(kind)
+
+def _insert_job(kind: str, payload: Optional[dict], dedupe_key: Optional[str],
+                max_attempts: Optional[int], run_after: Optional[datetime]):
+    """INSERT ... RETURNING id, doing nothing when an active job has the same dedupe_key"""
+    table = Job.__table__
+    stmt = pg_insert(table).values(
+        kind=kind,
+        payload=payload or {},
+        status="queued",
+        dedupe_key=dedupe_key,
+        attempts=0,
+        max_attempts=max_attempts or settings.job_max_attempts,
+        run_after=run_after or datetime.utcnow(),
+        events=[],
+        created_at=datetime.utcnow(),
+    )
+    if dedupe_key:
+        stmt = stmt.on_conflict_do_nothing(
+            index_elements=[table.c.dedupe_key],
+            index_where=text(ACTIVE_DEDUPE_PREDICATE),
+        )
+    return stmt.returning(table.c.id)
+
+async def enqueue(kind: str, payload: Optional[dict] = None, dedupe_key: Optional[str] = None,
+                  max_attempts: Optional[int] = None, run_after: Optional[datetime] = None):
+    """
+    Queue a job and wake a worker. Returns (job_id, created).
+
+    With a dedupe_key, an already queued/running job with the same key is
+    returned instead of adding a second one. run_after delays the job.
+    """
+    stmt = _insert_job(kind, payload, dedupe_key, max_attempts, run_after)
+
+    async with AsyncSessionLocal() as db:
+        while True:
+            job_id = (await db.execute(stmt)).scalar()
+            if job_id is not None:
+                break
+            existing = await _active_job_id(db, dedupe_key)
+            if existing is not None:
+                return existing, False
+            # The conflicting job finished between the insert and the lookup - try again
+        # Delivered on commit
+        await db.execute(text("SELECT pg_notify(:channel, :kind)"), {"channel": NOTIFY_CHANNEL, "kind": kind})
+        await db.commit()
+    return job_id, True
+
+async def _active_job_id(db, dedupe_key: str) -> Optional[int]:
+    result = await db.execute(
+        select(Job.id).where(Job.dedupe_key == dedupe_key, Job.status.in_(ACTIVE_STATUSES))
+    )
+    return result.scalar()
+
+async def claim(worker_id: str) -> Optional[Job]:
+    """Claim the next runnable job, skipping rows other workers have locked"""
+    now = datetime.utcnow()
+    stale = now - timedelta(seconds=settings.job_visibility_timeout_seconds)
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(
+            select(Job)
+            .where(or_(
+                and_(Job.status == "queued", Job.run_after <= now),
+                # Worker died mid-job - its heartbeat stopped
+                and_(Job.status == "running", Job.locked_at < stale),
+            ))
+            .order_by(Job.run_after, Job.id)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+        )
+        job = result.scalar_one_or_none()
+        if job is None:
+            return None
+        job.status = "running"
+        job.attempts = (job.attempts or 0) + 1
+        job.locked_by = worker_id
+        job.locked_at = now
+        await db.commit()
+        return job
+
+async def heartbeat(job_id: int, worker_id: str):
+    async with AsyncSessionLocal() as db:
+        await db.execute(
+            update(Job)
+            .where(Job.id == job_id, Job.locked_by == worker_id)
+            .values(locked_at=datetime.utcnow())
+        )
+        await db.commit()
+
+async def append_event(job_id: int, events: list):
+    """Persist the job's progress events so other processes can stream them"""
+    async with AsyncSessionLocal() as db:
+        await db.execute(update(Job).where(Job.id == job_id).values(events=events))
+        await db.commit()
+
+async def complete(job_id: int, result=None):
+    async with AsyncSessionLocal() as db:
+        await db.execute(
+            update(Job).where(Job.id == job_id).values(
+                status="done", result=result, finished_at=datetime.utcnow(), locked_by=None, locked_at=None
+            )
+        )
+        await db.commit()
+
+async def fail(job: Job, error: str):
+    """Retry with exponential backoff, or dead-letter once attempts are exhausted"""
+    dead = (job.attempts or 0) >= (job.max_attempts or 1)
+    values = {"last_error": error[:2000], "locked_by": None, "locked_at": None}
+    if dead:
+        values.update(status="dead", finished_at=datetime.utcnow())
+        print(f"[QUEUE] Job {job.id} ({job.kind}) dead-lettered after {job.attempts} attempts: {error}")
+    else:
+        delay = settings.job_retry_backoff_seconds * (2 ** ((job.attempts or 1) - 1))
+        values.update(status="queued", run_after=datetime.utcnow() + timedelta(seconds=delay))
+        print(f"[QUEUE] Job {job.id} ({job.kind}) failed, retrying in {delay}s: {error}")
+    async with AsyncSessionLocal() as db:
+        await db.execute(update(Job).where(Job.id == job.id).values(**values))
+        await db.commit()
+
+async def get_job(job_id: int) -> Optional[Job]:
+    async with AsyncSessionLocal() as db:
+        return await db.get(Job, job_id)
+
+async def get_jobs(job_ids: List[int]) -> List[Job]:
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(select(Job).where(Job.id.in_(job_ids)).order_by(Job.id))
+        return list(result.scalars().all())
+
+async def retry_dead(job_id: int) -> Optional[Tuple[int, bool]]:
+    """
+    Move a dead-lettered job back to the queue. Returns (job_id, requeued), or
+    None if there is no such dead job. When a job with the same dedupe_key is
+    already queued or running, that job is returned instead (requeued False).
+    """
+    async with AsyncSessionLocal() as db:
+        job = await db.get(Job, job_id)
+        if job is None or job.status != "dead":
+            return None
+        dedupe_key = job.dedupe_key
+        if dedupe_key:
+            active = await _active_job_id(db, dedupe_key)
+            if active is not None:
+                return active, False
+        try:
+            result = await db.execute(
+                update(Job).where(Job.id == job_id, Job.status == "dead").values(
+                    status="queued", attempts=0, run_after=datetime.utcnow(), finished_at=None
+                )
+            )
+            await db.execute(text("SELECT pg_notify(:channel, 'retry')"), {"channel": NOTIFY_CHANNEL})
+            await db.commit()
+        except IntegrityError:
+            # An active job with the same key was queued in the meantime (uq_jobs_active_dedupe)
+            await db.rollback()
+            return await _active_job_id(db, dedupe_key), False
+        return (job_id, True) if result.rowcount == 1 else None
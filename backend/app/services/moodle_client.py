@@ -1,29 +1,164 @@
+import asyncio
+import json
+import time
 import httpx
-from typing import List, Dict, Any
+from typing import AsyncIterator, List, Dict, Any, Set
 from app.config import settings
+from app.services.http_client import get_http_client
+from app.services.rate_limiter import get_request_scheduler, backoff_delay, CircuitOpenError
+from app.services.contents_stream import iter_file_records
+
+# Moodle mobile-app function that runs several web-service functions in one request
+BATCH_WSFUNCTION = "tool_mobile_call_external_functions"
+
+# Statuses worth retrying; 429 and 503 also mean "slow down"
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+OVERLOAD_STATUS = {429, 503}
 
 class MoodleClient:
-    def __init__(self):
+    def __init__(self, token: str = None, user_id: int = None):
+        """Client for one Moodle account; defaults to the credentials in settings"""
         self.base_url = f"{settings.moodle_url}/webservice/rest/server.php"
-        self.token = settings.moodle_token
-        self.user_id = settings.moodle_user_id
+        self.token = token or settings.moodle_token
+        self.user_id = user_id if user_id is not None else settings.moodle_user_id
+        # Per-instance metrics, read by the sync run ledger
+        self.call_counts: Dict[str, int] = {}
+        self.response_bytes = 0
+
+    # Tokens whose service rejects the batch function; shared across instances
+    # so there is no point asking again on every sync. Per token: other
+    # users' services may well allow it.
+    _batching_unsupported: Set[str] = set()
 
-    async def _call(self, wsfunction: str, **params) -> Any:
-        """Make async API call to Moodle"""
+    @property
+    def batching_supported(self) -> bool:
+        return self.token not in MoodleClient._batching_unsupported
+
+    async def _call(self, wsfunction: str, _method: str = "GET", **params) -> Any:
+        """Make async API call to Moodle, with adaptive concurrency, retries and a circuit breaker"""
         payload = {
             "wstoken": self.token,
             "wsfunction": wsfunction,
             "moodlewsrestformat": "json",
             **params
         }
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.get(self.base_url, params=payload)
-            response.raise_for_status()
-            data = response.json()
-            # Check for Moodle API errors (invalid token, permission denied, etc.)
-            if isinstance(data, dict) and 'exception' in data:
-                print(f"[MOODLE API ERROR] {wsfunction}: {data.get('message', data)}")
-            return data
+        client = get_http_client()
+        scheduler = get_request_scheduler()
+
+        for attempt in range(settings.moodle_max_retries + 1):
+            retry_after = None
+            try:
+                async with scheduler.slot(wsfunction, user_key=self.user_id):
+                    started = time.monotonic()
+                    if _method == "POST":
+                        # Large batched requests go in the body to avoid URL length limits
+                        response = await client.post(self.base_url, data=payload)
+                    else:
+                        response = await client.get(self.base_url, params=payload)
+                    latency = time.monotonic() - started
+
+                if response.status_code in RETRYABLE_STATUS:
+                    if response.status_code in OVERLOAD_STATUS:
+                        scheduler.record_overload()
+                    else:
+                        scheduler.record_failure()
+                    if response.headers.get("retry-after", "").isdigit():
+                        retry_after = float(response.headers["retry-after"])
+                    error = httpx.HTTPStatusError(
+                        f"{response.status_code} from Moodle", request=response.request, response=response
+                    )
+                else:
+                    response.raise_for_status()
+                    scheduler.record_success(latency)
+                    self.call_counts[wsfunction] = self.call_counts.get(wsfunction, 0) + 1
+                    self.response_bytes += len(response.content)
+                    data = response.json()
+                    # Check for Moodle API errors (invalid token, permission denied, etc.)
+                    if isinstance(data, dict) and 'exception' in data:
+                        print(f"[MOODLE API ERROR] {wsfunction}: {data.get('message', data)}")
+                    return data
+            except CircuitOpenError:
+                raise
+            except httpx.TransportError as e:
+                # Timeouts, connection resets, DNS failures
+                scheduler.record_failure()
+                error = e
+
+            if attempt == settings.moodle_max_retries:
+                break
+            delay = backoff_delay(attempt, retry_after)
+            print(f"[MOODLE RETRY] {wsfunction} attempt {attempt + 1} failed ({type(error).__name__}: {error}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+        raise error
+
+    async def _stream(self, wsfunction: str, **params) -> AsyncIterator[bytes]:
+        """
+        Like _call, but yield the raw response body in chunks instead of decoding it.
+
+        The scheduler slot is held until the body has been consumed. Failures are
+        retried only before the first chunk is handed out; once the caller has
+        parsed part of the body a retry would replay it, so the error is raised.
+        """
+        payload = {
+            "wstoken": self.token,
+            "wsfunction": wsfunction,
+            "moodlewsrestformat": "json",
+            **params
+        }
+        client = get_http_client()
+        scheduler = get_request_scheduler()
+        body_started = False
+
+        for attempt in range(settings.moodle_max_retries + 1):
+            retry_after = None
+            try:
+                async with scheduler.slot(wsfunction, user_key=self.user_id):
+                    started = time.monotonic()
+                    request = client.build_request("GET", self.base_url, params=payload)
+                    response = await client.send(request, stream=True)
+                    try:
+                        latency = time.monotonic() - started
+                        if response.status_code in RETRYABLE_STATUS:
+                            if response.status_code in OVERLOAD_STATUS:
+                                scheduler.record_overload()
+                            else:
+                                scheduler.record_failure()
+                            if response.headers.get("retry-after", "").isdigit():
+                                retry_after = float(response.headers["retry-after"])
+                            error = httpx.HTTPStatusError(
+                                f"{response.status_code} from Moodle", request=response.request, response=response
+                            )
+                        else:
+                            response.raise_for_status()
+                            scheduler.record_success(latency)
+                            self.call_counts[wsfunction] = self.call_counts.get(wsfunction, 0) + 1
+                            async for chunk in response.aiter_bytes():
+                                body_started = True
+                                self.response_bytes += len(chunk)
+                                yield chunk
+                            return
+                    finally:
+                        await response.aclose()
+            except CircuitOpenError:
+                raise
+            except httpx.TransportError as e:
+                scheduler.record_failure()
+                if body_started:
+                    raise
+                error = e
+
+            if attempt == settings.moodle_max_retries:
+                break
+            delay = backoff_delay(attempt, retry_after)
+            print(f"[MOODLE RETRY] {wsfunction} attempt {attempt + 1} failed ({type(error).__name__}: {error}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+        raise error
+
+    async def get_site_info(self) -> Dict:
+        """Fetch the token owner's identity (userid, fullname, ...)"""
+        return await self._call("core_webservice_get_site_info")
 
     async def get_user_courses(self) -> List[Dict]:
         """Fetch all enrolled courses"""
@@ -33,6 +168,21 @@ class MoodleClient:
         """Fetch course contents (modules, resources)"""
         return await self._call("core_course_get_contents", courseid=course_id)
 
+    def iter_course_files(self, course_id: int) -> AsyncIterator[Dict]:
+        """
+        Stream course contents as flat file records (section, module, content),
+        without materializing the whole response
+        """
+        return iter_file_records(self._stream("core_course_get_contents", courseid=course_id))
+
+    async def get_course_updates_since(self, course_id: int, since: int) -> Dict:
+        """Fetch module-level change markers for a course since a unix timestamp"""
+        return await self._call("core_course_get_updates_since", courseid=course_id, since=since)
+
+    async def get_grade_items(self, course_id: int) -> Dict:
+        """Fetch the user's gradebook items (all activities) for a course"""
+        return await self._call("gradereport_user_get_grade_items", courseid=course_id, userid=self.user_id)
+
     async def get_assignments(self, course_ids: List[int]) -> Dict:
         """Fetch assignments for multiple courses"""
         # Moodle API expects courseids[0]=id1&courseids[1]=id2 format
@@ -45,11 +195,67 @@ class MoodleClient:
             return await self._call("mod_assign_get_submission_status",
                                    assignid=assignment_id,
                                    userid=self.user_id)
+        except CircuitOpenError:
+            # Moodle is down - let the sync fail fast instead of recording empty statuses
+            raise
         except Exception as e:
             # If we can't get status, log and return empty dict
             print(f"[MOODLE ERROR] get_assignment_status({assignment_id}): {type(e).__name__}: {e}")
             return {}
 
+    async def get_assignment_statuses(self, assignment_ids: List[int]) -> Dict[int, Dict]:
+        """Fetch submission statuses for many assignments, batched into multi-function requests"""
+        chunk_size = max(1, settings.moodle_batch_size)
+        chunks = [assignment_ids[i:i + chunk_size] for i in range(0, len(assignment_ids), chunk_size)]
+        results = await asyncio.gather(*[self._get_assignment_statuses_chunk(chunk) for chunk in chunks])
+
+        statuses = {}
+        for chunk_statuses in results:
+            statuses.update(chunk_statuses)
+        return statuses
+
+    async def _get_assignment_statuses_chunk(self, assignment_ids: List[int]) -> Dict[int, Dict]:
+        if self.batching_supported:
+            params = {}
+            for i, aid in enumerate(assignment_ids):
+                params[f"requests[{i}][function]"] = "mod_assign_get_submission_status"
+                params[f"requests[{i}][arguments]"] = json.dumps({"assignid": aid, "userid": self.user_id})
+            try:
+                data = await self._call(BATCH_WSFUNCTION, _method="POST", **params)
+            except CircuitOpenError:
+                raise
+            except Exception as e:
+                # Transient failure of the whole batch - retry this chunk call by call
+                print(f"[MOODLE ERROR] Batched status call failed ({type(e).__name__}: {e}), falling back to per-call")
+                data = None
+
+            if isinstance(data, dict) and 'exception' in data:
+                # Function not enabled for this token/service
+                print(f"[MOODLE] {BATCH_WSFUNCTION} unavailable ({data.get('errorcode')}), using per-call status requests")
+                MoodleClient._batching_unsupported.add(self.token)
+            elif isinstance(data, dict) and len(data.get('responses', [])) == len(assignment_ids):
+                return {
+                    aid: self._unpack_batch_response(aid, response)
+                    for aid, response in zip(assignment_ids, data['responses'])
+                }
+
+        results = await asyncio.gather(*[self.get_assignment_status(aid) for aid in assignment_ids])
+        return dict(zip(assignment_ids, results))
+
+    def _unpack_batch_response(self, assignment_id: int, response: Dict) -> Dict:
+        """Decode one entry of a batched response; errors stay isolated to their assignment"""
+        if response.get('error'):
+            # Same shape as a single-call Moodle exception payload
+            exception = response.get('exception') or {}
+            if isinstance(exception, str):
+                exception = {"message": exception}
+            return {"exception": exception.get('exception', 'moodle_exception'), **exception}
+        try:
+            return json.loads(response.get('data') or '{}')
+        except (TypeError, ValueError) as e:
+            print(f"[MOODLE ERROR] Could not decode batched status for assignment {assignment_id}: {e}")
+            return {}
+
     async def get_submissions(self, assignment_ids: List[int]) -> Dict:
         """Fetch submissions for multiple assignments"""
         params = {f"assignmentids[{i}]": aid for i, aid in enumerate(assignment_ids)}
@@ -0,0 +1,213 @@
+"""
+Post-sync prefetch of new and changed files into the local mirror.
+
+After a sync, files added or modified recently that the mirror does not hold
+yet are downloaded in the background - only inside the configured off-peak
+window, a few at a time and under a shared bandwidth cap - so that the next
+morning's downloads are served from disk.
+"""
+import asyncio
+import time
+from datetime import datetime, timedelta
+from typing import Optional
+from sqlalchemy import select, update, func, or_
+from app.config import settings
+from app.database import AsyncSessionLocal
+from app.models.course import UserCourse
+from app.models.job import Job
+from app.models.mirror import MirrorEntry
+from app.models.resource import Resource
+from app.models.sync_state import CourseSyncState
+from app.models.user import MoodleUser
+from app.services import job_queue
+from app.services.downloads import DownloadFailed, get_download_engine
+from app.services.file_mirror import MirrorKey, get_file_mirror
+from app.services.job_queue import job_handler
+from app.services.sync_lock import LeaseLock, LockNotAcquired, PREFETCH_LOCK
+
+class BandwidthLimiter:
+    """Caps the combined transfer rate of everyone awaiting consume()"""
+
+    def __init__(self, bytes_per_sec: int):
+        self.rate = bytes_per_sec
+        self._next = time.monotonic()
+
+    async def consume(self, size: int):
+        if self.rate <= 0:
+            return
+        now = time.monotonic()
+        # Each chunk books its transfer time after the previous chunk's slot
+        self._next = max(self._next, now) + size / self.rate
+        delay = self._next - now
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+def in_window(now: Optional[datetime] = None) -> bool:
+    hour = (now or datetime.now()).hour
+    start, end = settings.prefetch_window_start_hour, settings.prefetch_window_end_hour
+    if start <= end:
+        return start <= hour < end
+    return hour >= start or hour < end
+
+def next_window_start(now: Optional[datetime] = None) -> datetime:
+    """Now if inside the window, else the next time it opens (local time)"""
+    now = now or datetime.now()
+    if in_window(now):
+        return now
+    start = now.replace(hour=settings.prefetch_window_start_hour % 24, minute=0, second=0, microsecond=0)
+    return start if start > now else start + timedelta(days=1)
+
+async def _load_candidates(db) -> list:
+    """
+    Live files added/modified within prefetch_max_age_days without an
+    up-to-date mirror copy, most recently accessed courses first and newest
+    files first within a course. Each comes with the token of an enabled user
+    enrolled in its course.
+    """
+    recency = func.coalesce(Resource.time_modified, Resource.time_created, Resource.created_at)
+    now = datetime.utcnow()
+    token_user = (
+        select(UserCourse.course_id, func.min(UserCourse.user_id).label("user_id"))
+        .join(MoodleUser, MoodleUser.id == UserCourse.user_id)
+        .where(MoodleUser.enabled == True)
+        .group_by(UserCourse.course_id)
+        .subquery()
+    )
+    result = await db.execute(
+        select(
+            Resource.id, Resource.file_url, Resource.filename, Resource.filesize, Resource.time_modified,
+            MoodleUser.token,
+        )
+        .join(token_user, token_user.c.course_id == Resource.course_id)
+        .join(MoodleUser, MoodleUser.id == token_user.c.user_id)
+        .outerjoin(MirrorEntry, MirrorEntry.file_url == Resource.file_url)
+        .outerjoin(CourseSyncState, CourseSyncState.course_id == Resource.course_id)
+        .where(Resource.deleted_at.is_(None))
+        .where(or_(
+            MirrorEntry.id.is_(None),
+            MirrorEntry.filesize.is_distinct_from(Resource.filesize),
+            MirrorEntry.time_modified.is_distinct_from(Resource.time_modified),
+        ))
+        .where(recency >= now - timedelta(days=settings.prefetch_max_age_days))
+        .where(or_(Resource.filesize.is_(None), Resource.filesize <= settings.prefetch_max_file_bytes))
+        .where(or_(
+            Resource.prefetch_status.is_distinct_from("failed"),
+            Resource.prefetch_attempted_at < now - timedelta(hours=settings.prefetch_retry_hours),
+        ))
+        .order_by(CourseSyncState.course_lastaccess.desc().nulls_last(), recency.desc())
+        .limit(settings.prefetch_max_files)
+    )
+    return result.all()
+
+async def _set_status(resource_ids: list, status: str, error: Optional[str] = None):
+    async with AsyncSessionLocal() as db:
+        await db.execute(
+            update(Resource).where(Resource.id.in_(resource_ids))
+            # updated_at keeps meaning "changed in Moodle"
+            .values(prefetch_status=status, prefetch_error=error,
+                    prefetch_attempted_at=datetime.utcnow(), updated_at=Resource.updated_at)
+        )
+        await db.commit()
+
+async def prefetch_files() -> dict:
+    """One prefetch pass; stops early when the window closes. Returns counts."""
+    mirror = get_file_mirror()
+    if mirror is None:
+        print("[PREFETCH] Local mirror disabled, nothing to prefetch into")
+        return {"done": 0, "failed": 0, "skipped": 0}
+
+    async with AsyncSessionLocal() as db:
+        candidates = await _load_candidates(db)
+    if not candidates:
+        return {"done": 0, "failed": 0, "skipped": 0}
+    await _set_status([c.id for c in candidates], "queued")
+    print(f"[PREFETCH] {len(candidates)} files to prefetch")
+
+    engine = get_download_engine()
+    limiter = BandwidthLimiter(settings.prefetch_bandwidth_bytes_per_sec)
+    gate = asyncio.Semaphore(settings.prefetch_concurrency)
+    counts = {"done": 0, "failed": 0, "skipped": 0, "bytes": 0}
+    started = time.monotonic()
+
+    async def prefetch(candidate):
+        async with gate:
+            if not in_window():
+                # Left queued; picked up again by the next run
+                counts["skipped"] += 1
+                return
+            key = MirrorKey(candidate.file_url, candidate.filesize, candidate.time_modified)
+            try:
+                # Another download may have mirrored it since the candidates were loaded
+                if not await mirror.lookup([key]):
+                    stored = await mirror.download(
+                        engine, f"{candidate.file_url}&token={candidate.token}", key, candidate.filename, limiter.consume
+                    )
+                    stored.file.close()
+                    counts["bytes"] += stored.size
+            except DownloadFailed as e:
+                counts["failed"] += 1
+                await _set_status([candidate.id], "failed", str(e))
+                return
+            counts["done"] += 1
+            await _set_status([candidate.id], "done")
+
+    await asyncio.gather(*[prefetch(c) for c in candidates])
+    print(
+        f"[PREFETCH] {counts['done']} files ({counts['bytes'] / 1024 ** 2:.1f} MiB) in {time.monotonic() - started:.0f}s, "
+        f"{counts['failed']} failed, {counts['skipped']} left for the next window"
+    )
+    return counts
+
+async def run_prefetch() -> dict:
+    """prefetch_files() under a cross-process lease, so the API and the worker never both run it"""
+    try:
+        async with LeaseLock(PREFETCH_LOCK).hold():
+            return await prefetch_files()
+    except LockNotAcquired:
+        print("[PREFETCH] Already running elsewhere, skipping")
+        return {"skipped": True}
+
+_task: Optional[asyncio.Task] = None
+_rerun = False
+
+async def _prefetch_loop():
+    global _rerun
+    while True:
+        _rerun = False
+        delay = (next_window_start() - datetime.now()).total_seconds()
+        if delay > 0:
+            print(f"[PREFETCH] Waiting {delay / 3600:.1f}h for the prefetch window")
+            await asyncio.sleep(delay)
+        try:
+            await run_prefetch()
+        except Exception as e:
+            print(f"[PREFETCH ERROR] {type(e).__name__}: {e}")
+        if not _rerun:
+            return
+
+async def request_prefetch():
+    """
+    Ask for a prefetch after a sync. With the job queue it becomes a job
+    delayed to the window; otherwise it runs (or re-runs once the current pass
+    finishes) as a task in this process.
+    """
+    global _task, _rerun
+    if not settings.prefetch_enabled:
+        return
+    if settings.job_queue_enabled:
+        # Local times in the window, converted to the queue's UTC
+        run_after = datetime.utcnow() + (next_window_start() - datetime.now())
+        await job_queue.enqueue("prefetch", {}, dedupe_key="prefetch", run_after=run_after)
+        return
+    if _task is not None and not _task.done():
+        _rerun = True
+        return
+    _task = asyncio.create_task(_prefetch_loop())
+
+async def stop_prefetch():
+    if _task is not None and not _task.done():
+        _task.cancel()
+
+@job_handler("prefetch")
+async def run_prefetch_job(job: Job, report):
+    return await run_prefetch()
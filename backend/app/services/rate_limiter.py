@@ -0,0 +1,185 @@
+import asyncio
+import random
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, Optional
+from app.config import settings
+
+class CircuitOpenError(Exception):
+    """Raised when Moodle calls are short-circuited because the breaker is open"""
+    pass
+
+class AdaptiveLimiter:
+    """AIMD concurrency limit: grow slowly while Moodle is healthy, halve on overload"""
+
+    def __init__(self, initial: int, minimum: int, maximum: int, latency_target: float):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_target = latency_target
+        self.in_flight = 0
+        self._last_decrease = 0.0
+        self._cond = asyncio.Condition()
+
+    async def acquire(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def release(self):
+        async with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def on_success(self, latency: float):
+        if latency > self.latency_target:
+            self.on_overload()
+            return
+        # Additive increase: roughly +1 per "window" of successful calls
+        self.limit = min(self.maximum, self.limit + 1.0 / max(self.limit, 1.0))
+
+    def on_overload(self):
+        # Multiplicative decrease, at most once per latency window so a burst of
+        # slow responses from the same round does not collapse the limit to 1
+        now = time.monotonic()
+        if now - self._last_decrease < self.latency_target:
+            return
+        self._last_decrease = now
+        self.limit = max(self.minimum, self.limit / 2)
+        print(f"[RATE LIMIT] Moodle overloaded, concurrency limit -> {int(self.limit)}")
+
+class CircuitBreaker:
+    """Opens after consecutive failures, then lets a single probe through after a cooldown"""
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._probe_in_flight = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def before_call(self):
+        state = self.state
+        if state == "open":
+            raise CircuitOpenError("Moodle circuit breaker is open, skipping call")
+        if state == "half_open":
+            if self._probe_in_flight:
+                raise CircuitOpenError("Moodle circuit breaker is half-open, probe already in flight")
+            self._probe_in_flight = True
+
+    def after_call(self):
+        # Calls that ended without a success/failure verdict (e.g. a 4xx) must not
+        # leave the half-open probe slot taken forever
+        self._probe_in_flight = False
+
+    def on_success(self):
+        if self.opened_at is not None:
+            print("[CIRCUIT] Moodle recovered, closing breaker")
+        self.failures = 0
+        self.opened_at = None
+        self._probe_in_flight = False
+
+    def on_failure(self):
+        self.failures += 1
+        self._probe_in_flight = False
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+            print(f"[CIRCUIT] Moodle failing ({self.failures} consecutive errors), breaker open for {self.reset_timeout}s")
+
+class MoodleRequestScheduler:
+    """Process-wide admission control for Moodle web-service calls"""
+
+    def __init__(self):
+        self.limiter = AdaptiveLimiter(
+            initial=settings.moodle_concurrency_initial,
+            minimum=settings.moodle_concurrency_min,
+            maximum=settings.moodle_concurrency_max,
+            latency_target=settings.moodle_latency_target,
+        )
+        self.breaker = CircuitBreaker(
+            failure_threshold=settings.moodle_breaker_failure_threshold,
+            reset_timeout=settings.moodle_breaker_reset_timeout,
+        )
+        self.budgets: Dict[str, asyncio.Semaphore] = {
+            wsfunction: asyncio.Semaphore(limit)
+            for wsfunction, limit in settings.moodle_function_budgets.items()
+        }
+        # Per-user caps, created on first use
+        self.user_budgets: Dict[object, asyncio.Semaphore] = {}
+
+    def _user_budget(self, user_key) -> Optional[asyncio.Semaphore]:
+        if user_key is None:
+            return None
+        if user_key not in self.user_budgets:
+            self.user_budgets[user_key] = asyncio.Semaphore(settings.moodle_user_concurrency)
+        return self.user_budgets[user_key]
+
+    @asynccontextmanager
+    async def slot(self, wsfunction: str, user_key=None):
+        """Reserve a per-user slot, a per-function budget slot and a global concurrency slot"""
+        self.breaker.before_call()
+        user_budget = self._user_budget(user_key)
+        budget = self.budgets.get(wsfunction)
+        # The user cap is taken first so a user at their limit queues without
+        # holding function or global slots that other users could use
+        if user_budget:
+            await user_budget.acquire()
+        try:
+            if budget:
+                await budget.acquire()
+            try:
+                await self.limiter.acquire()
+                try:
+                    yield
+                finally:
+                    await self.limiter.release()
+            finally:
+                if budget:
+                    budget.release()
+        finally:
+            self.breaker.after_call()
+            if user_budget:
+                user_budget.release()
+
+    def record_success(self, latency: float):
+        self.limiter.on_success(latency)
+        self.breaker.on_success()
+
+    def record_overload(self):
+        self.limiter.on_overload()
+        self.breaker.on_failure()
+
+    def record_failure(self):
+        self.breaker.on_failure()
+
+    def status(self) -> dict:
+        return {
+            "concurrency_limit": int(self.limiter.limit),
+            "in_flight": self.limiter.in_flight,
+            "breaker": self.breaker.state,
+            "consecutive_failures": self.breaker.failures,
+            "per_user_limit": settings.moodle_user_concurrency,
+        }
+
+def backoff_delay(attempt: int, retry_after: Optional[float] = None) -> float:
+    """Full-jitter exponential backoff, honouring Retry-After when Moodle sends one"""
+    if retry_after is not None:
+        return min(retry_after, settings.moodle_retry_backoff_max)
+    cap = min(settings.moodle_retry_backoff_max, settings.moodle_retry_backoff_base * (2 ** attempt))
+    return random.uniform(0, cap)
+
+_scheduler: Optional[MoodleRequestScheduler] = None
+
+def get_request_scheduler() -> MoodleRequestScheduler:
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = MoodleRequestScheduler()
+    return _scheduler
@@ -0,0 +1,132 @@
+import time
+from datetime import datetime
+from typing import Dict, List, Tuple
+from app.database import engine
+
+STAGE_TABLE = "resource_stage"
+STAGE_COLUMNS = (
+    "course_id", "moodle_id", "filename", "file_url", "section", "mimetype", "filesize", "time_created", "time_modified",
+)
+
+CREATE_STAGE = f"""
+    CREATE TEMP TABLE IF NOT EXISTS {STAGE_TABLE} (
+        course_id BIGINT NOT NULL,
+        moodle_id BIGINT,
+        filename TEXT,
+        file_url TEXT NOT NULL,
+        section TEXT,
+        mimetype TEXT,
+        filesize BIGINT,
+        time_created TIMESTAMP,
+        time_modified TIMESTAMP
+    );
+    CREATE INDEX IF NOT EXISTS {STAGE_TABLE}_key ON {STAGE_TABLE} (course_id, file_url);
+    TRUNCATE {STAGE_TABLE};
+"""
+
+# One row per file_url: a course can list the same file in several modules
+STAGED = f"""
+    SELECT DISTINCT ON (file_url) *
+    FROM {STAGE_TABLE}
+    WHERE course_id = $1
+    ORDER BY file_url
+"""
+
+UPDATE_CHANGED = f"""
+    UPDATE resources r
+    SET section = s.section, filesize = s.filesize, time_modified = s.time_modified,
+        deleted_at = NULL, updated_at = $2::timestamp
+    FROM ({STAGED}) s
+    WHERE r.file_url = s.file_url
+      AND (r.section, r.filesize, r.time_modified, r.deleted_at)
+          IS DISTINCT FROM (s.section, s.filesize::integer, s.time_modified, NULL::timestamp)
+"""
+
+INSERT_NEW = f"""
+    WITH inserted AS (
+        INSERT INTO resources (moodle_id, course_id, filename, file_url, section, mimetype, filesize,
+                               time_created, time_modified, is_new, created_at, updated_at)
+        SELECT moodle_id, course_id, filename, file_url, section, mimetype, filesize,
+               time_created, time_modified, TRUE, $2::timestamp, $2::timestamp
+        FROM ({STAGED}) s
+        ON CONFLICT (file_url) DO NOTHING
+        RETURNING 1
+    )
+    SELECT count(*) FROM inserted
+"""
+
+# Set difference stored - staged for the course, in one anti-join
+FLAG_MISSING = f"""
+    UPDATE resources r
+    SET deleted_at = $2::timestamp, updated_at = $2::timestamp
+    WHERE r.course_id = $1
+      AND r.deleted_at IS NULL
+      AND NOT EXISTS (
+          SELECT 1 FROM {STAGE_TABLE} s WHERE s.course_id = $1 AND s.file_url = r.file_url
+      )
+"""
+
+def _affected(status: str) -> int:
+    """Row count from a command tag such as 'UPDATE 12'"""
+    return int(status.split()[-1])
+
+class ResourceStager:
+    """
+    Resource reconciliation through a temp staging table.
+
+    Rows are COPYed into the stage as they are streamed from Moodle, on a
+    dedicated connection so the stage survives the sync's per-course commits.
+    Once a course has been fully staged, merge() reconciles it with a few
+    set-based statements: update changed rows (section, size, timemodified),
+    insert new ones and tombstone (set deleted_at on) rows Moodle no longer
+    lists - removed files as well as files of hidden sections/modules, which
+    the stream leaves out.
+    """
+
+    def __init__(self):
+        self.stats = {"copied": 0, "copy_seconds": 0.0, "merge_seconds": 0.0}
+        self._conn = None
+        self._pg = None
+
+    async def __aenter__(self):
+        self._conn = await engine.connect()
+        raw = await self._conn.get_raw_connection()
+        self._pg = raw.driver_connection
+        await self._pg.execute(CREATE_STAGE)
+        return self
+
+    async def __aexit__(self, *exc):
+        try:
+            # The connection goes back to the pool; do not leave the stage behind
+            await self._pg.execute(f"DROP TABLE IF EXISTS {STAGE_TABLE}")
+        finally:
+            await self._conn.close()
+
+    async def stage(self, rows: List[Dict]):
+        """COPY a chunk of resource rows into the stage"""
+        if not rows:
+            return
+        started = time.monotonic()
+        await self._pg.copy_records_to_table(
+            STAGE_TABLE,
+            records=[tuple(row[column] for column in STAGE_COLUMNS) for row in rows],
+            columns=STAGE_COLUMNS,
+        )
+        self.stats["copied"] += len(rows)
+        self.stats["copy_seconds"] += time.monotonic() - started
+
+    async def merge(self, course_id: int) -> Tuple[int, int, int]:
+        """Reconcile one fully staged course; returns (inserted, updated, flagged missing)"""
+        started = time.monotonic()
+        now = datetime.utcnow()
+        async with self._pg.transaction():
+            updated = _affected(await self._pg.execute(UPDATE_CHANGED, course_id, now))
+            inserted = await self._pg.fetchval(INSERT_NEW, course_id, now)
+            missing = _affected(await self._pg.execute(FLAG_MISSING, course_id, now))
+            await self._pg.execute(f"DELETE FROM {STAGE_TABLE} WHERE course_id = $1", course_id)
+        self.stats["merge_seconds"] += time.monotonic() - started
+        return inserted, updated, missing
+
+    async def discard(self, course_id: int):
+        """Drop whatever was staged for a course that will not be merged"""
+        await self._pg.execute(f"DELETE FROM {STAGE_TABLE} WHERE course_id = $1", course_id)
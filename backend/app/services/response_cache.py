@@ -0,0 +1,218 @@
+"""
+Cache of read-endpoint responses, invalidated when synced data changes.
+
+Listing endpoints only change when a sync (or a user change) commits, so
+their JSON bodies are kept per route + query under a generation counter.
+invalidate_responses() bumps the generation here and, through Postgres
+NOTIFY, in every other API process; a request with a matching If-None-Match
+gets a 304 without touching the database. Entries also expire after
+response_cache_ttl, in case an invalidation was missed.
+"""
+import hashlib
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Callable, Dict, NamedTuple, Optional
+import asyncpg
+from sqlalchemy import text
+from app.config import settings
+from app.database import AsyncSessionLocal
+from app.services.sync_lock import PROCESS_ID
+
+# Postgres LISTEN/NOTIFY channel carrying invalidations between processes
+INVALIDATE_CHANNEL = "response_cache"
+
+# Endpoints whose 200 responses are cached
+CACHED_PATHS = {"/api/courses/", "/api/assignments/", "/api/resources/", "/api/resources/new"}
+
+class CachedResponse(NamedTuple):
+    body: bytes
+    content_type: bytes
+    etag: str
+    stored_at: float
+
+class ResponseCacheBackend(ABC):
+    """Storage for cached responses; keys already include the generation"""
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[CachedResponse]:
+        ...
+
+    @abstractmethod
+    def set(self, key: str, entry: CachedResponse):
+        ...
+
+    @abstractmethod
+    def clear(self):
+        ...
+
+class MemoryBackend(ResponseCacheBackend):
+    """Per-process LRU dict"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, CachedResponse]" = OrderedDict()
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def set(self, key: str, entry: CachedResponse):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+BACKENDS: Dict[str, Callable[[], ResponseCacheBackend]] = {
+    "memory": lambda: MemoryBackend(settings.response_cache_max_entries),
+}
+
+def register_backend(name: str, factory: Callable[[], ResponseCacheBackend]):
+    """Make another backend selectable with RESPONSE_CACHE_BACKEND=<name>"""
+    BACKENDS[name] = factory
+
+class ResponseCache:
+    def __init__(self, backend: ResponseCacheBackend, ttl: float):
+        self.backend = backend
+        self.ttl = ttl
+        self.generation = 0
+
+    def key(self, generation: int, host: str, path: str, query: str) -> str:
+        # Host is part of the key: listings embed absolute download URLs
+        params = "&".join(sorted(query.split("&"))) if query else ""
+        return f"{generation}|{host}|{path}?{params}"
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        entry = self.backend.get(key)
+        if entry is None or time.monotonic() - entry.stored_at > self.ttl:
+            return None
+        return entry
+
+    def store(self, key: str, body: bytes, content_type: bytes) -> CachedResponse:
+        etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+        entry = CachedResponse(body, content_type, etag, time.monotonic())
+        self.backend.set(key, entry)
+        return entry
+
+    def bump(self):
+        self.generation += 1
+        self.backend.clear()
+
+_cache: Optional[ResponseCache] = None
+
+def get_response_cache() -> Optional[ResponseCache]:
+    global _cache
+    if not settings.response_cache_enabled:
+        return None
+    if _cache is None:
+        _cache = ResponseCache(BACKENDS[settings.response_cache_backend](), settings.response_cache_ttl)
+    return _cache
+
+async def invalidate_responses():
+    """Drop cached responses here and in every other process after data changed"""
+    cache = get_response_cache()
+    if cache is not None:
+        cache.bump()
+    try:
+        async with AsyncSessionLocal() as db:
+            await db.execute(text("SELECT pg_notify(:channel, :sender)"), {"channel": INVALIDATE_CHANNEL, "sender": PROCESS_ID})
+            await db.commit()
+    except Exception as e:
+        # Other processes fall back to the TTL
+        print(f"[CACHE] Could not notify other processes: {type(e).__name__}: {e}")
+
+def _on_invalidate(connection, pid, channel, sender):
+    cache = get_response_cache()
+    if cache is not None and sender != PROCESS_ID:
+        cache.bump()
+
+_listener = None
+
+async def start_invalidation_listener():
+    """LISTEN for invalidations from syncs running in other processes (e.g. the worker)"""
+    global _listener
+    if not settings.response_cache_enabled:
+        return
+    dsn = settings.database_url.replace("postgresql+asyncpg://", "postgresql://")
+    try:
+        _listener = await asyncpg.connect(dsn)
+        await _listener.add_listener(INVALIDATE_CHANNEL, _on_invalidate)
+    except Exception as e:
+        _listener = None
+        print(f"[CACHE] LISTEN unavailable ({e}), cached responses expire after {settings.response_cache_ttl}s")
+
+async def stop_invalidation_listener():
+    global _listener
+    if _listener is not None:
+        await _listener.close()
+        _listener = None
+
+class ResponseCacheMiddleware:
+    """
+    ASGI middleware serving CACHED_PATHS from the response cache. Runs before
+    routing, so hits and 304s never reach the endpoint or its dependencies.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        cache = get_response_cache()
+        if cache is None or scope["type"] != "http" or scope["method"] != "GET" or scope["path"] not in CACHED_PATHS:
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope["headers"])
+        if_none_match = [tag.strip().removeprefix("W/") for tag in headers.get(b"if-none-match", b"").decode().split(",")]
+        # Captured up front: a response built across an invalidation is stored
+        # under the old generation and never served
+        key = cache.key(cache.generation, headers.get(b"host", b"").decode(), scope["path"], scope["query_string"].decode())
+        entry = cache.get(key)
+        if entry is not None:
+            if entry.etag in if_none_match:
+                await self._send(send, 304, entry, b"")
+            else:
+                await self._send(send, 200, entry, entry.body)
+            return
+
+        start: Dict = {}
+        parts = []
+
+        async def capture(message):
+            # Buffered so the ETag can go in the headers; these bodies are small JSON lists
+            if message["type"] == "http.response.start":
+                start.update(message)
+                return
+            parts.append(message.get("body", b""))
+            if message.get("more_body"):
+                return
+            body = b"".join(parts)
+            if start["status"] != 200:
+                await send(start)
+                await send({"type": "http.response.body", "body": body})
+                return
+            content_type = dict(start["headers"]).get(b"content-type", b"application/json")
+            entry = cache.store(key, body, content_type)
+            # A sync that changed nothing this client sees still ends in a 304
+            if entry.etag in if_none_match:
+                await self._send(send, 304, entry, b"", cached=False)
+            else:
+                await self._send(send, 200, entry, body, cached=False)
+
+        await self.app(scope, receive, capture)
+
+    async def _send(self, send, status: int, entry: CachedResponse, body: bytes, cached: bool = True):
+        headers = [
+            (b"etag", entry.etag.encode()),
+            (b"cache-control", b"private, no-cache"),
+            (b"x-cache", b"hit" if cached else b"miss"),
+        ]
+        if status == 200:
+            headers += [(b"content-type", entry.content_type), (b"content-length", str(len(body)).encode())]
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        await send({"type": "http.response.body", "body": body})
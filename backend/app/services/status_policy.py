@@ -0,0 +1,26 @@
+from datetime import datetime, timedelta
+from app.config import settings
+
+# Submission-status refresh tiers
+TIER_URGENT = "urgent"  # not submitted, due within the next few days - polled by its own job
+TIER_CLOSED = "closed"  # graded, or due date long past - refreshed rarely
+TIER_NORMAL = "normal"  # everything else - refreshed on every sync
+
+def status_tier(submitted: bool, grade, due_date, now: datetime) -> str:
+    """Classify an assignment by how likely its submission status is to change"""
+    if grade:
+        return TIER_CLOSED
+    if due_date is not None:
+        if due_date < now - timedelta(days=settings.status_closed_after_days):
+            return TIER_CLOSED
+        if not submitted and now <= due_date <= now + timedelta(days=settings.status_urgent_window_days):
+            return TIER_URGENT
+    return TIER_NORMAL
+
+def status_refresh_due(submitted: bool, grade, due_date, checked_at, now: datetime) -> bool:
+    """Whether a regular sync should re-fetch this assignment's submission status"""
+    if checked_at is None:
+        return True
+    if status_tier(submitted, grade, due_date, now) == TIER_CLOSED:
+        return now - checked_at >= timedelta(hours=settings.status_closed_refresh_hours)
+    return True
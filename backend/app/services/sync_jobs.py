@@ -0,0 +1,455 @@
+import asyncio
+import contextlib
+import json
+import traceback
+import uuid
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional
+from sqlalchemy import update
+from app.config import settings
+from app.database import AsyncSessionLocal
+from app.models.job import Job
+from app.models.user import MoodleUser
+from app.services import job_queue
+from app.services.course_zips import request_zip_prebuild
+from app.services.job_queue import job_handler
+from app.services.prefetch import request_prefetch
+from app.services.response_cache import invalidate_responses
+from app.services.sync_service import SyncService
+from app.services.sync_lock import LeaseLock, LockNotAcquired, SCHEDULED_SYNC_LOCK, URGENT_REFRESH_LOCK, user_sync_lock
+from app.services.users import get_sync_users
+
+# Keep this many finished jobs around so late SSE subscribers can still read the outcome
+MAX_FINISHED_JOBS = 20
+FINAL_EVENTS = ("done", "error")
+
+def make_event(event: str, **data) -> dict:
+    return {"event": event, "time": datetime.utcnow().isoformat(), **data}
+
+class SyncJob:
+    """A sync running in the background, with an event log that SSE clients can follow"""
+
+    def __init__(self, trigger: str, full: bool, user_id: Optional[int] = None):
+        self.id = uuid.uuid4().hex
+        self.trigger = trigger
+        self.full = full
+        self.user_id = user_id  # None = every enabled user
+        self.status = "running"
+        self.error: Optional[str] = None
+        self.started_at = datetime.utcnow()
+        self.finished_at: Optional[datetime] = None
+        self.events: List[dict] = []
+        self._subscribers: List[asyncio.Queue] = []
+        self._done = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    def publish(self, event: str, **data):
+        entry = make_event(event, **data)
+        self.events.append(entry)
+        for queue in self._subscribers:
+            queue.put_nowait(entry)
+
+    async def subscribe(self):
+        """Yield past events, then live ones until the job finishes"""
+        queue: asyncio.Queue = asyncio.Queue()
+        self._subscribers.append(queue)
+        # Events published from here on land in the queue, so the snapshot and
+        # the queue never overlap
+        backlog = list(self.events)
+        try:
+            for entry in backlog:
+                yield entry
+                if entry["event"] in FINAL_EVENTS:
+                    return
+            while True:
+                entry = await queue.get()
+                yield entry
+                if entry["event"] in FINAL_EVENTS:
+                    return
+        finally:
+            self._subscribers.remove(queue)
+
+    @property
+    def finished(self) -> bool:
+        return self._done.is_set()
+
+    async def wait(self):
+        await self._done.wait()
+        if self.status == "failed":
+            raise Exception(self.error)
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.id,
+            "trigger": self.trigger,
+            "full": self.full,
+            "user_id": self.user_id,
+            "status": self.status,
+            "error": self.error,
+            "started_at": self.started_at.isoformat(),
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+            "progress": self.events[-1] if self.events else None
+        }
+
+class QueuedSyncJob:
+    """
+    API-side view of a sync job running in a worker process (see app.worker).
+
+    A cohort sync job only fans out into per-user jobs (dispatch_user_syncs)
+    and completes right away; this view follows those jobs and finishes, with
+    the same per-user results as an in-process SyncJob, once they all have.
+    """
+
+    def __init__(self, job: Job):
+        self.job = job
+        self.id = str(job.id)
+        self.children: List[Job] = []
+
+    @property
+    def fans_out(self) -> bool:
+        return (self.job.payload or {}).get("user_id") is None
+
+    @property
+    def child_ids(self) -> List[int]:
+        if self.job.status != "done":
+            return []
+        return (self.job.result or {}).get("jobs") or []
+
+    @staticmethod
+    def _job_status(job: Job) -> str:
+        status = job.status
+        if status == "done" and (job.result or {}).get("skipped"):
+            return "skipped"
+        return {"done": "success", "dead": "failed"}.get(status, status)
+
+    def user_results(self) -> dict:
+        return {
+            (child.payload or {}).get("user_id"): {"status": self._job_status(child), "error": child.last_error}
+            for child in self.children
+        }
+
+    @property
+    def status(self) -> str:
+        if not self.child_ids:
+            return self._job_status(self.job)
+        if not self.finished:
+            return "running"
+        statuses = [result["status"] for result in self.user_results().values()]
+        if all(status == "failed" for status in statuses):
+            return "failed"
+        if all(status == "skipped" for status in statuses):
+            return "skipped"
+        return "success"
+
+    @property
+    def error(self) -> Optional[str]:
+        if self.child_ids:
+            errors = [result["error"] for result in self.user_results().values() if result["status"] == "failed"]
+            return errors[0] if self.status == "failed" and errors else None
+        return self.job.last_error
+
+    @property
+    def finished(self) -> bool:
+        if self.job.status not in ("done", "dead"):
+            return False
+        ids = self.child_ids
+        return len(self.children) == len(ids) and all(child.status in ("done", "dead") for child in self.children)
+
+    async def refresh(self):
+        job = await job_queue.get_job(self.job.id)
+        if job is not None:
+            self.job = job
+        if self.child_ids:
+            self.children = await job_queue.get_jobs(self.child_ids)
+
+    async def subscribe(self):
+        """Poll the job row (and a cohort's per-user jobs) and yield the progress events workers persisted"""
+        seen = 0
+        held_done = None
+        while True:
+            events = self.job.events or []
+            for entry in events[seen:]:
+                if entry["event"] == "done" and self.fans_out:
+                    # The fan-out finished, the syncs it queued have not
+                    held_done = entry
+                    continue
+                yield entry
+                if entry["event"] in FINAL_EVENTS:
+                    return
+            seen = len(events)
+            if self.job.status in ("done", "dead"):
+                break
+            await asyncio.sleep(settings.worker_poll_interval / 5)
+            await self.refresh()
+
+        if not self.child_ids:
+            if held_done is not None:
+                yield held_done
+            return
+
+        reported = set()
+        while True:
+            for child in self.children:
+                if child.status in ("done", "dead") and child.id not in reported:
+                    reported.add(child.id)
+                    user_id = (child.payload or {}).get("user_id")
+                    yield make_event("user", user_id=user_id, **self.user_results()[user_id])
+            if self.finished:
+                break
+            await asyncio.sleep(settings.worker_poll_interval / 5)
+            await self.refresh()
+
+        if self.status == "failed":
+            yield make_event("error", status="failed", detail=f"Sync failed: {self.error}")
+        else:
+            yield make_event("done", status=self.status, users=self.user_results())
+
+    async def wait(self):
+        await self.refresh()
+        while not self.finished:
+            await asyncio.sleep(settings.worker_poll_interval)
+            await self.refresh()
+        if self.status == "failed":
+            raise Exception(self.error)
+
+    def to_dict(self) -> dict:
+        payload = self.job.payload or {}
+        events = self.job.events or []
+        finished_at = [job.finished_at for job in [self.job, *self.children] if job.finished_at]
+        return {
+            "job_id": self.id,
+            "trigger": payload.get("trigger"),
+            "full": payload.get("full", False),
+            "user_id": payload.get("user_id"),
+            "status": self.status,
+            "error": self.error,
+            "attempts": self.job.attempts,
+            "jobs": self.child_ids,
+            "started_at": self.job.locked_at.isoformat() if self.job.locked_at else None,
+            "finished_at": max(finished_at).isoformat() if self.finished and finished_at else None,
+            "progress": events[-1] if events else None
+        }
+
+class SyncJobManager:
+    """Single-flight sync runner: concurrent triggers for the same user(s) join the in-flight job"""
+
+    def __init__(self):
+        self.jobs: Dict[str, SyncJob] = {}
+        # In-flight job per scope: a user id, or "all" for a cohort sync
+        self.current: Dict[object, SyncJob] = {}
+
+    async def start(self, trigger: str = "manual", full: bool = False, user_id: Optional[int] = None):
+        """
+        Start a sync of one user, or of every enabled user when user_id is None,
+        or return the job already running for it. Returns (job, coalesced).
+        """
+        if settings.job_queue_enabled:
+            # Hand the sync to a worker; the dedupe key coalesces across API processes
+            job_id, created = await job_queue.enqueue(
+                "sync", {"trigger": trigger, "full": full, "user_id": user_id},
+                dedupe_key="sync" if user_id is None else f"sync:{user_id}"
+            )
+            job = QueuedSyncJob(await job_queue.get_job(job_id))
+            await job.refresh()
+            return job, not created
+
+        scope = "all" if user_id is None else user_id
+        current = self.current.get(scope)
+        if current is not None and not current.finished:
+            return current, True
+
+        job = SyncJob(trigger, full, user_id)
+        self.jobs[job.id] = job
+        self.current[scope] = job
+        job.task = asyncio.create_task(self._run(job))
+        self._prune()
+        return job, False
+
+    async def get(self, job_id: str):
+        if job_id in self.jobs:
+            return self.jobs[job_id]
+        if settings.job_queue_enabled and job_id.isdigit():
+            job = await job_queue.get_job(int(job_id))
+            if job is not None and job.kind == "sync":
+                queued = QueuedSyncJob(job)
+                await queued.refresh()
+                return queued
+        return None
+
+    async def _run(self, job: SyncJob):
+        job.publish("started", trigger=job.trigger, full=job.full, user_id=job.user_id)
+        try:
+            async with AsyncSessionLocal() as db:
+                user_ids = [user.id for user in await get_sync_users(db, job.user_id)]
+            if not user_ids:
+                raise Exception("No enabled Moodle users to sync")
+            scheduled = job.trigger == "scheduled"
+            # Per-user leases only keep a user's syncs from overlapping; without
+            # this one every replica would sync the whole cohort on schedule
+            cohort = contextlib.nullcontext()
+            if scheduled and job.user_id is None:
+                cohort = LeaseLock(SCHEDULED_SYNC_LOCK).hold()
+            async with cohort:
+                # Scheduled cohort runs are staggered over the sync window
+                results = await sync_users(user_ids, job.full, job.trigger, job.publish, spread=scheduled)
+            failed = [r["error"] for r in results.values() if r["status"] == "failed"]
+            if len(failed) == len(user_ids):
+                raise Exception(failed[0])
+            if all(r["status"] == "skipped" for r in results.values()):
+                job.status = "skipped"
+                job.publish("done", status="skipped", detail="Sync already running")
+            else:
+                job.status = "success"
+                job.publish("done", status="success", users=results)
+        except LockNotAcquired as e:
+            print(f"[SYNC] Skipped scheduled sync: {e}")
+            job.status = "skipped"
+            job.publish("done", status="skipped", detail="Scheduled sync already running on another replica")
+        except asyncio.CancelledError:
+            job.status = "failed"
+            job.error = "Sync cancelled (lock lost or shutdown)"
+            job.publish("error", status="failed", detail=job.error)
+        except Exception as e:
+            print(f"[SYNC ERROR] {type(e).__name__}: {e}")
+            job.status = "failed"
+            job.error = f"Sync failed: {e}"
+            job.publish("error", status="failed", detail=job.error)
+        finally:
+            job.finished_at = datetime.utcnow()
+            job._done.set()
+
+    def _prune(self):
+        finished = [j for j in self.jobs.values() if j.finished]
+        for job in sorted(finished, key=lambda j: j.started_at)[:-MAX_FINISHED_JOBS]:
+            del self.jobs[job.id]
+
+async def sync_user(user_id: int, full: bool = False, trigger: str = "manual",
+                    progress: Optional[Callable] = None) -> dict:
+    """Sync one user under their own lease. Returns {"status", "error"}; failures are not raised."""
+    status, error = "failed", None
+    try:
+        # Each sync owns its session; it must not borrow a request-scoped one
+        async with AsyncSessionLocal() as db:
+            user = await db.get(MoodleUser, user_id)
+            if user is None:
+                raise Exception(f"Moodle user {user_id} not found")
+            sync_service = SyncService(db, user, progress=progress)
+            async with LeaseLock(user_sync_lock(user_id)).hold():
+                await sync_service.sync_all(full=full, trigger=trigger)
+        status = "success"
+        await request_prefetch()
+        await request_zip_prebuild(user_id)
+    except LockNotAcquired as e:
+        print(f"[SYNC] Skipped user {user_id}: {e}")
+        return {"status": "skipped", "error": f"Sync already running ({e.holder})"}
+    except Exception as e:
+        print(f"[SYNC ERROR] User {user_id}: {type(e).__name__}: {e}")
+        traceback.print_exc()
+        error = f"{type(e).__name__}: {e}"
+
+    try:
+        async with AsyncSessionLocal() as db:
+            await db.execute(
+                update(MoodleUser).where(MoodleUser.id == user_id)
+                .values(last_synced_at=datetime.utcnow(), last_sync_status=status)
+            )
+            await db.commit()
+    except Exception as e:
+        print(f"[ERROR] Could not record sync of user {user_id}: {e}")
+    return {"status": status, "error": error}
+
+async def sync_users(user_ids: List[int], full: bool, trigger: str, publish: Callable, spread: bool = False) -> dict:
+    """
+    Sync several users, at most settings.sync_user_concurrency at a time.
+
+    user_ids should be ordered least recently synced first. With spread=True the
+    start times are staggered evenly across settings.sync_window_minutes, so a
+    cohort does not hit Moodle all at once. Users sharing a course share its
+    contents fetch (see SyncService._claim_course_contents).
+    """
+    spacing = settings.sync_window_minutes * 60 / len(user_ids) if spread and user_ids else 0
+    gate = asyncio.Semaphore(settings.sync_user_concurrency)
+    results = {}
+
+    async def run(index: int, user_id: int):
+        if spacing:
+            await asyncio.sleep(index * spacing)
+        async with gate:
+            def progress(event: str, **data):
+                publish(event, user_id=user_id, **data)
+            try:
+                results[user_id] = await sync_user(user_id, full, trigger, progress)
+            except asyncio.CancelledError:
+                # Lost this user's lease; the other users carry on
+                results[user_id] = {"status": "failed", "error": "Sync cancelled (lock lost or shutdown)"}
+                raise
+            finally:
+                if user_id in results:
+                    publish("user", user_id=user_id, **results[user_id])
+
+    await asyncio.gather(*[run(i, uid) for i, uid in enumerate(user_ids)], return_exceptions=True)
+    return results
+
+async def refresh_urgent_statuses_all() -> int:
+    """Urgent submission-status poll for every enabled user"""
+    async with AsyncSessionLocal() as db:
+        user_ids = [user.id for user in await get_sync_users(db)]
+    changed = 0
+    for user_id in user_ids:
+        async with AsyncSessionLocal() as db:
+            try:
+                user = await db.get(MoodleUser, user_id)
+                changed += await SyncService(db, user).refresh_urgent_statuses()
+            except Exception as e:
+                print(f"[ERROR] Urgent status refresh for user {user_id} failed: {type(e).__name__}: {e}")
+    if changed:
+        await invalidate_responses()
+    return changed
+
+async def dispatch_user_syncs(full: bool, trigger: str, report: Callable) -> dict:
+    """Queue one sync job per user so the worker pool shards the cohort between workers"""
+    async with AsyncSessionLocal() as db:
+        user_ids = [user.id for user in await get_sync_users(db)]
+    spacing = settings.sync_window_minutes * 60 / len(user_ids) if trigger == "scheduled" and user_ids else 0
+    now = datetime.utcnow()
+    queued = 0
+    job_ids = []
+    for index, user_id in enumerate(user_ids):
+        job_id, created = await job_queue.enqueue(
+            "sync", {"trigger": trigger, "full": full, "user_id": user_id},
+            dedupe_key=f"sync:{user_id}", run_after=now + timedelta(seconds=index * spacing)
+        )
+        queued += created
+        # A user whose sync was already queued is followed through that job
+        job_ids.append(job_id)
+    report("dispatched", users=len(user_ids), queued=queued)
+    print(f"[SYNC] Queued {queued} user syncs over {spacing * len(user_ids) / 60:.0f} minutes")
+    return {"users": len(user_ids), "queued": queued, "jobs": job_ids}
+
+@job_handler("sync")
+async def run_sync_job(job: Job, report):
+    """Worker handler: sync one user, or fan a cohort sync out into per-user jobs"""
+    payload = job.payload or {}
+    full, trigger = payload.get("full", False), payload.get("trigger", "queued")
+    if payload.get("user_id") is None:
+        return await dispatch_user_syncs(full, trigger, report)
+
+    result = await sync_user(payload["user_id"], full, trigger, progress=report)
+    if result["status"] == "failed":
+        # Let the queue retry with backoff
+        raise Exception(result["error"])
+    return {"skipped": result["status"] == "skipped", "detail": result["error"], "user_id": payload["user_id"]}
+
+@job_handler("urgent_refresh")
+async def run_urgent_refresh_job(job: Job, report):
+    try:
+        async with LeaseLock(URGENT_REFRESH_LOCK).hold():
+            changed = await refresh_urgent_statuses_all()
+    except LockNotAcquired:
+        return {"skipped": True}
+    return {"changed": changed}
+
+def format_sse(entry: dict) -> str:
+    return f"event: {entry['event']}\ndata: {json.dumps(entry)}\n\n"
+
+sync_jobs = SyncJobManager()
@@ -0,0 +1,147 @@
+import asyncio
+import os
+import socket
+import uuid
+from contextlib import asynccontextmanager
+from datetime import timedelta
+from typing import Optional
+from sqlalchemy import select, delete, update, func
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from app.config import settings
+from app.database import AsyncSessionLocal
+from app.models.sync_lock import SyncLock
+
+# Identifies this process in the sync_locks table
+PROCESS_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+SYNC_LOCK = "moodle_sync"
+URGENT_REFRESH_LOCK = "urgent_status_refresh"
+PREFETCH_LOCK = "file_prefetch"
+
+# Scheduled cohort run in in-process mode: the schedulers of all replicas fire,
+# one of them syncs the cohort
+SCHEDULED_SYNC_LOCK = f"{SYNC_LOCK}:scheduled"
+
+def user_sync_lock(user_id: int) -> str:
+    """Per-user sync lease: different users sync in parallel, the same user never twice"""
+    return f"{SYNC_LOCK}:user:{user_id}"
+
+def _db_now():
+    # Database clock in naive UTC, so all replicas agree on lease expiry
+    return func.timezone('utc', func.now())
+
+class LockNotAcquired(Exception):
+    """Another process holds the lease"""
+
+    def __init__(self, name: str, holder: Optional[str]):
+        super().__init__(f"{name} is held by {holder or 'another process'}")
+        self.holder = holder
+
+class LeaseLock:
+    """
+    Cross-process lease stored in PostgreSQL.
+
+    The holder renews the lease every ttl/3 seconds; if it dies the lease expires
+    and the next process to try takes it over. Every instance is its own
+    holder, so a lease is not re-entrant, not even within one process.
+    """
+
+    def __init__(self, name: str, ttl: Optional[int] = None):
+        self.name = name
+        self.ttl = ttl or settings.sync_lock_ttl_seconds
+        self.holder = f"{PROCESS_ID}:{uuid.uuid4().hex[:8]}"
+
+    async def acquire(self) -> bool:
+        expires = _db_now() + timedelta(seconds=self.ttl)
+        table = SyncLock.__table__
+        stmt = pg_insert(table).values(
+            name=self.name, holder=self.holder, acquired_at=_db_now(), expires_at=expires
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c.name],
+            set_={"holder": self.holder, "acquired_at": _db_now(), "expires_at": expires},
+            where=table.c.expires_at < _db_now(),
+        ).returning(table.c.holder)
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(stmt)
+            acquired = result.scalar() == self.holder
+            await db.commit()
+        return acquired
+
+    async def renew(self) -> bool:
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(
+                update(SyncLock)
+                .where(SyncLock.name == self.name, SyncLock.holder == self.holder)
+                .values(expires_at=_db_now() + timedelta(seconds=self.ttl))
+            )
+            await db.commit()
+            return result.rowcount == 1
+
+    async def release(self):
+        async with AsyncSessionLocal() as db:
+            await db.execute(
+                delete(SyncLock).where(SyncLock.name == self.name, SyncLock.holder == self.holder)
+            )
+            await db.commit()
+
+    @asynccontextmanager
+    async def hold(self):
+        """Hold the lease for the duration of the block, renewing it in the background"""
+        if not await self.acquire():
+            raise LockNotAcquired(self.name, (await lock_holder(self.name) or {}).get("holder"))
+
+        owner = asyncio.current_task()
+
+        async def keep_alive():
+            while True:
+                await asyncio.sleep(self.ttl / 3)
+                try:
+                    renewed = await self.renew()
+                except Exception as e:
+                    print(f"[LOCK] Renewing {self.name} failed: {e}")
+                    continue
+                if not renewed:
+                    # Someone took over after our lease expired - stop working on stale authority
+                    print(f"[LOCK] Lost {self.name} lease, cancelling")
+                    owner.cancel()
+                    return
+
+        renewer = asyncio.create_task(keep_alive())
+        try:
+            yield
+        finally:
+            renewer.cancel()
+            try:
+                await self.release()
+            except Exception as e:
+                print(f"[LOCK] Releasing {self.name} failed: {e}")
+
+async def lock_holder(name: str) -> Optional[dict]:
+    """Current lease on a lock, or None if it is free or expired"""
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(
+            select(SyncLock).where(SyncLock.name == name, SyncLock.expires_at >= _db_now())
+        )
+        lock = result.scalar_one_or_none()
+    if not lock:
+        return None
+    return _describe(lock)
+
+async def held_locks(prefix: str) -> list:
+    """Live leases whose name starts with prefix"""
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(
+            select(SyncLock)
+            .where(SyncLock.name.startswith(prefix), SyncLock.expires_at >= _db_now())
+            .order_by(SyncLock.name)
+        )
+        return [{"name": lock.name, **_describe(lock)} for lock in result.scalars().all()]
+
+def _describe(lock: SyncLock) -> dict:
+    return {
+        "holder": lock.holder,
+        "this_process": lock.holder.startswith(f"{PROCESS_ID}:"),
+        "acquired_at": lock.acquired_at.isoformat(),
+        "expires_at": lock.expires_at.isoformat()
+    }
@@ -1,36 +1,501 @@
 import asyncio
+import hashlib
+import json
+import time
+from contextlib import contextmanager
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
+from sqlalchemy import select, update, delete, func, tuple_
+from app.config import settings
+from app.database import AsyncSessionLocal
 from app.services.moodle_client import MoodleClient
-from app.models.course import Course
-from app.models.assignment import Assignment
-from app.models.resource import Resource
-from datetime import datetime, timezone
+from app.services.bulk_upsert import bulk_upsert
+from app.services.contents_stream import MoodleAPIError
+from app.services.resource_staging import ResourceStager
+from app.services.rate_limiter import CircuitOpenError
+from app.services.response_cache import invalidate_responses
+from app.services.status_policy import status_refresh_due, status_tier, TIER_URGENT
+from app.models.course import Course, UserCourse
+from app.models.assignment import Assignment, UserAssignment
+from app.models.sync_state import CourseSyncState
+from app.models.grade import GradeItem
+from app.models.sync_run import SyncRun
+from app.models.user import MoodleUser
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, Optional
+
+def _from_timestamp(value):
+    if not value:
+        return None
+    return datetime.fromtimestamp(value, tz=timezone.utc).replace(tzinfo=None)
+
+# Fields that change without the underlying course material changing
+# (per-user completion/visibility state, rendered HTML helpers, access times)
+VOLATILE_FIELDS = {
+    'completiondata', 'completion', 'dates', 'uservisible', 'availabilityinfo',
+    'onclick', 'afterlink', 'noviewlink', 'lastaccess', 'timeaccess', 'course_id',
+}
+
+def _normalize_payload(value):
+    if isinstance(value, dict):
+        return {k: _normalize_payload(v) for k, v in value.items() if k not in VOLATILE_FIELDS}
+    if isinstance(value, list):
+        return [_normalize_payload(v) for v in value]
+    return value
+
+def payload_fingerprint(payload) -> str:
+    """Stable hash of a parsed Moodle payload, independent of key order and volatile fields"""
+    normalized = json.dumps(_normalize_payload(payload), sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(normalized.encode()).hexdigest()
+
+class _StreamFingerprint:
+    """payload_fingerprint computed incrementally over streamed file records"""
+
+    def __init__(self):
+        self._hash = hashlib.sha256()
+
+    def update(self, record: dict):
+        normalized = json.dumps(_normalize_payload(record), sort_keys=True, separators=(',', ':'))
+        self._hash.update(normalized.encode())
+        self._hash.update(b'\n')
+
+    def hexdigest(self) -> str:
+        return self._hash.hexdigest()
+
+# course id -> future of the sync currently streaming that course's contents,
+# resolved True once they are committed (False if that sync gave up). Concurrent
+# syncs of users who share a course wait for it instead of repeating the request.
+_contents_inflight: Dict[int, asyncio.Future] = {}
+
+def _clean_grade(value):
+    """Normalize a formatted Moodle grade; '-' means not graded"""
+    if not value:
+        return None
+    value = value.replace('&nbsp;', ' ').strip()
+    return None if value in ('', '-') else value
 
 class SyncService:
-    def __init__(self, db: AsyncSession):
+    """
+    Syncs one Moodle user.
+
+    Course-level data (courses, resources, assignment definitions) is shared by
+    every user enrolled in the course; enrollments, submission statuses and
+    gradebook items are stored per user.
+    """
+
+    def __init__(self, db: AsyncSession, user: MoodleUser, progress: Optional[Callable] = None):
         self.db = db
-        self.moodle = MoodleClient()
+        self.user = user
+        # Optional callback(event, **data) for live progress (see sync_jobs)
+        self.progress = progress
+        self.moodle = MoodleClient(user.token, user.moodle_user_id)
+        self._stored_assignments = {}
+        self._sync_states = {}
+        self._enrollments = {}
+        # course id -> time of the newest module update reported by Moodle
+        self._latest_updates = {}
+        self._assignment_hashes = {}
+        # cmid -> display grade, for courses whose gradebook was fetched this run
+        self._gradebook_grades = {}
+        self._gradebook_courses = set()
+        # Per-course fingerprint outcome of the last run: {"contents": "hit"/"miss", "assignments": ...}
+        self.fingerprint_stats = {}
+        # Metrics for the sync_runs ledger
+        self.run_stats = {"phases": {}, "rows": {}, "errors": []}
+        # Completed phases and courses whose contents were committed; a retry of
+        # a failed run starts from its checkpoint
+        self.checkpoint = {"phases": [], "courses": []}
+        self._run_id = None
+        self._courses = {}
+        self._changes = {}
+        # Courses whose contents Moodle refused this run; their watermark stays put
+        self._unavailable_courses = set()
+        self._sync_started = None
+        # course id -> _contents_inflight future this sync owns
+        self._owned_fetches = {}
+
+    async def sync_all(self, full: bool = False, trigger: str = "manual"):
+        """
+        Run a sync and record it in the sync_runs ledger.
+
+        The ledger entry is written through its own session so a failed (rolled
+        back) sync still leaves a record of what happened, including the
+        checkpoint the next attempt resumes from.
+        """
+        full = full or not settings.sync_incremental
+        run_id = self._run_id = await self._start_run(trigger, full)
+        started = time.monotonic()
+        status, error = "failed", None
+        try:
+            await self._run_sync(full)
+            status = "success"
+        except BaseException as e:
+            error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            await self._finish_run(run_id, status, error, time.monotonic() - started)
+            # Even a failed sync may have committed some courses
+            await invalidate_responses()
+
+    async def _start_run(self, trigger: str, full: bool):
+        mode = "full" if full else "incremental"
+        try:
+            async with AsyncSessionLocal() as ledger:
+                previous = await self._find_resumable_run(ledger, mode)
+                run = SyncRun(
+                    trigger=trigger, user_id=self.user.id, mode=mode, status="running",
+                    resumed_from=previous.id if previous else None,
+                )
+                if previous is not None:
+                    self.checkpoint = {
+                        "phases": list(previous.checkpoint.get("phases", [])),
+                        "courses": list(previous.checkpoint.get("courses", [])),
+                    }
+                    run.checkpoint = self.checkpoint
+                    if previous.status == "running":
+                        # Its process died - we hold the user's lease, so nobody else is running it
+                        previous.status = "failed"
+                        previous.error = "Interrupted"
+                    print(f"[DEBUG] Resuming sync run {previous.id}: phases {self.checkpoint['phases']}, "
+                          f"{len(self.checkpoint['courses'])} courses already committed")
+                ledger.add(run)
+                await ledger.commit()
+                return run.id
+        except Exception as e:
+            print(f"[ERROR] Could not record sync run: {e}")
+            return None
+
+    async def _find_resumable_run(self, ledger: AsyncSession, mode: str):
+        """The user's latest run, if it failed recently with progress worth keeping"""
+        result = await ledger.execute(
+            select(SyncRun)
+            .where(SyncRun.user_id == self.user.id)
+            .order_by(SyncRun.started_at.desc())
+            .limit(1)
+        )
+        previous = result.scalar_one_or_none()
+        if previous is None or previous.status not in ("failed", "running") or previous.mode != mode:
+            return None
+        checkpoint = previous.checkpoint or {}
+        if not (checkpoint.get("phases") or checkpoint.get("courses")):
+            return None
+        if previous.started_at < datetime.utcnow() - timedelta(hours=settings.sync_resume_window_hours):
+            return None
+        return previous
+
+    async def _save_checkpoint(self, phase: str = None, course_id: int = None):
+        """Record committed progress in the ledger (own session, survives a failed run)"""
+        if phase is not None and phase not in self.checkpoint["phases"]:
+            self.checkpoint["phases"].append(phase)
+        if course_id is not None and course_id not in self.checkpoint["courses"]:
+            self.checkpoint["courses"].append(course_id)
+        if self._run_id is None:
+            return
+        try:
+            async with AsyncSessionLocal() as ledger:
+                await ledger.execute(
+                    update(SyncRun).where(SyncRun.id == self._run_id).values(checkpoint=self.checkpoint)
+                )
+                await ledger.commit()
+        except Exception as e:
+            print(f"[ERROR] Could not save checkpoint of sync run {self._run_id}: {e}")
+
+    async def _commit(self):
+        """Commit and drop the identity map so memory does not grow with the catalog"""
+        await self.db.commit()
+        self.db.expunge_all()
+
+    async def _finish_run(self, run_id, status: str, error, duration: float):
+        print(f"[DEBUG] Sync of user {self.user.id} {status} in {duration:.1f}s, phases: {self.run_stats['phases']}")
+        if run_id is None:
+            return
+        try:
+            async with AsyncSessionLocal() as ledger:
+                await ledger.execute(
+                    update(SyncRun).where(SyncRun.id == run_id).values(
+                        status=status,
+                        finished_at=datetime.utcnow(),
+                        duration=round(duration, 3),
+                        phase_timings=self.run_stats['phases'],
+                        moodle_calls=dict(self.moodle.call_counts),
+                        response_bytes=self.moodle.response_bytes,
+                        rows=self.run_stats['rows'],
+                        errors=self.run_stats['errors'][:100],
+                        error=error,
+                    )
+                )
+                await ledger.commit()
+        except Exception as e:
+            print(f"[ERROR] Could not record sync run {run_id}: {e}")
 
-    async def sync_all(self):
-        """Main sync function - fetches and updates all data"""
-        print(f"[{datetime.now()}] Starting sync...")
+    @contextmanager
+    def _phase(self, name: str):
+        """Accumulate wall-clock time spent in a sync phase (phases may overlap)"""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            phases = self.run_stats['phases']
+            phases[name] = round(phases.get(name, 0) + time.monotonic() - started, 3)
+
+    def _record_rows(self, stage: str, inserted: int, updated: int, **counts):
+        self.run_stats['rows'][stage] = {"inserted": inserted, "updated": updated, **counts}
+
+    def _emit(self, event: str, **data):
+        if self.progress is not None:
+            self.progress(event, **data)
+
+    def _record_error(self, message: str):
+        self.run_stats['errors'].append(message)
+
+    async def _run_sync(self, full: bool):
+        """
+        Main sync function - fetches and updates all data.
+
+        In incremental mode (the default when settings.sync_incremental is on),
+        courses whose watermark shows no change since the user's last sync are
+        skipped and only assignments in changed courses get their submission
+        status refreshed. full=True, or a course whose last full refresh is older
+        than settings.sync_full_resync_hours, forces a complete refetch.
+
+        Course contents that another user's sync already fetched after the last
+        reported change are reused rather than fetched again.
+
+        Work is committed per phase and per course, and recorded in the run's
+        checkpoint: a retry of a failed run skips courses and phases that
+        already made it to the database.
+        """
+        sync_started = self._sync_started = datetime.utcnow()
+        print(f"[{datetime.now()}] Starting {'full' if full else 'incremental'} sync for user {self.user.id}...")
 
         # 1. Sync courses
-        courses = await self.moodle.get_user_courses()
+        with self._phase("courses"):
+            courses = await self.moodle.get_user_courses()
 
-        # Check for Moodle API error
-        if isinstance(courses, dict) and 'exception' in courses:
-            error_msg = courses.get('message', 'Unknown Moodle API error')
-            raise Exception(f"Moodle API error: {error_msg}")
+            # Check for Moodle API error
+            if isinstance(courses, dict) and 'exception' in courses:
+                error_msg = courses.get('message', 'Unknown Moodle API error')
+                raise Exception(f"Moodle API error: {error_msg}")
 
-        print(f"[DEBUG] Fetched {len(courses)} courses")
-        await self._sync_courses(courses)
+            print(f"[DEBUG] Fetched {len(courses)} courses")
+            self._record_rows("courses", *await self._sync_courses(courses))
+            await self._sync_enrollments(courses)
+            await self._commit()
+        await self._save_checkpoint(phase="courses")
+        self._emit("courses", courses=len(courses))
+        self._courses = {c['id']: c for c in courses}
 
-        # 2. Sync assignments
         course_ids = [c['id'] for c in courses]
         print(f"[DEBUG] Course IDs: {course_ids}")
-        assignments_data = await self.moodle.get_assignments(course_ids)
+
+        # Decide which courses need a refresh
+        with self._phase("change_detection"):
+            states = await self._load_sync_states(course_ids)
+            self._sync_states = states
+            self._enrollments = await self._load_enrollments()
+            self._stored_assignments = await self._load_stored_assignments()
+            changes = self._changes = await self._detect_course_changes(courses, states, sync_started, full)
+        changed_ids = [cid for cid in course_ids if changes[cid] is not False]
+        content_ids = [cid for cid in changed_ids if self._needs_contents(cid, changes[cid], sync_started, full)]
+        shared = len(changed_ids) - len(content_ids)
+        print(f"[DEBUG] {len(changed_ids)}/{len(course_ids)} courses changed since last sync, {shared} already refreshed by other users")
+        self._emit("changes", changed=len(changed_ids), total=len(course_ids), shared=shared)
+
+        # Courses committed by the failed run this one resumes
+        committed = set(self.checkpoint["courses"])
+        fetch_ids = [cid for cid in content_ids if cid not in committed]
+        if len(fetch_ids) < len(content_ids):
+            print(f"[DEBUG] Resuming: contents of {len(content_ids) - len(fetch_ids)} courses already committed")
+        grades_done = "grades" in self.checkpoint["phases"]
+        assignments_done = "assignments" in self.checkpoint["phases"]
+
+        # 2. Fetch assignments and their submission statuses in the background,
+        # overlapping with the course-contents pipeline below
+        assignments_task = None if assignments_done else asyncio.create_task(self._fetch_assignments(course_ids, changes))
+        grades_task = None if grades_done else asyncio.create_task(self._fetch_grades(changed_ids))
+        background = [task for task in (assignments_task, grades_task) if task is not None]
+
+        # 3. Sync resources (files), committing course by course
+        try:
+            with self._phase("contents"):
+                resources, content_hashes = await self._sync_all_resources(fetch_ids)
+        except BaseException:
+            for task in background:
+                task.cancel()
+            raise
+        print(f"[DEBUG] Resources: {resources['inserted']} inserted, {resources['updated']} updated, {resources['missing']} no longer in Moodle")
+        self._record_rows("resources", **resources)
+        hits = sum(1 for stats in self.fingerprint_stats.values() if stats.get('contents') == 'hit')
+        print(f"[DEBUG] Fingerprints: {hits}/{len(content_hashes)} fetched courses unchanged, DB reconciliation skipped")
+
+        with self._phase("db_write"):
+            try:
+                if grades_done:
+                    await self._load_gradebook_grades(changed_ids)
+                else:
+                    self._record_rows("grade_items", *await self._sync_grades(await grades_task))
+                    await self._commit()
+                    await self._save_checkpoint(phase="grades")
+            except BaseException:
+                if assignments_task is not None:
+                    assignments_task.cancel()
+                raise
+
+            if not assignments_done:
+                assignments_data, statuses = await assignments_task
+                self._record_rows("assignments", *await self._sync_assignments(assignments_data, statuses))
+                await self._save_assignment_hashes()
+                await self._commit()
+                await self._save_checkpoint(phase="assignments")
+                self._emit("assignments", rows=self.run_stats['rows']['assignments'])
+
+            await self._save_sync_states(changes, sync_started)
+
+        with self._phase("db_commit"):
+            await self._commit()
+        print(f"[{datetime.now()}] Sync completed!")
+
+    # Watermarks are loaded as plain rows rather than ORM objects, so per-course
+    # commits do not keep an identity map alive for the whole run
+
+    async def _load_sync_states(self, course_ids: list) -> dict:
+        result = await self.db.execute(
+            select(*CourseSyncState.__table__.c).where(CourseSyncState.course_id.in_(course_ids))
+        )
+        return {state.course_id: state for state in result.all()}
+
+    async def _load_enrollments(self) -> dict:
+        result = await self.db.execute(
+            select(UserCourse.course_id, UserCourse.last_synced_at).where(UserCourse.user_id == self.user.id)
+        )
+        return {enrollment.course_id: enrollment for enrollment in result.all()}
+
+    async def _load_stored_assignments(self) -> dict:
+        """The user's stored submission state, kept for assignments whose status is not refreshed"""
+        result = await self.db.execute(
+            select(
+                UserAssignment.assignment_id, UserAssignment.submitted, UserAssignment.grade,
+                UserAssignment.status_checked_at, Assignment.due_date
+            )
+            .join(Assignment, Assignment.moodle_id == UserAssignment.assignment_id)
+            .where(UserAssignment.user_id == self.user.id)
+        )
+        return {row.assignment_id: row for row in result.all()}
+
+    async def _detect_course_changes(self, courses: list, states: dict, now: datetime, full: bool) -> dict:
+        """
+        Map course id -> change marker:
+        True  = refresh everything (new course, full resync, or no usable change markers)
+        set() of changed cmids = refresh contents, and statuses of those modules only
+        False = unchanged, skip
+        """
+        full_interval = timedelta(hours=settings.sync_full_resync_hours)
+
+        async def detect(course_data):
+            state = states.get(course_data['id'])
+            enrollment = self._enrollments.get(course_data['id'])
+            if full or enrollment is None or enrollment.last_synced_at is None:
+                return True
+            if state is None or state.last_full_sync_at is None or now - state.last_full_sync_at >= full_interval:
+                return True
+            timemodified = _from_timestamp(course_data.get('timemodified'))
+            if timemodified and state.course_timemodified and timemodified > state.course_timemodified:
+                return True
+
+            since = int(enrollment.last_synced_at.replace(tzinfo=timezone.utc).timestamp())
+            try:
+                updates = await self.moodle.get_course_updates_since(course_data['id'], since)
+            except CircuitOpenError:
+                raise
+            except Exception as e:
+                print(f"[DEBUG] Course {course_data['id']}: no change markers ({type(e).__name__}), refreshing")
+                return True
+            if not isinstance(updates, dict) or 'exception' in updates:
+                return True
+            changed_cmids = set()
+            latest = 0
+            for instance in updates.get('instances', []):
+                if instance.get('contextlevel') == 'module' and instance.get('updates'):
+                    changed_cmids.add(instance.get('id'))
+                    latest = max([latest] + [u.get('timeupdated') or 0 for u in instance['updates']])
+            if latest:
+                self._latest_updates[course_data['id']] = _from_timestamp(latest)
+            return changed_cmids or False
+
+        markers = await asyncio.gather(*[detect(c) for c in courses])
+        return {c['id']: marker for c, marker in zip(courses, markers)}
+
+    def _needs_contents(self, course_id: int, marker, now: datetime, full: bool) -> bool:
+        """Whether this user's sync has to fetch the course contents itself"""
+        if marker is False:
+            return False
+        state = self._sync_states.get(course_id)
+        if full or state is None or state.last_synced_at is None or state.last_synced_by in (None, self.user.id):
+            return True
+        # Contents were last fetched by another user's sync
+        if marker is True:
+            return now - state.last_synced_at >= timedelta(minutes=settings.sync_shared_course_ttl_minutes)
+        latest = self._latest_updates.get(course_id)
+        return latest is None or latest >= state.last_synced_at
+
+    async def _save_course_state(self, course_id: int, content_hash: str):
+        """
+        Shared state of a course whose contents this sync fetched. Must only be
+        written once the course's resources merge has committed: the merge runs
+        in its own transaction on the stager's connection, so a crash in between
+        leaves the old content hash and the next sync fetches the course again
+        instead of skipping it as unchanged.
+        """
+        course_data = self._courses.get(course_id, {})
+        marker = self._changes.get(course_id)
+        row = {
+            "course_id": course_id,
+            "last_synced_at": self._sync_started,
+            "last_synced_by": self.user.id,
+            "content_hash": content_hash,
+            "course_timemodified": _from_timestamp(course_data.get('timemodified')),
+            "course_lastaccess": _from_timestamp(course_data.get('lastaccess')),
+        }
+        columns = ["last_synced_at", "last_synced_by", "content_hash", "course_timemodified", "course_lastaccess"]
+        if marker is True:
+            # A True marker means the course was fully refreshed
+            row["last_full_sync_at"] = self._sync_started
+            columns.append("last_full_sync_at")
+        await bulk_upsert(self.db, CourseSyncState, [row], "course_id", columns)
+
+        outcome = self.fingerprint_stats.get(course_id, {}).get('contents')
+        column = CourseSyncState.fingerprint_hits if outcome == 'hit' else CourseSyncState.fingerprint_misses
+        await self.db.execute(
+            update(CourseSyncState)
+            .where(CourseSyncState.course_id == course_id)
+            .values({column: func.coalesce(column, 0) + 1})
+        )
+
+    async def _save_assignment_hashes(self):
+        # Assignment fingerprints come from one call covering every course
+        if self._assignment_hashes:
+            await bulk_upsert(
+                self.db, CourseSyncState,
+                [{"course_id": cid, "assignments_hash": h} for cid, h in self._assignment_hashes.items()],
+                "course_id", ["assignments_hash"]
+            )
+
+    async def _save_sync_states(self, changes: dict, now: datetime):
+        """Advance the user's watermarks once every phase has been committed"""
+        refreshed = [
+            cid for cid, marker in changes.items()
+            if marker is not False and cid not in self._unavailable_courses
+        ]
+        if refreshed:
+            await self.db.execute(
+                update(UserCourse)
+                .where(UserCourse.user_id == self.user.id, UserCourse.course_id.in_(refreshed))
+                .values(last_synced_at=now, updated_at=UserCourse.updated_at)
+            )
+
+    async def _fetch_assignments(self, course_ids: list, changes: dict = None):
+        """Fetch assignments and their submission statuses from Moodle (no DB access)"""
+        with self._phase("assignments"):
+            assignments_data = await self.moodle.get_assignments(course_ids)
         print(f"[DEBUG] Assignments API response type: {type(assignments_data)}")
         print(f"[DEBUG] Assignments API response keys: {assignments_data.keys() if isinstance(assignments_data, dict) else 'Not a dict'}")
         if isinstance(assignments_data, dict) and 'courses' in assignments_data:
@@ -38,183 +503,475 @@ class SyncService:
             for course in assignments_data['courses']:
                 if 'assignments' in course:
                     print(f"[DEBUG] Course {course.get('id')} has {len(course['assignments'])} assignments")
-        await self._sync_assignments(assignments_data)
+        # Fingerprint each course's assignment list before flattening annotates it
+        self._assignment_hashes = {
+            course['id']: payload_fingerprint(course.get('assignments', []))
+            for course in (assignments_data.get('courses', []) if isinstance(assignments_data, dict) else [])
+        }
+        all_assignments = self._flatten_assignments(assignments_data)
+        all_assignments = [a for a in all_assignments if self._status_may_have_changed(a, changes or {})]
+        with self._phase("statuses"):
+            statuses = await self._fetch_assignment_statuses(all_assignments)
+        self._emit("statuses", fetched=len(statuses), assignments=len(self._flatten_assignments(assignments_data)))
+        return assignments_data, statuses
 
-        # 3. Sync resources (files)
-        for course in courses:
-            contents = await self.moodle.get_course_contents(course['id'])
-            await self._sync_resources(course['id'], contents)
+    def _status_may_have_changed(self, assign: dict, changes: dict) -> bool:
+        stored = self._stored_assignments.get(assign['id'])
+        if stored is None:
+            return True
+        marker = changes.get(assign['course_id'], True)
+        if marker is False:
+            return False
+        if marker is not True:
+            # Moodle reported which modules changed
+            return assign.get('cmid') in marker
+        # No change markers for this course - let the due-date tiers decide
+        return status_refresh_due(
+            stored.submitted, stored.grade, stored.due_date, stored.status_checked_at, datetime.utcnow()
+        )
 
-        await self.db.commit()
-        print(f"[{datetime.now()}] Sync completed!")
+    async def _sync_all_resources(self, course_ids: list):
+        """
+        Producer/consumer pipeline for course contents.
 
-    async def _sync_courses(self, courses_data: list):
-        """Sync courses to database"""
-        for course_data in courses_data:
-            stmt = select(Course).where(Course.moodle_id == course_data['id'])
-            result = await self.db.execute(stmt)
-            existing = result.scalar_one_or_none()
-
-            if existing:
-                existing.fullname = course_data.get('fullname', '')
-                existing.progress = course_data.get('progress', 0)
-                existing.updated_at = datetime.utcnow()
-            else:
-                course = Course(
-                    moodle_id=course_data['id'],
-                    fullname=course_data.get('fullname', ''),
-                    shortname=course_data.get('shortname', ''),
-                    category_id=course_data.get('category'),
-                    progress=course_data.get('progress', 0)
+        Contents are streamed for all courses concurrently (bounded by the Moodle
+        request scheduler) and parsed record by record into chunks of resource
+        rows. A single consumer COPYs the chunks from a bounded queue into a
+        staging table and, once a course is complete, reconciles it with a few
+        set-based statements (see ResourceStager). Memory stays flat however
+        large a course is, and total time tracks the slowest course rather than
+        the sum of all courses.
+        """
+        queue = asyncio.Queue(maxsize=settings.sync_pipeline_queue_size)
+        chunk_size = max(1, settings.sync_stream_chunk_size)
+        content_hashes = {}
+
+        async def produce(course_id):
+            try:
+                if not await self._claim_course_contents(course_id):
+                    await queue.put((course_id, "shared", None))
+                    return
+                fingerprint = _StreamFingerprint()
+                rows, flushed = [], False
+                records = self.moodle.iter_course_files(course_id)
+                try:
+                    async for record in records:
+                        fingerprint.update(record)
+                        rows.append(self._resource_row(course_id, record))
+                        if len(rows) >= chunk_size:
+                            await queue.put((course_id, "rows", rows))
+                            rows, flushed = [], True
+                finally:
+                    await records.aclose()
+                content_hashes[course_id] = fingerprint.hexdigest()
+                state = self._sync_states.get(course_id)
+                unchanged = state is not None and state.content_hash == content_hashes[course_id]
+                # An unchanged course that fit in one chunk skips reconciliation;
+                # a larger one is merged anyway, as a no-op
+                await queue.put((course_id, "done", (unchanged, None if unchanged and not flushed else rows)))
+            except MoodleAPIError as e:
+                await queue.put((course_id, "unavailable", e))
+            except Exception as e:
+                await queue.put((course_id, "error", e))
+
+        producers = [asyncio.create_task(produce(cid)) for cid in course_ids]
+        totals = {"inserted": 0, "updated": 0, "missing": 0}
+        courses_done = 0
+        try:
+            async with ResourceStager() as stager:
+                while courses_done < len(course_ids):
+                    course_id, kind, payload = await queue.get()
+                    if kind == "error":
+                        raise payload
+                    if kind == "rows":
+                        await stager.stage(payload)
+                        continue
+
+                    if kind == "unavailable":
+                        # Not an empty course - keep its files, fetch it again next sync
+                        self._record_error(f"contents course {course_id}: {payload}")
+                        self._unavailable_courses.add(course_id)
+                        await stager.discard(course_id)
+                    elif kind == "done":
+                        unchanged, rows = payload
+                        self.fingerprint_stats.setdefault(course_id, {})['contents'] = 'hit' if unchanged else 'miss'
+                        if rows is not None:
+                            await stager.stage(rows)
+                            # Committed here, before the state below records the new hash
+                            inserted, updated, missing = await stager.merge(course_id)
+                            totals["inserted"] += inserted
+                            totals["updated"] += updated
+                            totals["missing"] += missing
+                        await self._save_course_state(course_id, content_hashes[course_id])
+                    # Commit per course: a later failure keeps this course's work
+                    await self._commit()
+                    # Unavailable with this token: syncs waiting on it fetch with their own
+                    self._release_course_contents(course_id, kind != "unavailable")
+                    await self._save_checkpoint(course_id=course_id)
+                    courses_done += 1
+                    self._emit(
+                        "contents", course_id=course_id, courses_done=courses_done,
+                        courses_total=len(course_ids), files_upserted=totals["inserted"] + totals["updated"]
+                    )
+                stats = stager.stats
+                totals["staged"] = stats["copied"]
+                self.run_stats['phases']['resources_copy'] = round(stats["copy_seconds"], 3)
+                self.run_stats['phases']['resources_merge'] = round(stats["merge_seconds"], 3)
+                print(
+                    f"[DEBUG] Resource staging: {stats['copied']} rows copied in {stats['copy_seconds']:.2f}s, "
+                    f"merged in {stats['merge_seconds']:.2f}s"
                 )
-                self.db.add(course)
+        finally:
+            for task in producers:
+                task.cancel()
+            for course_id in list(self._owned_fetches):
+                self._release_course_contents(course_id, False)
+        return totals, content_hashes
 
-    async def _sync_assignments(self, assignments_data: dict):
-        """Sync assignments to database"""
-        if 'courses' not in assignments_data:
+    async def _claim_course_contents(self, course_id: int) -> bool:
+        """
+        Take over streaming a course's contents, or wait for the sync already
+        doing it. Returns False when that sync committed them, so there is
+        nothing left to fetch.
+        """
+        while True:
+            owner = _contents_inflight.get(course_id)
+            if owner is None:
+                future = asyncio.get_running_loop().create_future()
+                _contents_inflight[course_id] = future
+                self._owned_fetches[course_id] = future
+                return True
+            print(f"[DEBUG] Course {course_id}: waiting for contents fetch already in flight")
+            # Shielded so this sync being cancelled does not cancel the other's claim
+            if await asyncio.shield(owner):
+                return False
+
+    def _release_course_contents(self, course_id: int, committed: bool):
+        future = self._owned_fetches.pop(course_id, None)
+        if future is None:
             return
+        if _contents_inflight.get(course_id) is future:
+            del _contents_inflight[course_id]
+        if not future.done():
+            future.set_result(committed)
+
+    async def _fetch_grades(self, course_ids: list) -> list:
+        """Fetch gradebook items with one call per course (no DB access)"""
+        if not settings.sync_grades_from_gradebook or not course_ids:
+            return []
+
+        async def fetch(course_id):
+            try:
+                return course_id, await self.moodle.get_grade_items(course_id)
+            except CircuitOpenError:
+                raise
+            except Exception as e:
+                print(f"[ERROR] Failed to fetch grades for course {course_id}: {type(e).__name__}: {e}")
+                self._record_error(f"grades course {course_id}: {type(e).__name__}: {e}")
+                return course_id, None
+
+        rows = []
+        with self._phase("grades"):
+            results = await asyncio.gather(*[fetch(cid) for cid in course_ids])
+        for course_id, data in results:
+            if not isinstance(data, dict) or 'exception' in data:
+                # Leave grades of this course to the submission-status path
+                continue
+            self._gradebook_courses.add(course_id)
+            for user_grades in data.get('usergrades', []):
+                for item in user_grades.get('gradeitems', []):
+                    if item.get('id') is None:
+                        continue
+                    grade = _clean_grade(item.get('gradeformatted'))
+                    if item.get('itemmodule') == 'assign' and item.get('cmid'):
+                        self._gradebook_grades[item['cmid']] = grade
+                    rows.append({
+                        "user_id": self.user.id,
+                        "moodle_id": item['id'],
+                        "course_id": course_id,
+                        "cmid": item.get('cmid'),
+                        "item_type": item.get('itemtype'),
+                        "item_module": item.get('itemmodule'),
+                        "name": item.get('itemname') or '',
+                        "grade": grade,
+                        "grade_raw": item.get('graderaw'),
+                        "grade_max": item.get('grademax'),
+                    })
+        return rows
+
+    async def _load_gradebook_grades(self, course_ids: list):
+        """Rebuild the gradebook grade map from grade items a resumed run already committed"""
+        result = await self.db.execute(
+            select(GradeItem.course_id, GradeItem.cmid, GradeItem.item_module, GradeItem.grade)
+            .where(GradeItem.user_id == self.user.id, GradeItem.course_id.in_(course_ids))
+        )
+        for row in result.all():
+            self._gradebook_courses.add(row.course_id)
+            if row.item_module == 'assign' and row.cmid:
+                self._gradebook_grades[row.cmid] = row.grade
+
+    async def _sync_grades(self, rows: list):
+        """Upsert gradebook items (assignments, quizzes, totals)"""
+        if not rows:
+            return 0, 0
+        inserted, updated = await bulk_upsert(
+            self.db, GradeItem, rows, ["user_id", "moodle_id"],
+            ["cmid", "name", "grade", "grade_raw", "grade_max"]
+        )
+        print(f"[DEBUG] Grade items: {inserted} inserted, {updated} updated")
+        return inserted, updated
+
+    async def _sync_courses(self, courses_data: list):
+        """Sync courses to database"""
+        rows = [
+            {
+                "moodle_id": course_data['id'],
+                "fullname": course_data.get('fullname', ''),
+                "shortname": course_data.get('shortname', ''),
+                "category_id": course_data.get('category'),
+            }
+            for course_data in courses_data
+        ]
+        inserted, updated = await bulk_upsert(
+            self.db, Course, rows, "moodle_id", ["fullname"]
+        )
+        print(f"[DEBUG] Courses: {inserted} inserted, {updated} updated")
+        return inserted, updated
+
+    async def _sync_enrollments(self, courses_data: list):
+        """Record which courses the user is enrolled in, with their progress"""
+        rows = [
+            {"user_id": self.user.id, "course_id": c['id'], "progress": c.get('progress') or 0}
+            for c in courses_data
+        ]
+        await bulk_upsert(self.db, UserCourse, rows, ["user_id", "course_id"], ["progress"])
+        # Unenrolled courses disappear from the user's views
+        await self.db.execute(
+            delete(UserCourse)
+            .where(UserCourse.user_id == self.user.id)
+            .where(UserCourse.course_id.notin_([c['id'] for c in courses_data]))
+        )
 
-        # Flatten assignments list to process concurrently
+    def _flatten_assignments(self, assignments_data: dict) -> list:
+        """Flatten assignments of all courses into one list"""
         all_assignments = []
+        if not isinstance(assignments_data, dict) or 'courses' not in assignments_data:
+            return all_assignments
         for course in assignments_data['courses']:
             if 'assignments' in course:
                 for assign in course['assignments']:
                     # Add course_id to assignment object for easy access
                     assign['course_id'] = course['id']
                     all_assignments.append(assign)
+        return all_assignments
 
-        # Batch fetch submission statuses concurrently
-        # We use get_assignment_status which works for students (unlike get_submissions)
-        # running them in parallel is much faster than sequential
-        
-        # Limit concurrency to 5 to avoid overwhelming Moodle
-        semaphore = asyncio.Semaphore(5)
-
-        async def fetch_with_semaphore(assign_id):
-            async with semaphore:
-                return await self.moodle.get_assignment_status(assign_id)
-
-        tasks = [fetch_with_semaphore(a['id']) for a in all_assignments]
-        if tasks:
-            print(f"[DEBUG] Fetching statuses for {len(tasks)} assignments...")
-            # Limit concurrency to avoid overwhelming the server or hitting limits
-            # Since MoodleClient creates a new session per call, we should be careful.
-            # However, asyncio.gather with ~50 tasks is usually fine.
-            results = await asyncio.gather(*tasks, return_exceptions=True)
-        else:
-            results = []
+    async def _fetch_assignment_statuses(self, all_assignments: list) -> dict:
+        """Fetch submission statuses, packed into batched multi-function requests"""
+        # We use mod_assign_get_submission_status which works for students (unlike get_submissions).
+        # Concurrency is governed by the shared Moodle request scheduler, which adapts
+        # to Moodle's latency and backs off on 429/5xx responses.
+        # A CircuitOpenError propagates so the sync aborts rather than overwriting
+        # stored statuses when Moodle is unreachable.
+        if not all_assignments:
+            return {}
+        print(f"[DEBUG] Fetching statuses for {len(all_assignments)} assignments...")
+        return await self.moodle.get_assignment_statuses([a['id'] for a in all_assignments])
+
+    async def _sync_assignments(self, assignments_data: dict, statuses: dict = None):
+        """Sync assignments to database"""
+        if 'courses' not in assignments_data:
+            return 0, 0
+
+        all_assignments = self._flatten_assignments(assignments_data)
+        if statuses is None:
+            statuses = await self._fetch_assignment_statuses(all_assignments)
+        results = [statuses.get(a['id'], {}) for a in all_assignments]
 
         submission_status_map = {}
         grade_map = {}
+        # Statuses actually read this run; failed ones do not count as checked
+        checked = set()
         for assign, result in zip(all_assignments, results):
-            is_submitted = False
-            grade = None
-            
-            if isinstance(result, Exception):
-                print(f"[ERROR] Failed to fetch status for assignment {assign['id']}: {result}")
-            elif isinstance(result, dict):
-                 if 'exception' in result:
-                     print(f"[ERROR] Moodle API error for assignment {assign['id']}: {result}")
-                 
-                 # Check if there's a submission with status "submitted" (individual or team)
-                 last_attempt = result.get('lastattempt', {})
-                 sub_status = last_attempt.get('submission', {}).get('status')
-                 team_status = last_attempt.get('teamsubmission', {}).get('status')
-                 
-                 # Consider 'graded' as submitted as well
-                 if sub_status in ['submitted', 'graded'] or team_status in ['submitted', 'graded']:
-                     is_submitted = True
-                 elif sub_status or team_status:
-                     print(f"[DEBUG] Assignment {assign['id']} has status: sub={sub_status}, team={team_status}")
-                 
-                 # DEBUG: Trace specific assignments
-                 if assign['id'] in [13033, 13744]:
-                     print(f"[TRACE] Assign {assign['id']}: sub_status='{sub_status}', team_status='{team_status}', is_submitted={is_submitted}")
-
-                 # Extract grade
-                 feedback = result.get('feedback', {})
-                 grade_display = feedback.get('gradefordisplay')
-                 if grade_display:
-                     # Clean up HTML entities
-                     grade = grade_display.replace('&nbsp;', ' ').strip()
-            
-            submission_status_map[assign['id']] = is_submitted
-            grade_map[assign['id']] = grade
+            parsed = self._parse_status(assign['id'], result) if assign['id'] in statuses else None
+            if parsed is not None:
+                checked.add(assign['id'])
+                submission_status_map[assign['id']], grade_map[assign['id']] = parsed
+            elif assign['id'] in self._stored_assignments:
+                # Status not refreshed this run - keep what we already have
+                stored = self._stored_assignments[assign['id']]
+                submission_status_map[assign['id']], grade_map[assign['id']] = stored.submitted, stored.grade
+
+        # The gradebook is authoritative for grades of the courses it was fetched for
+        for assign in all_assignments:
+            if assign['course_id'] in self._gradebook_courses:
+                grade_map[assign['id']] = self._gradebook_grades.get(assign.get('cmid'))
 
         # Update DB
-        for assign_data in all_assignments:
-            stmt = select(Assignment).where(Assignment.moodle_id == assign_data['id'])
-            result = await self.db.execute(stmt)
-            existing = result.scalar_one_or_none()
+        # Assignment definitions are shared; courses whose assignment list
+        # fingerprint is unchanged do not need them rewritten
+        unchanged_courses = set()
+        for course_id, fingerprint in self._assignment_hashes.items():
+            state = self._sync_states.get(course_id)
+            unchanged = state is not None and state.assignments_hash == fingerprint
+            self.fingerprint_stats.setdefault(course_id, {})['assignments'] = 'hit' if unchanged else 'miss'
+            if unchanged:
+                unchanged_courses.add(course_id)
 
+        rows = []
+        for assign_data in all_assignments:
+            if assign_data['course_id'] in unchanged_courses:
+                continue
             due_date = None
             if assign_data.get('duedate'):
                 due_date = datetime.fromtimestamp(assign_data['duedate'], tz=timezone.utc).replace(tzinfo=None)
 
-            # Get submission status and grade from maps
-            submitted = submission_status_map.get(assign_data['id'], False)
-            grade = grade_map.get(assign_data['id'])
-
-            if not existing:
-                assignment = Assignment(
-                    moodle_id=assign_data['id'],
-                    cmid=assign_data.get('cmid'),  # Store course module ID
-                    course_id=assign_data['course_id'],
-                    name=assign_data.get('name', ''),
-                    due_date=due_date,
-                    description=assign_data.get('intro', ''),
-                    is_new=True,
-                    submitted=submitted,
-                    grade=grade
-                )
-                self.db.add(assignment)
-            else:
-                # Update existing assignment's fields (including due_date which may change)
-                existing.submitted = submitted
-                existing.grade = grade
-                existing.cmid = assign_data.get('cmid')
-                existing.due_date = due_date
-                existing.name = assign_data.get('name', '')
-                existing.description = assign_data.get('intro', '')
-                existing.updated_at = datetime.utcnow()
-
-    async def _sync_resources(self, course_id: int, contents: list):
-        """Sync course resources (files) to database"""
-        for module in contents:
-            if 'modules' not in module:
+            rows.append({
+                "moodle_id": assign_data['id'],
+                "cmid": assign_data.get('cmid'),  # Store course module ID
+                "course_id": assign_data['course_id'],
+                "name": assign_data.get('name', ''),
+                "due_date": due_date,
+                "description": assign_data.get('intro', ''),
+                "is_new": True,
+            })
+
+        # Existing assignments keep is_new; every other field (including due_date) may change
+        inserted, updated = await bulk_upsert(
+            self.db, Assignment, rows, "moodle_id",
+            ["cmid", "due_date", "name", "description"]
+        )
+        print(f"[DEBUG] Assignments: {inserted} inserted, {updated} updated")
+
+        # The user's submission state: refreshed statuses, new assignments and grade changes
+        status_rows = []
+        for assign_data in all_assignments:
+            assign_id = assign_data['id']
+            submitted = submission_status_map.get(assign_id, False)
+            grade = grade_map.get(assign_id)
+            stored = self._stored_assignments.get(assign_id)
+            if assign_id not in checked and stored is not None and (stored.submitted, stored.grade) == (submitted, grade):
                 continue
+            status_rows.append({
+                "user_id": self.user.id,
+                "assignment_id": assign_id,
+                "submitted": submitted,
+                "grade": grade,
+            })
+        self._record_rows("submissions", *await bulk_upsert(
+            self.db, UserAssignment, status_rows, ["user_id", "assignment_id"], ["submitted", "grade"]
+        ))
+        await self._mark_status_checked(list(checked))
+        return inserted, updated
 
-            section_name = module.get('name', 'General')
+    def _parse_status(self, assign_id: int, result) -> Optional[tuple]:
+        """
+        Extract (submitted, grade) from a mod_assign_get_submission_status
+        response. None for a failed, error or empty response: the caller keeps
+        the stored values and does not count the status as checked.
+        """
+        is_submitted = False
+        grade = None
 
-            for mod in module['modules']:
-                if 'contents' not in mod:
-                    continue
+        if isinstance(result, Exception):
+            print(f"[ERROR] Failed to fetch status for assignment {assign_id}: {result}")
+            self._record_error(f"status assignment {assign_id}: {result}")
+            return None
+        if not isinstance(result, dict) or not result:
+            print(f"[ERROR] Empty status response for assignment {assign_id}")
+            self._record_error(f"status assignment {assign_id}: empty response")
+            return None
+        if 'exception' in result:
+            print(f"[ERROR] Moodle API error for assignment {assign_id}: {result}")
+            self._record_error(f"status assignment {assign_id}: {result.get('message', result.get('exception'))}")
+            return None
 
-                for content in mod['contents']:
-                    if content.get('type') != 'file':
-                        continue
+        # Check if there's a submission with status "submitted" (individual or team)
+        last_attempt = result.get('lastattempt', {})
+        sub_status = last_attempt.get('submission', {}).get('status')
+        team_status = last_attempt.get('teamsubmission', {}).get('status')
 
-                    file_url = content.get('fileurl', '')
-                    if not file_url:
-                        continue
+        # Consider 'graded' as submitted as well
+        if sub_status in ['submitted', 'graded'] or team_status in ['submitted', 'graded']:
+            is_submitted = True
+        elif sub_status or team_status:
+            print(f"[DEBUG] Assignment {assign_id} has status: sub={sub_status}, team={team_status}")
+
+        # DEBUG: Trace specific assignments
+        if assign_id in [13033, 13744]:
+            print(f"[TRACE] Assign {assign_id}: sub_status='{sub_status}', team_status='{team_status}', is_submitted={is_submitted}")
+
+        # Extract grade
+        feedback = result.get('feedback', {})
+        grade_display = feedback.get('gradefordisplay')
+        if grade_display:
+            # Clean up HTML entities
+            grade = grade_display.replace('&nbsp;', ' ').strip()
+
+        return is_submitted, grade
+
+    async def _mark_status_checked(self, assignment_ids: list):
+        """Record when statuses were fetched, without bumping updated_at"""
+        if not assignment_ids:
+            return
+        await self.db.execute(
+            update(UserAssignment)
+            .where(UserAssignment.user_id == self.user.id)
+            .where(UserAssignment.assignment_id.in_(assignment_ids))
+            .values(status_checked_at=datetime.utcnow(), updated_at=UserAssignment.updated_at)
+        )
+
+    async def refresh_urgent_statuses(self):
+        """Poll the user's unsubmitted assignments due within the urgent window"""
+        now = datetime.utcnow()
+        result = await self.db.execute(
+            select(UserAssignment.assignment_id, UserAssignment.submitted, UserAssignment.grade, Assignment.due_date)
+            .join(Assignment, Assignment.moodle_id == UserAssignment.assignment_id)
+            .where(UserAssignment.user_id == self.user.id)
+            .where(UserAssignment.submitted == False)
+            .where(Assignment.due_date >= now)
+            .where(Assignment.due_date <= now + timedelta(days=settings.status_urgent_window_days))
+        )
+        urgent_ids = [
+            row.assignment_id for row in result.all()
+            if status_tier(row.submitted, row.grade, row.due_date, now) == TIER_URGENT
+        ]
+        if not urgent_ids:
+            return 0
+
+        print(f"[DEBUG] Refreshing {len(urgent_ids)} urgent assignment statuses for user {self.user.id}...")
+        statuses = await self.moodle.get_assignment_statuses(urgent_ids)
+        changed = 0
+        checked = []
+        for assign_id, status in statuses.items():
+            parsed = self._parse_status(assign_id, status)
+            if parsed is None:
+                # Keep the stored status and retry on the next poll
+                continue
+            checked.append(assign_id)
+            submitted, grade = parsed
+            result = await self.db.execute(
+                update(UserAssignment)
+                .where(UserAssignment.user_id == self.user.id, UserAssignment.assignment_id == assign_id)
+                .where(tuple_(UserAssignment.submitted, UserAssignment.grade).is_distinct_from(tuple_(submitted, grade)))
+                .values(submitted=submitted, grade=grade)
+            )
+            changed += result.rowcount
+        await self._mark_status_checked(checked)
+        await self.db.commit()
+        print(f"[DEBUG] Urgent statuses: {changed} of {len(statuses)} changed")
+        return changed
 
-                    stmt = select(Resource).where(Resource.file_url == file_url)
-                    result = await self.db.execute(stmt)
-                    existing = result.scalar_one_or_none()
-
-                    if not existing:
-                        resource = Resource(
-                            moodle_id=content.get('id', 0),
-                            course_id=course_id,
-                            filename=content.get('filename', 'unknown'),
-                            file_url=file_url,
-                            section=section_name,
-                            mimetype=content.get('mimetype', ''),
-                            filesize=content.get('filesize', 0),
-                            time_created=datetime.fromtimestamp(content['timecreated'], tz=timezone.utc).replace(tzinfo=None) if content.get('timecreated') else None,
-                            is_new=True
-                        )
-                        self.db.add(resource)
-                    elif existing.section != section_name:
-                        # Update section if changed
-                        existing.section = section_name
+    def _resource_row(self, course_id: int, record: dict) -> dict:
+        """Resource row for one streamed file record (see MoodleClient.iter_course_files)"""
+        return {
+            "moodle_id": record.get('id', 0),
+            "course_id": course_id,
+            "filename": record.get('filename', 'unknown'),
+            "file_url": record['fileurl'],
+            "section": record['section'],
+            "mimetype": record.get('mimetype', ''),
+            "filesize": record.get('filesize', 0),
+            "time_created": _from_timestamp(record.get('timecreated')),
+            "time_modified": _from_timestamp(record.get('timemodified')),
+            "is_new": True,
+        }
@@ -0,0 +1,72 @@
+from datetime import datetime
+from typing import List, Optional
+from fastapi import Depends, HTTPException
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.config import settings
+from app.database import AsyncSessionLocal, get_db
+from app.models.user import MoodleUser
+
+async def ensure_default_user() -> Optional[int]:
+    """Register (or refresh the token of) the single-account user from settings"""
+    if not settings.moodle_token or not settings.moodle_user_id:
+        return None
+    table = MoodleUser.__table__
+    stmt = pg_insert(table).values(
+        moodle_user_id=settings.moodle_user_id,
+        name="default",
+        token=settings.moodle_token,
+        enabled=True,
+        created_at=datetime.utcnow(),
+        updated_at=datetime.utcnow(),
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.moodle_user_id],
+        set_={"token": stmt.excluded.token},
+        where=table.c.token.is_distinct_from(stmt.excluded.token),
+    ).returning(table.c.id)
+    async with AsyncSessionLocal() as db:
+        user_id = (await db.execute(stmt)).scalar()
+        await db.commit()
+        if user_id is None:
+            # Already registered with the same token
+            user_id = (await db.execute(
+                select(MoodleUser.id).where(MoodleUser.moodle_user_id == settings.moodle_user_id)
+            )).scalar()
+    return user_id
+
+async def get_default_user(db: AsyncSession) -> Optional[MoodleUser]:
+    """The settings user if registered, otherwise the first enabled user"""
+    result = await db.execute(
+        select(MoodleUser)
+        .where(MoodleUser.enabled == True)
+        .order_by((MoodleUser.moodle_user_id == settings.moodle_user_id).desc(), MoodleUser.id)
+        .limit(1)
+    )
+    return result.scalar_one_or_none()
+
+async def get_sync_users(db: AsyncSession, user_id: int = None) -> List[MoodleUser]:
+    """Enabled users, least recently synced first so nobody is starved"""
+    query = select(MoodleUser).where(MoodleUser.enabled == True)
+    if user_id is not None:
+        query = query.where(MoodleUser.id == user_id)
+    result = await db.execute(
+        query.order_by(MoodleUser.last_synced_at.asc().nulls_first(), MoodleUser.id)
+    )
+    return result.scalars().all()
+
+async def get_current_user(user_id: int = None, db: AsyncSession = Depends(get_db)) -> MoodleUser:
+    """
+    FastAPI dependency resolving the ?user_id= query parameter.
+
+    Without one the default user is used, so single-user deployments keep
+    working unchanged.
+    """
+    if user_id is not None:
+        user = await db.get(MoodleUser, user_id)
+    else:
+        user = await get_default_user(db)
+    if user is None:
+        raise HTTPException(status_code=404, detail="Moodle user not found")
+    return user
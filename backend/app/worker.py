@@ -0,0 +1,148 @@
+"""
+Standalone job worker.
+
+Claims jobs from the Postgres `jobs` table (FOR UPDATE SKIP LOCKED) and runs them
+in N concurrent slots. Idle slots wake on LISTEN/NOTIFY, with a slow poll as a
+fallback.
+
+Usage:
+    python -m app.worker
+"""
+import asyncio
+import signal
+import traceback
+import asyncpg
+from app.config import settings
+from app.database import engine, Base
+from app.services import job_queue
+from app.services.http_client import open_http_client, close_http_client
+from app.services.sync_lock import PROCESS_ID
+from app.services.users import ensure_default_user
+# Import handlers so they register themselves with the queue
+from app.services import sync_jobs  # noqa: F401
+from app.models import course, assignment, resource, sync_state, grade, sync_run, sync_lock, job, user, mirror  # noqa: F401
+
+class JobCancelled(Exception):
+    """The job's handler task was cancelled from inside, e.g. after losing its lease"""
+    pass
+
+class Worker:
+    def __init__(self, concurrency: int):
+        self.concurrency = concurrency
+        self.id = PROCESS_ID
+        self.wake = asyncio.Event()
+        self.stopping = asyncio.Event()
+
+    async def run(self):
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        await ensure_default_user()
+        await open_http_client()
+        listener = await self._listen()
+
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.stopping.set)
+
+        print(f"[Worker] {self.id} started with {self.concurrency} slots")
+        slots = [asyncio.create_task(self._slot(i)) for i in range(self.concurrency)]
+        await self.stopping.wait()
+        print("[Worker] Stopping, waiting for running jobs...")
+        self.wake.set()
+        await asyncio.gather(*slots, return_exceptions=True)
+
+        if listener is not None:
+            await listener.close()
+        await close_http_client()
+        print("[Worker] Stopped")
+
+    async def _listen(self):
+        dsn = settings.database_url.replace("postgresql+asyncpg://", "postgresql://")
+        try:
+            conn = await asyncpg.connect(dsn)
+            await conn.add_listener(job_queue.NOTIFY_CHANNEL, lambda *args: self.wake.set())
+            return conn
+        except Exception as e:
+            print(f"[Worker] LISTEN unavailable ({e}), polling every {settings.worker_poll_interval}s")
+            return None
+
+    async def _slot(self, slot: int):
+        while not self.stopping.is_set():
+            try:
+                job = await job_queue.claim(self.id)
+            except Exception as e:
+                print(f"[Worker] Claim failed: {e}")
+                job = None
+
+            if job is None:
+                self.wake.clear()
+                try:
+                    await asyncio.wait_for(self.wake.wait(), timeout=settings.worker_poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            await self._execute(job)
+
+    async def _execute(self, job):
+        print(f"[Worker] Running job {job.id} ({job.kind}), attempt {job.attempts}")
+        handler = job_queue.get_handler(job.kind)
+        events = list(job.events or [])
+        pending = set()
+        flush_lock = asyncio.Lock()
+
+        async def flush():
+            # Snapshot under the lock so a write never replaces newer events with older ones
+            async with flush_lock:
+                await job_queue.append_event(job.id, list(events))
+
+        def report(event: str, **data):
+            events.append(sync_jobs.make_event(event, **data))
+            task = asyncio.create_task(flush())
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+
+        async def keep_alive():
+            while True:
+                await asyncio.sleep(settings.job_visibility_timeout_seconds / 3)
+                try:
+                    await job_queue.heartbeat(job.id, self.id)
+                except Exception as e:
+                    print(f"[Worker] Heartbeat for job {job.id} failed: {e}")
+
+        heartbeat = asyncio.create_task(keep_alive())
+        try:
+            if handler is None:
+                raise Exception(f"No handler registered for job kind '{job.kind}'")
+            report("started", kind=job.kind, attempt=job.attempts)
+            # Own task: a lease lost inside the handler (LeaseLock.hold) cancels
+            # this task, not the slot
+            run = asyncio.create_task(handler(job, report))
+            try:
+                result = await run
+            except asyncio.CancelledError:
+                if asyncio.current_task().cancelling():
+                    # The worker itself is being torn down
+                    raise
+                raise JobCancelled("Job cancelled while running (lease lost)")
+            result = result or {}
+            status = "skipped" if result.get("skipped") else "success"
+            events.append(sync_jobs.make_event("done", status=status, detail=result.get("detail")))
+            await asyncio.gather(*pending, return_exceptions=True)
+            await flush()
+            await job_queue.complete(job.id, result)
+        except Exception as e:
+            traceback.print_exc()
+            error = f"{type(e).__name__}: {e}"
+            if job.attempts >= job.max_attempts:
+                events.append(sync_jobs.make_event("error", status="failed", detail=f"Sync failed: {error}"))
+            else:
+                events.append(sync_jobs.make_event("retrying", attempt=job.attempts, detail=error))
+            await asyncio.gather(*pending, return_exceptions=True)
+            await flush()
+            await job_queue.fail(job, error)
+        finally:
+            heartbeat.cancel()
+
+if __name__ == "__main__":
+    asyncio.run(Worker(settings.worker_concurrency).run())
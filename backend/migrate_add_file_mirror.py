@@ -0,0 +1,22 @@
+"""
+Migration script for the local file mirror: resources.time_modified and the
+mirror_blobs/mirror_entries index tables
+"""
+import asyncio
+from sqlalchemy import text
+from app.database import engine, Base
+from app.models import mirror  # noqa: F401
+
+async def migrate():
+    async with engine.begin() as conn:
+        await conn.execute(text("""
+            ALTER TABLE resources ADD COLUMN IF NOT EXISTS time_modified TIMESTAMP;
+        """))
+        print("✓ Added time_modified column to resources table")
+        await conn.run_sync(Base.metadata.create_all)
+        print("✓ Created mirror_blobs and mirror_entries tables")
+
+if __name__ == "__main__":
+    print("Running migration for the file mirror...")
+    asyncio.run(migrate())
+    print("Migration completed!")
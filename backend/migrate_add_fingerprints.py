@@ -0,0 +1,24 @@
+"""
+Migration script to add payload fingerprint columns to course_sync_state table
+"""
+import asyncio
+from sqlalchemy import text
+from app.database import engine
+
+async def migrate():
+    async with engine.begin() as conn:
+        await conn.execute(text("""
+            ALTER TABLE course_sync_state ADD COLUMN IF NOT EXISTS assignments_hash VARCHAR;
+        """))
+        await conn.execute(text("""
+            ALTER TABLE course_sync_state ADD COLUMN IF NOT EXISTS fingerprint_hits INTEGER DEFAULT 0;
+        """))
+        await conn.execute(text("""
+            ALTER TABLE course_sync_state ADD COLUMN IF NOT EXISTS fingerprint_misses INTEGER DEFAULT 0;
+        """))
+        print("✓ Added fingerprint columns to course_sync_state table")
+
+if __name__ == "__main__":
+    print("Running migration to add fingerprint columns...")
+    asyncio.run(migrate())
+    print("Migration completed!")
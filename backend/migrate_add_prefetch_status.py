@@ -0,0 +1,24 @@
+"""
+Migration script to add prefetch status columns to resources table
+"""
+import asyncio
+from sqlalchemy import text
+from app.database import engine
+
+async def migrate():
+    async with engine.begin() as conn:
+        await conn.execute(text("""
+            ALTER TABLE resources ADD COLUMN IF NOT EXISTS prefetch_status VARCHAR;
+        """))
+        await conn.execute(text("""
+            ALTER TABLE resources ADD COLUMN IF NOT EXISTS prefetch_error VARCHAR;
+        """))
+        await conn.execute(text("""
+            ALTER TABLE resources ADD COLUMN IF NOT EXISTS prefetch_attempted_at TIMESTAMP;
+        """))
+        print("✓ Added prefetch status columns to resources table")
+
+if __name__ == "__main__":
+    print("Running migration to add prefetch status...")
+    asyncio.run(migrate())
+    print("Migration completed!")
@@ -0,0 +1,21 @@
+"""
+Migration script to add deleted_at column to resources table
+"""
+import asyncio
+from sqlalchemy import text
+from app.database import engine
+
+async def migrate():
+    async with engine.begin() as conn:
+        await conn.execute(text("""
+            ALTER TABLE resources ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP;
+        """))
+        await conn.execute(text("""
+            CREATE INDEX IF NOT EXISTS ix_resources_deleted_at ON resources (deleted_at);
+        """))
+        print("✓ Added deleted_at column to resources table")
+
+if __name__ == "__main__":
+    print("Running migration to add resource tombstones...")
+    asyncio.run(migrate())
+    print("Migration completed!")
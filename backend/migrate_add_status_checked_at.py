@@ -0,0 +1,18 @@
+"""
+Migration script to add status_checked_at column to assignments table
+"""
+import asyncio
+from sqlalchemy import text
+from app.database import engine
+
+async def migrate():
+    async with engine.begin() as conn:
+        await conn.execute(text("""
+            ALTER TABLE assignments ADD COLUMN IF NOT EXISTS status_checked_at TIMESTAMP;
+        """))
+        print("✓ Added status_checked_at column to assignments table")
+
+if __name__ == "__main__":
+    print("Running migration to add status_checked_at column...")
+    asyncio.run(migrate())
+    print("Migration completed!")
@@ -0,0 +1,21 @@
+"""
+Migration script to add checkpoint columns to sync_runs table
+"""
+import asyncio
+from sqlalchemy import text
+from app.database import engine
+
+async def migrate():
+    async with engine.begin() as conn:
+        await conn.execute(text("""
+            ALTER TABLE sync_runs ADD COLUMN IF NOT EXISTS checkpoint JSON;
+        """))
+        await conn.execute(text("""
+            ALTER TABLE sync_runs ADD COLUMN IF NOT EXISTS resumed_from INTEGER;
+        """))
+        print("✓ Added checkpoint columns to sync_runs table")
+
+if __name__ == "__main__":
+    print("Running migration to add sync checkpoint columns...")
+    asyncio.run(migrate())
+    print("Migration completed!")
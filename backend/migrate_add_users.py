@@ -0,0 +1,72 @@
+"""
+Migration script for multi-user syncs.
+
+Creates the moodle_users, user_courses and user_assignments tables, registers the
+MOODLE_TOKEN/MOODLE_USER_ID account as the default user and moves the existing
+single-user data (course progress, submission statuses, grade items) to it.
+The old assignments.submitted/grade/status_checked_at and courses.progress
+columns are left in place and no longer read.
+"""
+import asyncio
+from sqlalchemy import text
+from app.database import engine, Base
+from app.models import course, assignment, resource, sync_state, grade, sync_run, user  # noqa: F401
+from app.services.users import ensure_default_user
+
+async def migrate():
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        print("✓ Created moodle_users, user_courses and user_assignments tables")
+
+        await conn.execute(text("""
+            ALTER TABLE course_sync_state ADD COLUMN IF NOT EXISTS last_synced_by INTEGER;
+        """))
+        await conn.execute(text("""
+            ALTER TABLE sync_runs ADD COLUMN IF NOT EXISTS user_id INTEGER;
+        """))
+        await conn.execute(text("""
+            CREATE INDEX IF NOT EXISTS ix_sync_runs_user_id ON sync_runs (user_id);
+        """))
+        await conn.execute(text("""
+            ALTER TABLE grade_items ADD COLUMN IF NOT EXISTS user_id INTEGER REFERENCES moodle_users(id);
+        """))
+        print("✓ Added user columns to course_sync_state, sync_runs and grade_items")
+
+    default_user = await ensure_default_user()
+    if default_user is None:
+        print("! MOODLE_TOKEN/MOODLE_USER_ID not set - existing data was not assigned to a user")
+        return
+
+    async with engine.begin() as conn:
+        params = {"user_id": default_user}
+        result = await conn.execute(text("""
+            INSERT INTO user_courses (user_id, course_id, progress, last_synced_at, created_at, updated_at)
+            SELECT :user_id, c.moodle_id, COALESCE(c.progress, 0), s.last_synced_at, NOW(), NOW()
+            FROM courses c LEFT JOIN course_sync_state s ON s.course_id = c.moodle_id
+            ON CONFLICT (user_id, course_id) DO NOTHING;
+        """), params)
+        print(f"✓ Enrolled default user in {result.rowcount} courses")
+
+        result = await conn.execute(text("""
+            INSERT INTO user_assignments (user_id, assignment_id, submitted, grade, status_checked_at, created_at, updated_at)
+            SELECT :user_id, moodle_id, COALESCE(submitted, FALSE), grade, status_checked_at, NOW(), NOW()
+            FROM assignments
+            ON CONFLICT (user_id, assignment_id) DO NOTHING;
+        """), params)
+        print(f"✓ Moved {result.rowcount} submission statuses to the default user")
+
+        await conn.execute(text("UPDATE grade_items SET user_id = :user_id WHERE user_id IS NULL;"), params)
+        await conn.execute(text("ALTER TABLE grade_items ALTER COLUMN user_id SET NOT NULL;"))
+        # Gradebook item ids are shared by every user - unique per user instead
+        await conn.execute(text("DROP INDEX IF EXISTS ix_grade_items_moodle_id;"))
+        await conn.execute(text("CREATE INDEX IF NOT EXISTS ix_grade_items_moodle_id ON grade_items (moodle_id);"))
+        await conn.execute(text("CREATE INDEX IF NOT EXISTS ix_grade_items_user_id ON grade_items (user_id);"))
+        await conn.execute(text("""
+            CREATE UNIQUE INDEX IF NOT EXISTS uq_grade_items_user_item ON grade_items (user_id, moodle_id);
+        """))
+        print("✓ Grade items are now unique per user")
+
+if __name__ == "__main__":
+    print("Running migration for multi-user syncs...")
+    asyncio.run(migrate())
+    print("Migration completed!")
@@ -1,7 +1,7 @@
 """
 Reset script for new semester.
-Clears assignments, resources, grades, and notebook URLs from the database.
-Courses are kept (they'll be updated on next Moodle sync).
+Clears assignments, resources, grades, sync watermarks and notebook URLs from the database.
+Courses, users and enrollments are kept (they'll be updated on next Moodle sync).
 
 Usage:
     docker exec moodle_backend python reset_semester.py
@@ -9,14 +9,17 @@ Usage:
 import asyncio
 from sqlalchemy import delete, update
 from app.database import AsyncSessionLocal
-from app.models.assignment import Assignment
+from app.models.assignment import Assignment, UserAssignment
 from app.models.resource import Resource
-from app.models.course import Course
+from app.models.course import Course, UserCourse
+from app.models.sync_state import CourseSyncState
+from app.models.grade import GradeItem
 
 
 async def reset():
     async with AsyncSessionLocal() as db:
-        # Delete all assignments (includes grades)
+        # Delete submission statuses, then all assignments
+        await db.execute(delete(UserAssignment))
         result = await db.execute(delete(Assignment))
         print(f"Deleted {result.rowcount} assignments")
 
@@ -24,6 +27,15 @@ async def reset():
         result = await db.execute(delete(Resource))
         print(f"Deleted {result.rowcount} resources")
 
+        # Delete gradebook items
+        result = await db.execute(delete(GradeItem))
+        print(f"Deleted {result.rowcount} grade items")
+
+        # Forget sync watermarks so the next sync refetches every course
+        result = await db.execute(delete(CourseSyncState))
+        print(f"Cleared sync state for {result.rowcount} courses")
+        await db.execute(update(UserCourse).values(last_synced_at=None))
+
         # Clear notebook URLs (new semester = new notebooks)
         result = await db.execute(
             update(Course).values(notebook_url=None)
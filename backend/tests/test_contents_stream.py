@@ -0,0 +1,76 @@
+import asyncio
+import json
+import pytest
+from app.services.contents_stream import DEFAULT_SECTION, MoodleAPIError, iter_file_records
+
+def _file(name, **fields):
+    return {"type": "file", "filename": name, "fileurl": f"https://moodle.example/pluginfile.php/{name}", "filesize": 10, **fields}
+
+def _module(module_id, contents, **fields):
+    # Same key order as Moodle: visibility comes before the contents
+    return {"id": module_id, "name": f"Module {module_id}", "modname": "resource", **fields, "contents": contents}
+
+async def _chunks(body: bytes, size: int):
+    for start in range(0, len(body), size):
+        yield body[start:start + size]
+
+def parse(payload, chunk_size: int = 7):
+    async def collect():
+        return [record async for record in iter_file_records(_chunks(json.dumps(payload).encode(), chunk_size))]
+    return asyncio.run(collect())
+
+def test_flattens_files_with_section_and_module():
+    records = parse([
+        {"name": "Week 1", "modules": [_module(10, [_file("a.pdf"), _file("b.pdf")])]},
+        {"name": "Week 2", "modules": [_module(11, [_file("c.pdf", timemodified=1700000000)])]},
+    ])
+    assert [(r["section"], r["module_id"], r["filename"]) for r in records] == [
+        ("Week 1", 10, "a.pdf"), ("Week 1", 10, "b.pdf"), ("Week 2", 11, "c.pdf"),
+    ]
+    assert records[0]["module_name"] == "Module 10"
+    assert records[0]["modname"] == "resource"
+    assert records[2]["timemodified"] == 1700000000
+
+def test_chunk_boundaries_do_not_matter():
+    payload = [{"name": "Week 1", "modules": [_module(i, [_file(f"{i}.pdf")]) for i in range(20)]}]
+    assert parse(payload, chunk_size=1) == parse(payload, chunk_size=64 * 1024)
+
+def test_skips_non_file_contents_and_files_without_url():
+    records = parse([{"name": "Week 1", "modules": [_module(10, [
+        {"type": "url", "filename": "link", "fileurl": "https://example.com"},
+        {"type": "file", "filename": "nourl.pdf"},
+        _file("ok.pdf"),
+    ])]}])
+    assert [r["filename"] for r in records] == ["ok.pdf"]
+
+def test_section_name_after_its_modules():
+    records = parse([{"modules": [_module(10, [_file("a.pdf")])], "name": "Late name"}])
+    assert [(r["section"], r["filename"]) for r in records] == [("Late name", "a.pdf")]
+
+def test_section_without_name_uses_default():
+    records = parse([{"modules": [_module(10, [_file("a.pdf")])]}])
+    assert records[0]["section"] == DEFAULT_SECTION
+
+def test_hidden_sections_and_modules_are_left_out():
+    records = parse([
+        {"name": "Hidden", "visible": 0, "modules": [_module(10, [_file("a.pdf")])]},
+        {"name": "Shown", "visible": 1, "modules": [
+            _module(11, [_file("b.pdf")], visible=0),
+            _module(12, [_file("c.pdf")], visible=1),
+        ]},
+    ])
+    assert [r["filename"] for r in records] == ["c.pdf"]
+
+def test_per_user_restrictions_do_not_drop_files():
+    # uservisible depends on whose token fetched the course; the rows are shared
+    records = parse([{"name": "Week 1", "uservisible": False, "modules": [
+        _module(10, [_file("a.pdf")], uservisible=False),
+    ]}])
+    assert [r["filename"] for r in records] == ["a.pdf"]
+
+def test_error_payload_raises():
+    with pytest.raises(MoodleAPIError, match="Access denied"):
+        parse({"exception": "moodle_exception", "errorcode": "nopermissions", "message": "Access denied"})
+
+def test_empty_course():
+    assert parse([]) == []
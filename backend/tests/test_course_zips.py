@@ -0,0 +1,74 @@
+import asyncio
+import io
+import zipfile
+from datetime import datetime
+from app.services import course_zips
+from app.services.course_zips import FAILED_MANIFEST, ArchiveFile, start_zip, unique_name
+
+class FakeEngine:
+    """Serves file contents by URL; URLs in `failing` fail as after retries"""
+
+    def __init__(self, contents: dict, failing: dict):
+        self.contents = contents
+        self.failing = failing
+        self.items = []
+
+    async def iter_downloads(self, items, window):
+        self.items = items
+        for index, item in enumerate(items):
+            url = item.url.split("&token=")[0]
+            if url in self.failing:
+                yield index, None, 0, self.failing[url]
+            else:
+                data = self.contents[url]
+                yield index, io.BytesIO(data), len(data), None
+
+def _file(arcname: str) -> ArchiveFile:
+    url = f"https://moodle.example/pluginfile.php/{arcname}?forcedownload=1"
+    return ArchiveFile(arcname, url, 5, "text/plain", datetime(2024, 1, 1), datetime(2024, 1, 1))
+
+def build(monkeypatch, files, failing=()):
+    engine = FakeEngine({f.file_url: f.arcname.encode() for f in files}, {f.file_url: "HTTP 404" for f in failing})
+    monkeypatch.setattr(course_zips, "get_download_engine", lambda: engine)
+
+    async def run():
+        chunks, progress = start_zip(files, "secret")
+        return b"".join([chunk async for chunk in chunks]), progress
+
+    data, progress = asyncio.run(run())
+    return zipfile.ZipFile(io.BytesIO(data)), progress, engine
+
+def test_archive_of_downloaded_files(monkeypatch):
+    files = [_file("Week 1/a.txt"), _file("Week 2/b.txt")]
+    archive, progress, engine = build(monkeypatch, files)
+    assert archive.namelist() == ["Week 1/a.txt", "Week 2/b.txt"]
+    assert archive.read("Week 2/b.txt") == b"Week 2/b.txt"
+    assert progress.status == "done"
+    assert (progress.files_done, progress.failed) == (2, [])
+    assert all(item.url.endswith("&token=secret") for item in engine.items)
+
+def test_failed_files_are_listed_in_a_manifest(monkeypatch):
+    files = [_file("a.txt"), _file("b.txt"), _file("c.txt")]
+    archive, progress, _ = build(monkeypatch, files, failing=[files[1]])
+    assert archive.namelist() == ["a.txt", "c.txt", FAILED_MANIFEST]
+    manifest = archive.read(FAILED_MANIFEST).decode()
+    assert manifest.startswith("1 of 3 files could not be downloaded")
+    assert "b.txt\tHTTP 404" in manifest
+    assert progress.status == "done"
+    assert progress.files_done == 3
+    assert progress.failed == [{"filename": "b.txt", "error": "HTTP 404"}]
+
+def test_no_manifest_without_failures(monkeypatch):
+    archive, _, _ = build(monkeypatch, [_file("a.txt")])
+    assert FAILED_MANIFEST not in archive.namelist()
+
+def test_repeated_names_get_suffixes(monkeypatch):
+    first, second = _file("notes.pdf"), _file("notes.pdf")._replace(file_url="https://moodle.example/other/notes.pdf?x=1")
+    archive, _, _ = build(monkeypatch, [first, second])
+    assert archive.namelist() == ["notes.pdf", "notes_1.pdf"]
+
+def test_unique_name():
+    seen = {}
+    assert [unique_name(name, seen) for name in ["a.pdf", "a.pdf", "b", "a.pdf", "b"]] == [
+        "a.pdf", "a_1.pdf", "b", "a_2.pdf", "b_1",
+    ]
@@ -0,0 +1,243 @@
+import asyncio
+import hashlib
+import os
+from datetime import datetime
+import httpx
+import pytest
+from app.services import downloads, file_mirror
+from app.services.download_links import sign_download, verify_download
+from app.services.downloads import DownloadEngine, DownloadFailed, DownloadItem, GrowingFile
+from app.services.file_mirror import FileMirror, MirrorKey
+
+CHUNKS = [bytes([65 + i]) * 1000 for i in range(5)]
+ITEM = DownloadItem("https://moodle.example/pluginfile.php/1/a.pdf?x=1&token=t", "a.pdf",
+                    MirrorKey("https://moodle.example/pluginfile.php/1/a.pdf?x=1", 5000, datetime(2024, 1, 1)))
+
+class FakeResponse:
+    def __init__(self, status_code: int, drop_after: int = None):
+        self.status_code = status_code
+        self.headers = {}
+        self.drop_after = drop_after
+
+    async def aiter_bytes(self, size):
+        for index, chunk in enumerate(CHUNKS):
+            await asyncio.sleep(0.01)
+            if index == self.drop_after:
+                raise httpx.ReadTimeout("dropped")
+            yield chunk
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+class FakeClient:
+    """Answers with `statuses` in turn (the last one repeats); drop_after cuts the first body short"""
+
+    def __init__(self, statuses=(200,), drop_after: int = None):
+        self.statuses = list(statuses)
+        self.drop_after = drop_after
+        self.requests = 0
+
+    def stream(self, method, url, **kwargs):
+        self.requests += 1
+        status = self.statuses.pop(0) if len(self.statuses) > 1 else self.statuses[0]
+        drop, self.drop_after = self.drop_after, None
+        return FakeResponse(status, drop)
+
+class FakeIndex:
+    """Stands in for the mirror's Postgres index: takes the writes, reports `total` stored bytes"""
+
+    def __init__(self):
+        self.total = 0
+        self.recounts = 0
+
+    def __call__(self):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+    async def execute(self, stmt):
+        return self
+
+    def all(self):
+        return []
+
+    async def scalar(self, stmt):
+        self.recounts += 1
+        return self.total
+
+    async def commit(self):
+        pass
+
+class FakeMirror(FileMirror):
+    """The real mirror with an in-memory index; every file is a miss"""
+
+    def __init__(self, root: str, max_bytes: int = 10 ** 9):
+        super().__init__(root, max_bytes)
+        self.downloads = 0
+
+    async def lookup(self, keys):
+        return {}
+
+    async def download(self, *args, **kwargs):
+        self.downloads += 1
+        return await super().download(*args, **kwargs)
+
+@pytest.fixture
+def client(monkeypatch):
+    client = FakeClient()
+    monkeypatch.setattr(downloads, "get_http_client", lambda: client)
+    monkeypatch.setattr(downloads, "backoff_delay", lambda attempt, retry_after=None: 0)
+    return client
+
+@pytest.fixture
+def index(monkeypatch):
+    index = FakeIndex()
+    monkeypatch.setattr(file_mirror, "AsyncSessionLocal", index)
+    return index
+
+@pytest.fixture
+def mirror(monkeypatch, tmp_path, index):
+    mirror = FakeMirror(str(tmp_path))
+    monkeypatch.setattr(downloads, "get_file_mirror", lambda: mirror)
+    return mirror
+
+async def _read(chunks) -> bytes:
+    return b"".join([chunk async for chunk in chunks])
+
+def test_growing_file_readers_follow_the_writer(tmp_path):
+    path = str(tmp_path / "part")
+
+    async def write(out, growing):
+        with out:
+            for chunk in CHUNKS:
+                await asyncio.sleep(0.01)
+                out.write(chunk)
+                out.flush()
+                growing.grew(growing.written + len(chunk))
+
+    async def run():
+        out = open(path, "wb")
+        growing = GrowingFile(path)
+        growing.start(write(out, growing))
+        early = asyncio.create_task(_read(growing.follow()))
+        await asyncio.sleep(0.025)
+        os.remove(path)  # Readers keep the shared descriptor
+        return await early, await _read(growing.follow())
+
+    early, late = asyncio.run(run())
+    assert early == late == b"".join(CHUNKS)
+
+def test_stream_passes_bytes_on_while_filling_the_mirror(client, mirror):
+    async def run():
+        engine = DownloadEngine()
+        first = await engine.stream(ITEM)
+        reading = asyncio.create_task(_read(first.chunks))
+        await asyncio.sleep(0.025)
+        second = await engine.stream(ITEM)
+        return await reading, await _read(second.chunks), engine
+
+    first, second, engine = asyncio.run(run())
+    assert first == second == b"".join(CHUNKS)
+    assert (client.requests, mirror.downloads) == (1, 1)
+    assert engine._inflight == {}
+    with open(mirror._blob_path(hashlib.sha256(first).hexdigest()), "rb") as blob:
+        assert blob.read() == first
+
+def test_stream_resumes_readers_after_a_retry(monkeypatch, mirror):
+    client = FakeClient(drop_after=3)
+    monkeypatch.setattr(downloads, "get_http_client", lambda: client)
+    monkeypatch.setattr(downloads, "backoff_delay", lambda attempt, retry_after=None: 0)
+
+    async def run():
+        download = await DownloadEngine().stream(ITEM)
+        return await _read(download.chunks)
+
+    assert asyncio.run(run()) == b"".join(CHUNKS)
+    assert client.requests == 2
+
+def test_stream_without_mirror(monkeypatch, client):
+    monkeypatch.setattr(downloads, "get_file_mirror", lambda: None)
+
+    async def run():
+        download = await DownloadEngine().stream(ITEM)
+        assert download.file is None
+        return await _read(download.chunks)
+
+    assert asyncio.run(run()) == b"".join(CHUNKS)
+
+def test_stream_raises_before_responding_when_moodle_refuses(monkeypatch, mirror):
+    monkeypatch.setattr(downloads, "get_http_client", lambda: FakeClient(statuses=[404]))
+
+    async def run():
+        await DownloadEngine().stream(ITEM)
+
+    with pytest.raises(DownloadFailed, match="HTTP 404"):
+        asyncio.run(run())
+    assert os.listdir(os.path.join(mirror.root, "tmp")) == []
+
+def test_signed_download_links():
+    expires, sig = sign_download(7, 1, now=1000)
+    assert expires > 1000
+    assert verify_download(7, 1, expires, sig, now=1000)
+    assert sign_download(7, 1, now=1001) == (expires, sig)  # Stable within a window
+    assert not verify_download(7, 2, expires, sig, now=1000)  # Another user's token
+    assert not verify_download(8, 1, expires, sig, now=1000)
+    assert not verify_download(7, 1, expires + 1, sig, now=1000)
+    assert not verify_download(7, 1, expires, sig, now=expires + 1)
+    assert not verify_download(7, 1, None, None)
+
+def test_mirror_download_survives_eviction_of_a_duplicate(client, mirror):
+    content = b"".join(CHUNKS)
+    path = mirror._blob_path(hashlib.sha256(content).hexdigest())
+    os.makedirs(os.path.dirname(path))
+    with open(path, "wb") as existing:
+        existing.write(content)
+    real_discard = file_mirror._HashingFile.discard
+
+    def discard_and_evict(part):
+        real_discard(part)
+        os.remove(path)  # evict() in another task, between the dedupe check and the open
+
+    file_mirror._HashingFile.discard = discard_and_evict
+    try:
+        stored = asyncio.run(mirror.download(DownloadEngine(), ITEM.url, ITEM.key, ITEM.label))
+    finally:
+        file_mirror._HashingFile.discard = real_discard
+    with stored.file:
+        assert stored.file.read() == content
+    assert stored.size == len(content)
+
+def test_mirror_evicts_only_when_over_budget(client, index, tmp_path):
+    mirror = FakeMirror(str(tmp_path), max_bytes=12000)
+    index.total = 5000  # What the index holds once the first file is stored
+
+    async def run():
+        for index_ in range(3):
+            item = ITEM._replace(key=ITEM.key._replace(file_url=f"{ITEM.key.file_url}{index_}"))
+            (await mirror.download(DownloadEngine(), item.url, item.key, item.label)).file.close()
+
+    asyncio.run(run())
+    # Counted on the first download, then kept up to date in memory
+    assert index.recounts == 1
+    assert mirror._stored_bytes == 5000
+
+    mirror.max_bytes = 4000
+    asyncio.run(run())
+    # Over budget: every download evicts (the fake index has nothing to evict)
+    assert index.recounts == 4
+
+def test_download_progress_is_scoped_to_its_user():
+    mine = downloads.start_progress("shared-id", 1, 10, owner=1)
+    theirs = downloads.start_progress("shared-id", 2, 20, owner=2)
+    assert downloads.get_progress(1, "shared-id") is mine
+    assert downloads.get_progress(2, "shared-id") is theirs
+    assert downloads.get_progress(3, "shared-id") is None
+    downloads.attach_progress(3, "joined", mine)
+    assert downloads.get_progress(3, "joined") is mine
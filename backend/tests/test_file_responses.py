@@ -0,0 +1,82 @@
+import io
+import pytest
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+from app.services.file_responses import etag_matches, file_response, parse_range
+
+BODY = bytes(range(256)) * 400
+ETAG = '"v1"'
+
+@pytest.mark.parametrize("header, expected", [
+    (None, None),
+    ("", None),
+    ("bytes=0-99", (0, 99)),
+    ("bytes=100-", (100, 999)),
+    ("bytes=-100", (900, 999)),
+    ("bytes=-5000", (0, 999)),
+    ("bytes=990-5000", (990, 999)),
+    ("bytes=0-0", (0, 0)),
+    ("bytes=-", None),
+    ("bytes=0-1,5-6", None),  # Multiple ranges: whole file
+    ("items=0-10", None),
+])
+def test_parse_range(header, expected):
+    assert parse_range(header, 1000) == expected
+
+@pytest.mark.parametrize("header", ["bytes=1000-", "bytes=5-4", "bytes=-0"])
+def test_parse_range_unsatisfiable(header):
+    with pytest.raises(ValueError):
+        parse_range(header, 1000)
+
+def test_etag_matches():
+    assert etag_matches('"v1"', '"v1"')
+    assert etag_matches('"v0", W/"v1"', '"v1"')
+    assert etag_matches("*", '"v1"')
+    assert not etag_matches('"v2"', '"v1"')
+    assert not etag_matches(None, '"v1"')
+
+@pytest.fixture
+def client():
+    app = FastAPI()
+
+    @app.get("/file")
+    async def serve(request: Request, etag: bool = True):
+        return file_response(request, io.BytesIO(BODY), len(BODY), "application/octet-stream", ETAG if etag else None)
+
+    return TestClient(app)
+
+def test_whole_file(client):
+    response = client.get("/file")
+    assert response.status_code == 200
+    assert response.content == BODY
+    assert response.headers["accept-ranges"] == "bytes"
+    assert response.headers["etag"] == ETAG
+    assert response.headers["content-length"] == str(len(BODY))
+
+def test_range(client):
+    response = client.get("/file", headers={"Range": "bytes=1000-70000"})
+    assert response.status_code == 206
+    assert response.content == BODY[1000:70001]
+    assert response.headers["content-range"] == f"bytes 1000-70000/{len(BODY)}"
+
+def test_not_modified(client):
+    response = client.get("/file", headers={"If-None-Match": ETAG})
+    assert response.status_code == 304
+    assert response.content == b""
+
+def test_unsatisfiable_range(client):
+    response = client.get("/file", headers={"Range": f"bytes={len(BODY)}-"})
+    assert response.status_code == 416
+    assert response.headers["content-range"] == f"bytes */{len(BODY)}"
+
+def test_if_range(client):
+    partial = client.get("/file", headers={"Range": "bytes=0-9", "If-Range": ETAG})
+    assert partial.status_code == 206
+    # The file changed since the client's partial download: send all of it
+    changed = client.get("/file", headers={"Range": "bytes=0-9", "If-Range": '"v0"'})
+    assert changed.status_code == 200
+    assert changed.content == BODY
+
+def test_without_etag_only_plain_ranges(client):
+    assert client.get("/file?etag=false", headers={"Range": "bytes=0-9"}).status_code == 206
+    assert client.get("/file?etag=false", headers={"Range": "bytes=0-9", "If-Range": ETAG}).status_code == 200
@@ -0,0 +1,15 @@
+from sqlalchemy.dialects import postgresql
+from app.services.job_queue import _insert_job
+
+def _sql(stmt) -> str:
+    return str(stmt.compile(dialect=postgresql.asyncpg.dialect()))
+
+def test_conflict_target_is_literal_sql():
+    # asyncpg's generic plans cannot match a partial index against bound parameters
+    sql = _sql(_insert_job("sync", {"user_id": 1}, "sync:1", None, None))
+    conflict = sql[sql.index("ON CONFLICT"):sql.index("DO NOTHING")]
+    assert conflict.strip() == "ON CONFLICT (dedupe_key) WHERE status IN ('queued', 'running')"
+    assert "$" not in conflict and "POSTCOMPILE" not in conflict
+
+def test_no_conflict_clause_without_dedupe_key():
+    assert "ON CONFLICT" not in _sql(_insert_job("sync", None, None, None, None))
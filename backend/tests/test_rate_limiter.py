@@ -0,0 +1,111 @@
+import asyncio
+import pytest
+from app.config import settings
+from app.services import rate_limiter
+from app.services.rate_limiter import AdaptiveLimiter, CircuitBreaker, CircuitOpenError, backoff_delay
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(rate_limiter.time, "monotonic", clock)
+    return clock
+
+def test_limiter_grows_additively_up_to_maximum():
+    limiter = AdaptiveLimiter(initial=2, minimum=1, maximum=3, latency_target=1.0)
+    limiter.on_success(0.1)
+    assert limiter.limit == pytest.approx(2.5)
+    for _ in range(20):
+        limiter.on_success(0.1)
+    assert limiter.limit == 3
+
+def test_limiter_halves_once_per_latency_window(clock):
+    limiter = AdaptiveLimiter(initial=16, minimum=2, maximum=16, latency_target=3.0)
+    limiter.on_overload()
+    limiter.on_overload()  # Same burst of slow responses
+    assert limiter.limit == 8
+    clock.now += 3.0
+    limiter.on_success(5.0)  # Slower than the target counts as overload
+    assert limiter.limit == 4
+    clock.now += 3.0
+    limiter.on_overload()
+    clock.now += 3.0
+    limiter.on_overload()
+    assert limiter.limit == 2
+
+def test_limiter_caps_concurrency():
+    limiter = AdaptiveLimiter(initial=2, minimum=1, maximum=2, latency_target=1.0)
+    peak = 0
+
+    async def call():
+        nonlocal peak
+        await limiter.acquire()
+        peak = max(peak, limiter.in_flight)
+        await asyncio.sleep(0.01)
+        await limiter.release()
+
+    async def main():
+        await asyncio.gather(*[call() for _ in range(6)])
+
+    asyncio.run(main())
+    assert peak == 2
+    assert limiter.in_flight == 0
+
+def test_breaker_opens_after_threshold(clock):
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=60.0)
+    breaker.on_failure()
+    breaker.on_failure()
+    assert breaker.state == "closed"
+    breaker.before_call()
+    breaker.on_failure()
+    assert breaker.state == "open"
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+def test_breaker_lets_one_probe_through_when_half_open(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60.0)
+    breaker.on_failure()
+    clock.now += 60.0
+    assert breaker.state == "half_open"
+    breaker.before_call()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    breaker.on_success()
+    assert breaker.state == "closed"
+    assert breaker.failures == 0
+
+def test_breaker_failed_probe_reopens(clock):
+    breaker = CircuitBreaker(failure_threshold=5, reset_timeout=60.0)
+    for _ in range(5):
+        breaker.on_failure()
+    clock.now += 60.0
+    breaker.before_call()
+    breaker.on_failure()
+    assert breaker.state == "open"
+
+def test_breaker_frees_probe_slot_without_verdict(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60.0)
+    breaker.on_failure()
+    clock.now += 60.0
+    breaker.before_call()
+    breaker.after_call()  # e.g. a 4xx: neither success nor failure
+    breaker.before_call()
+
+def test_backoff_is_jittered_and_capped(monkeypatch):
+    monkeypatch.setattr(settings, "moodle_retry_backoff_base", 0.5)
+    monkeypatch.setattr(settings, "moodle_retry_backoff_max", 15.0)
+    monkeypatch.setattr(rate_limiter.random, "uniform", lambda low, high: high)
+    assert [backoff_delay(attempt) for attempt in range(7)] == [0.5, 1.0, 2.0, 4.0, 8.0, 15.0, 15.0]
+    monkeypatch.setattr(rate_limiter.random, "uniform", lambda low, high: low)
+    assert backoff_delay(3) == 0
+
+def test_backoff_honours_retry_after(monkeypatch):
+    monkeypatch.setattr(settings, "moodle_retry_backoff_max", 15.0)
+    assert backoff_delay(0, retry_after=7) == 7
+    assert backoff_delay(0, retry_after=120) == 15.0
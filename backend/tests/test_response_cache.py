@@ -0,0 +1,97 @@
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from app.services import response_cache
+from app.services.response_cache import MemoryBackend, ResponseCache, ResponseCacheBackend, ResponseCacheMiddleware
+
+def test_key_ignores_query_order():
+    cache = ResponseCache(MemoryBackend(10), ttl=60)
+    assert cache.key(0, "h", "/api/courses/", "a=1&b=2") == cache.key(0, "h", "/api/courses/", "b=2&a=1")
+    assert cache.key(0, "h", "/api/courses/", "a=1") != cache.key(1, "h", "/api/courses/", "a=1")
+    assert cache.key(0, "h", "/api/courses/", "") != cache.key(0, "other", "/api/courses/", "")
+
+def test_incomplete_backend_fails_on_creation():
+    class NoClear(ResponseCacheBackend):
+        def get(self, key):
+            return None
+
+        def set(self, key, entry):
+            pass
+
+    with pytest.raises(TypeError):
+        NoClear()
+
+def test_memory_backend_evicts_least_recently_used():
+    cache = ResponseCache(MemoryBackend(2), ttl=60)
+    cache.store("a", b"1", b"application/json")
+    cache.store("b", b"2", b"application/json")
+    cache.get("a")
+    cache.store("c", b"3", b"application/json")
+    assert [cache.get(key) is not None for key in "abc"] == [True, False, True]
+
+def test_entries_expire(monkeypatch):
+    cache = ResponseCache(MemoryBackend(10), ttl=60)
+    now = [1000.0]
+    monkeypatch.setattr(response_cache.time, "monotonic", lambda: now[0])
+    cache.store("a", b"1", b"application/json")
+    now[0] += 61
+    assert cache.get("a") is None
+
+@pytest.fixture
+def app(monkeypatch):
+    cache = ResponseCache(MemoryBackend(10), ttl=60)
+    monkeypatch.setattr(response_cache, "get_response_cache", lambda: cache)
+    app = FastAPI()
+    app.add_middleware(ResponseCacheMiddleware)
+    app.state.cache = cache
+    app.state.calls = 0
+    app.state.courses = ["Algebra"]
+
+    @app.get("/api/courses/")
+    async def courses():
+        app.state.calls += 1
+        return app.state.courses
+
+    @app.get("/api/other")
+    async def other():
+        app.state.calls += 1
+        return []
+
+    return app
+
+def test_second_request_is_served_from_cache(app):
+    client = TestClient(app)
+    first = client.get("/api/courses/")
+    second = client.get("/api/courses/")
+    assert first.json() == second.json() == ["Algebra"]
+    assert (first.headers["x-cache"], second.headers["x-cache"]) == ("miss", "hit")
+    assert first.headers["etag"] == second.headers["etag"]
+    assert app.state.calls == 1
+
+def test_matching_etag_gets_304(app):
+    client = TestClient(app)
+    etag = client.get("/api/courses/").headers["etag"]
+    response = client.get("/api/courses/", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+
+def test_invalidation_rebuilds_and_keeps_unchanged_etags(app):
+    client = TestClient(app)
+    etag = client.get("/api/courses/").headers["etag"]
+    app.state.cache.bump()
+    # Rebuilt after a sync that changed nothing here: still a 304
+    unchanged = client.get("/api/courses/", headers={"If-None-Match": etag})
+    assert unchanged.status_code == 304
+    app.state.cache.bump()
+    app.state.courses = ["Algebra", "Calculus"]
+    changed = client.get("/api/courses/", headers={"If-None-Match": etag})
+    assert changed.status_code == 200
+    assert changed.json() == ["Algebra", "Calculus"]
+    assert app.state.calls == 3
+
+def test_other_paths_are_not_cached(app):
+    client = TestClient(app)
+    client.get("/api/other")
+    response = client.get("/api/other")
+    assert "x-cache" not in response.headers
+    assert app.state.calls == 2
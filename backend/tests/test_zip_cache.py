@@ -0,0 +1,128 @@
+import asyncio
+import io
+import os
+import zipfile
+import pytest
+from app.services.course_zips import ZipCache, ZipCacheKey
+from app.services.downloads import start_progress
+from app.services.zip_stream import ZipMember, stream_zip
+
+KEY = ZipCacheKey(42, False, "abc")
+
+class Builds:
+    """build() callbacks for ZipCache, counting how often an archive was built"""
+
+    def __init__(self, files: int = 3, delay: float = 0.01, fail: bool = False):
+        self.files = files
+        self.delay = delay
+        self.fail = fail
+        self.count = 0
+
+    def __call__(self):
+        self.count += 1
+        progress = start_progress(None, self.files, self.files * 1000)
+
+        async def data(index):
+            await asyncio.sleep(self.delay)
+            if self.fail and index == 1:
+                raise RuntimeError("build broke")
+            yield bytes([index]) * 1000
+
+        async def members():
+            for index in range(self.files):
+                yield ZipMember(f"{index}.bin", data(index), size=1000)
+                progress.file_done(1000)
+            progress.finish("done")
+
+        return stream_zip(members()), progress
+
+async def _read(chunks) -> bytes:
+    return b"".join([chunk async for chunk in chunks])
+
+def test_miss_streams_and_fills_the_cache(tmp_path):
+    cache = ZipCache(str(tmp_path), 10 ** 7)
+    build = Builds()
+
+    async def run():
+        miss = await cache.get_or_build(KEY, build)
+        assert miss.file is None
+        data = await _read(miss.chunks)
+        hit = await cache.get_or_build(KEY, build)
+        with hit.file:
+            return data, hit.file.read(), hit.size
+
+    data, cached, size = asyncio.run(run())
+    assert build.count == 1
+    assert data == cached and size == len(data)
+    assert zipfile.ZipFile(io.BytesIO(data)).namelist() == ["0.bin", "1.bin", "2.bin"]
+    assert cache.has(KEY)
+
+def test_concurrent_requests_share_one_build(tmp_path):
+    cache = ZipCache(str(tmp_path), 10 ** 7)
+    build = Builds(delay=0.02)
+
+    async def run():
+        first = await cache.get_or_build(KEY, build)
+        reading = asyncio.create_task(_read(first.chunks))
+        await asyncio.sleep(0.03)  # Mid-build
+        second = await cache.get_or_build(KEY, build)
+        return await reading, await _read(second.chunks)
+
+    first, second = asyncio.run(run())
+    assert build.count == 1
+    assert first == second
+
+def test_build_outlives_a_client_that_leaves(tmp_path):
+    cache = ZipCache(str(tmp_path), 10 ** 7)
+    build = Builds()
+
+    async def run():
+        miss = await cache.get_or_build(KEY, build)
+        await miss.chunks.__anext__()
+        await miss.chunks.aclose()
+        await cache.ensure(KEY, build)
+
+    asyncio.run(run())
+    assert build.count == 1
+    assert cache.has(KEY)
+
+def test_failed_build_reaches_readers_and_leaves_nothing(tmp_path):
+    cache = ZipCache(str(tmp_path), 10 ** 7)
+
+    async def run():
+        miss = await cache.get_or_build(KEY, Builds(fail=True))
+        with pytest.raises(RuntimeError, match="build broke"):
+            await _read(miss.chunks)
+        await asyncio.sleep(0)
+
+    asyncio.run(run())
+    assert not cache.has(KEY)
+    assert os.listdir(tmp_path / "tmp") == []
+
+def test_new_version_replaces_the_old_one(tmp_path):
+    cache = ZipCache(str(tmp_path), 10 ** 7)
+    newer = KEY._replace(fingerprint="def")
+
+    async def run():
+        await cache.ensure(KEY, Builds())
+        await cache.ensure(newer, Builds())
+
+    asyncio.run(run())
+    assert not cache.has(KEY)
+    assert cache.has(newer)
+
+def test_evicts_least_recently_served(tmp_path):
+    cache = ZipCache(str(tmp_path), 10 ** 7)
+    keys = [ZipCacheKey(course_id, False, "abc") for course_id in range(3)]
+
+    async def run():
+        for key in keys:
+            await cache.ensure(key, Builds())
+
+    asyncio.run(run())
+    for age, key in enumerate(keys):
+        os.utime(os.path.join(tmp_path, key.name + ".zip"), (1000 + age, 1000 + age))
+    size = os.path.getsize(os.path.join(tmp_path, keys[0].name + ".zip"))
+    cache.max_bytes = 2 * size
+    assert cache.evict() == 1
+    assert [cache.has(key) for key in keys] == [False, True, True]
@@ -0,0 +1,84 @@
+import asyncio
+import io
+import zipfile
+from datetime import datetime
+from app.services.zip_stream import ZipMember, compress_type_for, stream_zip
+
+async def _chunks(*parts: bytes):
+    for part in parts:
+        yield part
+
+def build(members) -> bytes:
+    async def run():
+        async def generate():
+            for member in members:
+                yield member
+        return b"".join([chunk async for chunk in stream_zip(generate())])
+    return asyncio.run(run())
+
+def test_archive_round_trips():
+    data = build([
+        ZipMember("notes.txt", _chunks(b"hello ", b"world"), size=11, modified=datetime(2024, 3, 1, 12, 30)),
+        ZipMember("Week 1/slides.pdf", _chunks(b"%PDF" * 1000), size=4000, compress_type=zipfile.ZIP_STORED),
+    ])
+    archive = zipfile.ZipFile(io.BytesIO(data))
+    assert archive.testzip() is None
+    assert archive.namelist() == ["notes.txt", "Week 1/slides.pdf"]
+    assert archive.read("notes.txt") == b"hello world"
+    assert archive.read("Week 1/slides.pdf") == b"%PDF" * 1000
+    assert archive.getinfo("notes.txt").date_time == (2024, 3, 1, 12, 30, 0)
+    assert archive.getinfo("notes.txt").compress_type == zipfile.ZIP_DEFLATED
+    assert archive.getinfo("Week 1/slides.pdf").compress_type == zipfile.ZIP_STORED
+
+def test_unknown_size_and_empty_members():
+    data = build([
+        ZipMember("unknown.bin", _chunks(b"x" * 100000)),  # size 0: written as zip64
+        ZipMember("empty.txt", _chunks()),
+    ])
+    archive = zipfile.ZipFile(io.BytesIO(data))
+    assert archive.read("unknown.bin") == b"x" * 100000
+    assert archive.read("empty.txt") == b""
+
+def test_dates_before_1980_are_clamped():
+    data = build([ZipMember("old.txt", _chunks(b"x"), size=1, modified=datetime(1970, 1, 1))])
+    assert zipfile.ZipFile(io.BytesIO(data)).getinfo("old.txt").date_time[0] >= 1980
+
+def test_streams_while_members_are_produced():
+    produced = []
+
+    async def members():
+        for i in range(3):
+            produced.append(i)
+            yield ZipMember(f"{i}.txt", _chunks(b"data" * 100), size=400)
+
+    async def run():
+        stream = stream_zip(members())
+        await stream.__anext__()
+        # The first bytes are out before the later members were even requested
+        assert produced == [0]
+        await stream.aclose()
+
+    asyncio.run(run())
+
+def test_closing_the_stream_closes_the_producer():
+    closed = []
+
+    async def members():
+        try:
+            for i in range(100):
+                yield ZipMember(f"{i}.txt", _chunks(b"data"), size=4)
+        finally:
+            closed.append(True)
+
+    async def run():
+        stream = stream_zip(members())
+        await stream.__anext__()
+        await stream.aclose()
+
+    asyncio.run(run())
+    assert closed == [True]
+
+def test_compress_type_for():
+    assert compress_type_for("slides.PDF") == zipfile.ZIP_STORED
+    assert compress_type_for("lecture", "video/mp4") == zipfile.ZIP_STORED
+    assert compress_type_for("notes.txt", "text/plain") == zipfile.ZIP_DEFLATED
@@ -56,7 +56,7 @@ function AppContent() {
   })
 
   const syncMutation = useMutation({
-    mutationFn: triggerSync,
+    mutationFn: () => triggerSync(),
     onSuccess: () => {
       setSyncError(null)
       // Refetch all data after sync
@@ -38,38 +38,90 @@ export const getExams = async () => {
   return response.data
 }
 
-export const downloadCourseZip = async (courseId: number, filename: string, flat: boolean = false) => {
-  const response = await api.get(`/api/resources/download-zip/${courseId}`, {
-    params: { flat },
-    responseType: 'blob'
-  })
-
-  // Create blob link to download
-  const url = window.URL.createObjectURL(new Blob([response.data]))
-  const link = document.createElement('a')
-  link.href = url
-  link.setAttribute('download', filename)
-  document.body.appendChild(link)
-  link.click()
-  link.remove()
+export interface DownloadProgress {
+  id: string
+  status: 'running' | 'done' | 'cancelled' | 'failed'
+  files_total: number
+  files_done: number
+  files_failed: number
+  bytes_total: number
+  bytes_done: number
+  failed: { filename: string; error: string }[]
 }
 
-export const downloadAllResourcesZip = async () => {
-  const response = await api.get('/api/resources/download-all-zip', {
-    responseType: 'blob'
-  })
+// Downloads a ZIP endpoint as a file, polling the server-side build progress
+// (files fetched from Moodle, failures) while the archive streams in.
+const downloadZip = async (
+  path: string,
+  filename: string,
+  params: Record<string, any> = {},
+  onProgress?: (progress: DownloadProgress) => void
+) => {
+  const downloadId = crypto.randomUUID()
+  const poll = onProgress
+    ? setInterval(async () => {
+        try {
+          const { data } = await api.get(`/api/resources/downloads/${downloadId}`)
+          onProgress(data)
+        } catch {
+          // Not registered yet
+        }
+      }, 1000)
+    : undefined
 
-  // Create blob link to download
-  const url = window.URL.createObjectURL(new Blob([response.data]))
-  const link = document.createElement('a')
-  link.href = url
-  link.setAttribute('download', 'all_course_materials.zip')
-  document.body.appendChild(link)
-  link.click()
-  link.remove()
+  try {
+    const response = await api.get(path, {
+      params: { ...params, download_id: downloadId },
+      responseType: 'blob'
+    })
+
+    // Create blob link to download
+    const url = window.URL.createObjectURL(new Blob([response.data]))
+    const link = document.createElement('a')
+    link.href = url
+    link.setAttribute('download', filename)
+    document.body.appendChild(link)
+    link.click()
+    link.remove()
+  } finally {
+    if (poll) clearInterval(poll)
+  }
 }
 
-export const triggerSync = async () => {
-  const { data } = await api.post('/api/sync/')
-  return data
+export const downloadCourseZip = async (
+  courseId: number,
+  filename: string,
+  flat: boolean = false,
+  onProgress?: (progress: DownloadProgress) => void
+) => downloadZip(`/api/resources/download-zip/${courseId}`, filename, { flat }, onProgress)
+
+export const downloadAllResourcesZip = async (onProgress?: (progress: DownloadProgress) => void) =>
+  downloadZip('/api/resources/download-all-zip', 'all_course_materials.zip', {}, onProgress)
+
+// Starts (or joins) a background sync job and resolves when it finishes.
+// Progress events are passed to onProgress as they stream in.
+export const triggerSync = async (onProgress?: (event: any) => void) => {
+  const { data: job } = await api.post('/api/sync/')
+
+  return new Promise((resolve, reject) => {
+    const source = new EventSource(`${API_URL}/api/sync/jobs/${job.job_id}/events`)
+    const handle = (e: MessageEvent) => {
+      const event = JSON.parse(e.data)
+      onProgress?.(event)
+      if (event.event === 'done') {
+        source.close()
+        resolve(job)
+      } else if (event.event === 'error') {
+        source.close()
+        reject(new Error(event.detail || 'Sync failed'))
+      }
+    }
+    ;['started', 'courses', 'changes', 'statuses', 'contents', 'assignments', 'retrying', 'dispatched', 'user', 'done', 'error'].forEach(name =>
+      source.addEventListener(name, handle as EventListener)
+    )
+    source.onerror = () => {
+      source.close()
+      reject(new Error('Lost connection to sync progress stream'))
+    }
+  })
 }